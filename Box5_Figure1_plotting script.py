@@ -2,44 +2,45 @@
 # coding: utf-8
 
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib import gridspec
-import cartopy.crs as ccrs
-
-
-# requires the Iris package. See:
-# https://scitools.org.uk/
-# https://scitools-iris.readthedocs.io/en/stable/
-#
-import iris
-import iris.plot as iplt
 
 import os
 import sys
-print("The Python version is %s.%s.%s" % sys.version_info[:3])
-print("The Iris version is ", iris.__version__)
 
+# consolidated store of all inputs, read when present, see ts5_store.py
+import ts5_store
 
-'''
-returns a numpy array of years from an Iris cube
-'''
-def get_yr(x):
-    yr2=x.coord('time')
-    y2=yr2.units.num2date(yr2.points)
-    y3=np.array(y2[0].year)
-    for ii in range(1,len(y2)):
-       y3=np.append(y3,y2[ii].year)
-    
-    return y3
+# vectorized multi-model statistics, see ts5_stats.py
+import ts5_stats
+
+# parallel loaders for the larger inputs, see ts5_io.py
+import ts5_io
+
+# stages of the calculation and their fingerprints, see ts5_pipeline.py
+import ts5_pipeline
+
+# shared year index for the time series, see ts5_timeline.py
+import ts5_timeline
+
+# optional per-stage timing and memory report (TS5_PROFILE=1), see ts5_profile.py
+import ts5_profile
+
+# tidy columnar export of the plotted series (TS5_EXPORT=<file>), see ts5_export.py
+import ts5_export
+
+# area-weighted grid operations: zonal profiles of the maps and coarsening for
+# draft previews, see ts5_grid.py
+import ts5_grid
+
+print("The Python version is %s.%s.%s" % sys.version_info[:3])
 
 
 '''
-simple smoother function
+simple smoother function: running mean of box_pts points along the last axis of a
+series or a stack of them, averaged over the points available at the ends (see
+ts5_timeline.running_mean)
 '''
 def smooth(y, box_pts):
-    box = np.ones(box_pts)/box_pts
-    y_smooth = np.convolve(y, box, mode='same')
-    return y_smooth
+    return ts5_timeline.running_mean(y, box_pts)
 
 
 # SSP colours:
@@ -52,35 +53,10 @@ col_ssp585 = '#840B22'
 col_ssp534 = '#9A6DC9'
 
 
-# read CMIP6 conc-driven CO2 concentrations
-#
-y_hist, co2_hist = np.loadtxt('CMIP6_HIST_CO2.dat',skiprows=1).T
-
-y_ssp, co2_ssp119, co2_ssp126, co2_ssp245, co2_ssp534, co2_ssp370, co2_ssp585 = np.loadtxt('CMIP6_SSP_CO2.dat',skiprows=1).T
-
-y_ssp_2300, co2_ssp126_2300, co2_ssp534_2300, co2_ssp585_2300 = np.loadtxt('CMIP6_SSP2300_CO2.dat',skiprows=1).T
-
-# "historical" data runs to 2014 and then SSPs from 2015 - this leaves a gap when plotted as separate lines
-# so extend hist data to 2015 so there's no gap in plotting. first year of SSPs is invariant across scenarios to 5 sig.fig.
-y_hist = np.append(y_hist, 2015)
-co2_hist = np.append(co2_hist, co2_ssp245[0])
-
-
-# read CMIP6 emission-driven CO2 concentrations
-y_e,co2_e_mmm,co2_e_pc5,co2_e_pc95 = np.loadtxt('CMIP6_e-CO2.dat',skiprows=1).T
-
-
 # create dictionaries for ease of selecting scenarios, colours etc
 #
-data = dict([('hist', co2_hist),('ssp585', co2_ssp585),
-             ('ssp370', co2_ssp370),('ssp534', co2_ssp534), 
-             ('ssp245', co2_ssp245), ('ssp126', co2_ssp126),
-             ('ssp119', co2_ssp119)])
-
-yr_data = dict([('hist', y_hist), ('ssp119', y_ssp), ('ssp126', y_ssp),
-             ('ssp245', y_ssp), ('ssp534', y_ssp), ('ssp370', y_ssp),
-             ('ssp585', y_ssp)])
 
+# set all lines to True, but can be configured to select subset
 plot_data = dict([('hist', True), ('ssp119', True), ('ssp126', True),
              ('ssp245', True), ('ssp534', True), ('ssp370', True),
              ('ssp585', True)])
@@ -93,6 +69,62 @@ lab = dict([('hist', 'Historical'), ('ssp119', 'SSP1-1.9'), ('ssp126', 'SSP1-2.6
              ('ssp245', 'SSP2-4.5'), ('ssp534', 'SSP5-3.4OS'), ('ssp370', 'SSP3-7.0'),
              ('ssp585', 'SSP5-8.5')])
 
+# lower and upper percentiles of the shaded model ranges
+pcs = [5, 95]
+
+# scenarios whose model range is shaded in panels f and g
+shade = ['ssp126', 'ssp370']
+
+# bootstrap confidence intervals (limits ci from n_boot resamples of the models)
+# of the multi-model mean and percentiles, drawn for the shaded scenarios of
+# panels f and g when show_ci is set
+n_boot = 1000
+boot_seed = 0
+ci = [2.5, 97.5]
+show_ci = False
+
+
+# the data are computed in named stages (see ts5_pipeline.py). each stage's output
+# is kept on disk under a fingerprint of its code, settings, input files and
+# upstream stages, so a rerun only recomputes what has changed
+
+
+# read CMIP6 conc-driven CO2 concentrations
+#
+@ts5_pipeline.stage(outputs=['data', 'yr_data', 'y_e', 'co2_e_pc5', 'co2_e_pc95'],
+             files=['CMIP6_HIST_CO2.dat', 'CMIP6_SSP_CO2.dat', 'CMIP6_e-CO2.dat'])
+def load_co2():
+    hist = ts5_store.loadtxt('CMIP6_HIST_CO2.dat',skiprows=1).T
+    ssp = ts5_store.loadtxt('CMIP6_SSP_CO2.dat',skiprows=1).T
+
+    # historical and SSP concentrations share one (scenario, year) array, columns
+    # are ssp119, ssp126, ssp245, ssp534, ssp370, ssp585
+    y_co2 = ts5_timeline.index(hist[0][0], ssp[0][-1])
+    co2 = np.empty((len(ssp) - 1, len(y_co2)))
+    ts5_timeline.place(y_co2, hist[0], hist[1], out=co2)
+    ts5_timeline.place(y_co2, ssp[0], ssp[1:], out=co2)
+    co2_ssp119, co2_ssp126, co2_ssp245, co2_ssp534, co2_ssp370, co2_ssp585 = co2
+
+    # "historical" data runs to 2014 and then SSPs from 2015 - this leaves a gap when plotted as separate lines
+    # so extend hist data to 2015 so there's no gap in plotting. first year of SSPs is invariant across scenarios to 5 sig.fig.
+    # the historical line is therefore a view of the ssp245 row up to 2015 and each SSP a view from 2015
+    y0, y1 = hist[0][0], ssp[0][0]
+
+    # read CMIP6 emission-driven CO2 concentrations
+    y_e,co2_e_mmm,co2_e_pc5,co2_e_pc95 = ts5_store.loadtxt('CMIP6_e-CO2.dat',skiprows=1).T
+
+    data = dict([('hist', ts5_timeline.view(y_co2, co2_ssp245, y0, y1))] +
+                [(i, ts5_timeline.view(y_co2, c, y1, y_co2[-1])) for i, c in
+                 [('ssp585', co2_ssp585), ('ssp370', co2_ssp370), ('ssp534', co2_ssp534),
+                  ('ssp245', co2_ssp245), ('ssp126', co2_ssp126), ('ssp119', co2_ssp119)]])
+
+    yr_data = dict([('hist', ts5_timeline.view(y_co2, y_co2, y0, y1))] +
+                   [(i, ts5_timeline.view(y_co2, y_co2, y1, y_co2[-1])) for i in
+                    ['ssp119', 'ssp126', 'ssp245', 'ssp534', 'ssp370', 'ssp585']])
+
+    return dict([('data', data), ('yr_data', yr_data), ('y_e', y_e),
+                 ('co2_e_pc5', co2_e_pc5), ('co2_e_pc95', co2_e_pc95)])
+
 
 # CO2 concentrations from MAGICC emiss-driven runs for SSPs
 # with grateful acknowledgement to Zebedee Nicholls
@@ -107,184 +139,141 @@ The setup used to generate this data is described extensively in Cross-chapter B
 Meinshausen et al. [2009](https://doi.org/10.1038/nature08017), [2011](https://doi.org/10.5194/acp-11-1417-2011) and [2020](https://doi.org/10.5194/gmd-13-3571-2020).
 '''
 
-co2_ssp119_magicc = iris.load('MAGICCv7.5.1_atmospheric-co2_esm-ssp119.nc')[0]
-co2_ssp126_magicc = iris.load('MAGICCv7.5.1_atmospheric-co2_esm-ssp126.nc')[0]
-co2_ssp245_magicc = iris.load('MAGICCv7.5.1_atmospheric-co2_esm-ssp245.nc')[0]
-co2_ssp534_magicc = iris.load('MAGICCv7.5.1_atmospheric-co2_esm-ssp534-over.nc')[0]
-co2_ssp370_magicc = iris.load('MAGICCv7.5.1_atmospheric-co2_esm-ssp370.nc')[0]
-co2_ssp585_magicc = iris.load('MAGICCv7.5.1_atmospheric-co2_esm-ssp585.nc')[0]
+# only the scenarios shaded in panel e are read. SSP5-8.5 is shown with the CMIP6
+# emission-driven range instead, so MAGICCv7.5.1_atmospheric-co2_esm-ssp585.nc is not needed
+magicc_files = dict([('ssp126', 'MAGICCv7.5.1_atmospheric-co2_esm-ssp126.nc'),
+             ('ssp119', 'MAGICCv7.5.1_atmospheric-co2_esm-ssp119.nc'),
+             ('ssp245', 'MAGICCv7.5.1_atmospheric-co2_esm-ssp245.nc'),
+             ('ssp534', 'MAGICCv7.5.1_atmospheric-co2_esm-ssp534-over.nc'),
+             ('ssp370', 'MAGICCv7.5.1_atmospheric-co2_esm-ssp370.nc')])
+
+# ensembles are reduced exactly in memory by default. for very large ensembles set
+# magicc_chunk to a number of members to stream them through a bounded-memory
+# quantile sketch instead (error bound documented in ts5_stats.py)
+magicc_chunk = None
+
+# load the ensembles of the drawn scenarios in parallel and create array of years
+# and multi-model mean, 5-95% ranges. the raw ensembles are kept per input file
+# (see ts5_io.load_ensembles), so a change of pcs or plot_data only redoes the
+# reduction
+#
+@ts5_pipeline.stage(outputs=['magicc_yr', 'magicc_mmm', 'magicc_pc5', 'magicc_pc95'],
+             files=list(magicc_files.values()))
+def magicc_stats():
+    files = dict([(i, magicc_files[i]) for i in magicc_files if plot_data[i]])
+
+    if magicc_chunk or not files:
+        magicc_yr, magicc_mmm, (magicc_pc5, magicc_pc95) = ts5_io.load_magicc(files, pcs, chunk=magicc_chunk)
+    else:
+        magicc_yr, ens = ts5_io.load_ensembles(files)
+        magicc_mmm, (magicc_pc5, magicc_pc95) = ts5_stats.ens_stats(ens, pcs)
+
+    return dict([('magicc_yr', magicc_yr), ('magicc_mmm', magicc_mmm),
+                 ('magicc_pc5', magicc_pc5), ('magicc_pc95', magicc_pc95)])
 
 
-# create array of years and multi-model mean, 5-95% ranges
+# multi-model, multi-scenario flux data from Liddicoat et al., 2020
+# with grateful acknowledgement to Spencer Liddicoat
+# https://journals.ametsoc.org/view/journals/clim/aop/JCLI-D-19-0991.1/JCLI-D-19-0991.1.xml
 #
-magicc_yr = get_yr(co2_ssp126_magicc[0])
 
-magicc_ssp126_mmm = np.mean(co2_ssp126_magicc.data,axis=0)
-magicc_ssp126_pc95 = np.percentile(co2_ssp126_magicc.data,95,axis=0)
-magicc_ssp126_pc5 = np.percentile(co2_ssp126_magicc.data,5,axis=0)
+# scenario file tags of every scenario named in plot_data, drawn or not, from the
+# files in the data directory (or the store), e.g. ssp534 -> Ssp534os (see
+# ts5_io.discover_liddicoat). scenarios switched off are loaded too, so variants
+# and watch mode can switch them on without a change of the input files
+liddicoat_ssp = ts5_io.discover_liddicoat(scenarios=[i for i in plot_data if i != 'hist'])
 
-magicc_ssp119_mmm = np.mean(co2_ssp119_magicc.data,axis=0)
-magicc_ssp119_pc95 = np.percentile(co2_ssp119_magicc.data,95,axis=0)
-magicc_ssp119_pc5 = np.percentile(co2_ssp119_magicc.data,5,axis=0)
+liddicoat_files = ['global_total_FGCO2_GtC_yr_Historical%s.txt' % i for i in liddicoat_ssp.values()] + \
+                  ['global_total_NBP_GtC_yr_Historical%s.txt' % i for i in liddicoat_ssp.values()] + \
+                  ['ffEmsHistorical%s_GtCyr.txt' % i for i in liddicoat_ssp.values()]
 
-magicc_ssp245_mmm = np.mean(co2_ssp245_magicc.data,axis=0)
-magicc_ssp245_pc95 = np.percentile(co2_ssp245_magicc.data,95,axis=0)
-magicc_ssp245_pc5 = np.percentile(co2_ssp245_magicc.data,5,axis=0)
+# read in calculated fossil-fuel emissions and land and ocean fluxes, all files at
+# once into (column, year) arrays: row 0 is the year, the others the models
+#
+@ts5_pipeline.stage(outputs=['fgco2', 'nbp', 'emiss_ff'], files=liddicoat_files)
+def load_liddicoat():
+    tables = iter(ts5_io.load_columns(liddicoat_files, skiprows=1))
 
-magicc_ssp534_mmm = np.mean(co2_ssp534_magicc.data,axis=0)
-magicc_ssp534_pc95 = np.percentile(co2_ssp534_magicc.data,95,axis=0)
-magicc_ssp534_pc5 = np.percentile(co2_ssp534_magicc.data,5,axis=0)
+    fgco2 = dict([(i, next(tables)) for i in liddicoat_ssp])
+    nbp = dict([(i, next(tables)) for i in liddicoat_ssp])
+    emiss_ff = dict([(i, next(tables)) for i in liddicoat_ssp])
 
-magicc_ssp370_mmm = np.mean(co2_ssp370_magicc.data,axis=0)
-magicc_ssp370_pc95 = np.percentile(co2_ssp370_magicc.data,95,axis=0)
-magicc_ssp370_pc5 = np.percentile(co2_ssp370_magicc.data,5,axis=0)
+    return dict([('fgco2', fgco2), ('nbp', nbp), ('emiss_ff', emiss_ff)])
 
 
-# multi-model, multi-scenario flux data from Liddicoat et al., 2020
-# with grateful acknowledgement to Spencer Liddicoat
-# https://journals.ametsoc.org/view/journals/clim/aop/JCLI-D-19-0991.1/JCLI-D-19-0991.1.xml
+# combine fgco2 (ocean flux) and nbp (land flux) into a total
 #
+@ts5_pipeline.stage(outputs=['y', 'flx', 'emiss', 'flx_nmod'])
+def flux_totals(fgco2, nbp, emiss_ff):
+    y = next(iter(nbp.values()))[0]
 
-# read in calculated fossil-fuel emissions
-# combine fgco2 (ocean flux) and nbp (land flux) into a total
+    # leading dimension is the year, so crop that off to just leave the flux data
+    flx = dict([(i, nbp[i][1:] + fgco2[i][1:]) for i in nbp])
 
-# leading dimension is the year, so crop that off to just leave the flux data
-
-fgco2_ssp119 = np.loadtxt('global_total_FGCO2_GtC_yr_HistoricalSsp119.txt',skiprows=1).T
-nbp_ssp119   = np.loadtxt('global_total_NBP_GtC_yr_HistoricalSsp119.txt',skiprows=1).T
-emiss_ssp119 = np.loadtxt('ffEmsHistoricalSsp119_GtCyr.txt',skiprows=1).T
-flx_ssp119 = nbp_ssp119[1:] + fgco2_ssp119[1:]
-emiss_ssp119 = emiss_ssp119[1:]
-
-fgco2_ssp126 = np.loadtxt('global_total_FGCO2_GtC_yr_HistoricalSsp126.txt',skiprows=1).T
-nbp_ssp126   = np.loadtxt('global_total_NBP_GtC_yr_HistoricalSsp126.txt',skiprows=1).T
-flx_ssp126 = nbp_ssp126[1:] + fgco2_ssp126[1:]
-emiss_ssp126 = np.loadtxt('ffEmsHistoricalSsp126_GtCyr.txt',skiprows=1).T
-emiss_ssp126 = emiss_ssp126[1:]
-
-fgco2_ssp245 = np.loadtxt('global_total_FGCO2_GtC_yr_HistoricalSsp245.txt',skiprows=1).T
-nbp_ssp245   = np.loadtxt('global_total_NBP_GtC_yr_HistoricalSsp245.txt',skiprows=1).T
-flx_ssp245 = nbp_ssp245[1:] + fgco2_ssp245[1:]
-emiss_ssp245 = np.loadtxt('ffEmsHistoricalSsp245_GtCyr.txt',skiprows=1).T
-emiss_ssp245 = emiss_ssp245[1:]
-
-fgco2_ssp534 = np.loadtxt('global_total_FGCO2_GtC_yr_HistoricalSsp534os.txt',skiprows=1).T
-nbp_ssp534   = np.loadtxt('global_total_NBP_GtC_yr_HistoricalSsp534os.txt',skiprows=1).T
-flx_ssp534 = nbp_ssp534[1:] + fgco2_ssp534[1:]
-emiss_ssp534 = np.loadtxt('ffEmsHistoricalSsp534os_GtCyr.txt',skiprows=1).T
-emiss_ssp534 = emiss_ssp534[1:]
-
-fgco2_ssp370 = np.loadtxt('global_total_FGCO2_GtC_yr_HistoricalSsp370.txt',skiprows=1).T
-nbp_ssp370   = np.loadtxt('global_total_NBP_GtC_yr_HistoricalSsp370.txt',skiprows=1).T
-flx_ssp370 = nbp_ssp370[1:] + fgco2_ssp370[1:]
-emiss_ssp370 = np.loadtxt('ffEmsHistoricalSsp370_GtCyr.txt',skiprows=1).T
-emiss_ssp370 = emiss_ssp370[1:]
-
-fgco2_ssp585 = np.loadtxt('global_total_FGCO2_GtC_yr_HistoricalSsp585.txt',skiprows=1).T
-nbp_ssp585   = np.loadtxt('global_total_NBP_GtC_yr_HistoricalSsp585.txt',skiprows=1).T
-flx_ssp585 = nbp_ssp585[1:] + fgco2_ssp585[1:]
-emiss_ssp585 = np.loadtxt('ffEmsHistoricalSsp585_GtCyr.txt',skiprows=1).T
-emiss_ssp585 = emiss_ssp585[1:]
-
-y = nbp_ssp585[0]
-
-# insert leading 0 as emissions data runs from 1851
-emiss_ssp119 = np.insert(emiss_ssp119, 0, 0, axis=1)
-emiss_ssp126 = np.insert(emiss_ssp126, 0, 0, axis=1)
-emiss_ssp245 = np.insert(emiss_ssp245, 0, 0, axis=1)
-emiss_ssp534 = np.insert(emiss_ssp534, 0, 0, axis=1)
-emiss_ssp370 = np.insert(emiss_ssp370, 0, 0, axis=1)
-emiss_ssp585 = np.insert(emiss_ssp585, 0, 0, axis=1)
-
-flx_mmm = dict([('ssp119', np.mean(flx_ssp119,axis=0)), ('ssp126', np.mean(flx_ssp126,axis=0)),
-             ('ssp245', np.mean(flx_ssp245,axis=0)), ('ssp534', np.mean(flx_ssp534,axis=0)), ('ssp370', np.mean(flx_ssp370,axis=0)),
-             ('ssp585', np.mean(flx_ssp585,axis=0))])
-
-flx_pc5 = dict([('ssp119', np.percentile(flx_ssp119,5,axis=0)), ('ssp126', np.percentile(flx_ssp126,5,axis=0)),
-             ('ssp245', np.percentile(flx_ssp245,5,axis=0)), ('ssp534', np.percentile(flx_ssp534,5,axis=0)), ('ssp370', np.percentile(flx_ssp370,5,axis=0)),
-             ('ssp585', np.percentile(flx_ssp585,5,axis=0))])
-flx_pc95 = dict([('ssp119', np.percentile(flx_ssp119,95,axis=0)), ('ssp126', np.percentile(flx_ssp126,95,axis=0)),
-             ('ssp245', np.percentile(flx_ssp245,95,axis=0)), ('ssp534', np.percentile(flx_ssp534,95,axis=0)), ('ssp370', np.percentile(flx_ssp370,95,axis=0)),
-             ('ssp585', np.percentile(flx_ssp585,95,axis=0))])
-
-
-# get data to 2300 from 4 ESMs (CanESM5, IPSL, UKESM, CESM2):
-
-year,c5_ssp126,c5_ssp534,c5_ssp585 = np.loadtxt('CanESM5_nbp.dat').T
-year,i6_ssp126,i6_ssp534,i6_ssp585 = np.loadtxt('IPSL-CM6A-LR_nbp.dat').T
-year,uk_ssp126,uk_ssp534,uk_ssp585 = np.loadtxt('UKESM1-0-LL_nbp.dat').T
-year,ce2_ssp126,ce2_ssp534,ce2_ssp585 = np.loadtxt('CESM2-WACCM_nbp.dat').T
-
-year,c5_ocn_ssp126,c5_ocn_ssp534,c5_ocn_ssp585 = np.loadtxt('CanESM5_fgco2.dat').T
-year,i6_ocn_ssp126,i6_ocn_ssp534,i6_ocn_ssp585 = np.loadtxt('IPSL-CM6A-LR_fgco2.dat').T
-year,uk_ocn_ssp126,uk_ocn_ssp534,uk_ocn_ssp585 = np.loadtxt('UKESM1-0-LL_fgco2.dat').T
-year,ce2_ocn_ssp126,ce2_ocn_ssp534,ce2_ocn_ssp585 = np.loadtxt('CESM2-WACCM_fgco2.dat').T
-
-
-flx_2300_ssp126 = [
-    [c5_ssp126 + c5_ocn_ssp126],
-    [i6_ssp126 + i6_ocn_ssp126],
-    [uk_ssp126 + uk_ocn_ssp126],
-    [ce2_ssp126 + ce2_ocn_ssp126]
-]
-
-flx_2300_ssp534 = [
-    [c5_ssp534 + c5_ocn_ssp534],
-    [i6_ssp534 + i6_ocn_ssp534],
-    [uk_ssp534 + uk_ocn_ssp534],
-    [ce2_ssp534 + ce2_ocn_ssp534]
-]
-
-flx_2300_ssp585 = [
-    [c5_ssp585 + c5_ocn_ssp585],
-    [i6_ssp585 + i6_ocn_ssp585],
-    [uk_ssp585 + uk_ocn_ssp585],
-    [ce2_ssp585 + ce2_ocn_ssp585]
-]
-
-
-data_2300 = dict([('ssp126', flx_2300_ssp126),
-             ('ssp534', flx_2300_ssp534),
-             ('ssp585', flx_2300_ssp585)])
+    # emissions data runs from 1851, so place it on the flux years with a leading 0
+    emiss = dict([(i, ts5_timeline.place(y, emiss_ff[i][0], emiss_ff[i][1:], fill=0)) for i in emiss_ff])
 
+    # number of models with data in each scenario, as printed in panels f and g
+    flx_nmod = dict([(i, int(np.sum(~np.all(np.isnan(flx[i]), axis=1)))) for i in flx])
 
-# calculate multi-model mean and 5-95%
-#
+    return dict([('y', y), ('flx', flx), ('emiss', emiss), ('flx_nmod', flx_nmod)])
 
-ssp126_2300_mmm = np.mean(flx_2300_ssp126,axis=0)[0]
-ssp126_2300_pc95 = np.percentile(flx_2300_ssp126,95,axis=0)[0]
-ssp126_2300_pc5  = np.percentile(flx_2300_ssp126,5,axis=0)[0]
 
-ssp534_2300_mmm = np.mean(flx_2300_ssp534,axis=0)[0]
-ssp534_2300_pc95 = np.percentile(flx_2300_ssp534,95,axis=0)[0]
-ssp534_2300_pc5  = np.percentile(flx_2300_ssp534,5,axis=0)[0]
+@ts5_pipeline.stage(outputs=['flx_mmm', 'flx_pc5', 'flx_pc95'])
+def flux_stats(flx):
+    flx_mmm, (flx_pc5, flx_pc95) = ts5_stats.ens_stats(flx, pcs)
 
-ssp585_2300_mmm = np.mean(flx_2300_ssp585,axis=0)[0]
-ssp585_2300_pc95 = np.percentile(flx_2300_ssp585,95,axis=0)[0]
-ssp585_2300_pc5  = np.percentile(flx_2300_ssp585,5,axis=0)[0]
+    return dict([('flx_mmm', flx_mmm), ('flx_pc5', flx_pc5), ('flx_pc95', flx_pc95)])
 
 
-# calculate cumulative fluxes from annuals
+# get data to 2300 from the ESMs that ran the extensions (CanESM5, IPSL, UKESM,
+# CESM2 in AR6): every model with a <model>_nbp.dat and <model>_fgco2.dat pair in
+# the data directory (or the store), see ts5_io.discover_2300
+
+esm_2300 = ts5_io.discover_2300()
+
+# scenarios of the columns after the year
+ssp_2300 = ['ssp126', 'ssp534', 'ssp585']
+
+@ts5_pipeline.stage(outputs=['year', 'data_2300', 'nmod_2300'],
+             files=['%s_%s.dat' % (m, v) for v in ['nbp', 'fgco2'] for m in esm_2300])
+def load_2300():
+    tables = ts5_io.load_columns(['%s_%s.dat' % (m, v) for v in ['nbp', 'fgco2'] for m in esm_2300])
+    lnd, ocn = tables[:len(esm_2300)], tables[len(esm_2300):]
+
+    # one (scenario, model, year) array over the years of all models, NaN where a
+    # model has no data
+    year = ts5_timeline.index(min(t[0, 0] for t in lnd), max(t[0, -1] for t in lnd))
+    flx_2300 = np.full((len(ssp_2300), len(esm_2300), len(year)), np.nan)
+    for m in range(len(esm_2300)):
+        ts5_timeline.place(year, lnd[m][0], lnd[m][1:] + ocn[m][1:], out=flx_2300[:, m])
+
+    data_2300 = dict(zip(ssp_2300, flx_2300))
+    nmod_2300 = dict([(i, int(np.sum(~np.all(np.isnan(data_2300[i]), axis=1)))) for i in ssp_2300])
+
+    return dict([('year', year), ('data_2300', data_2300), ('nmod_2300', nmod_2300)])
+
+
+# calculate multi-model mean and 5-95%
 #
+@ts5_pipeline.stage(outputs=['ssp_2300_mmm', 'ssp_2300_pc5', 'ssp_2300_pc95'])
+def flux_2300_stats(data_2300):
+    ssp_2300_mmm, (ssp_2300_pc5, ssp_2300_pc95) = ts5_stats.ens_stats(data_2300, pcs)
+
+    return dict([('ssp_2300_mmm', ssp_2300_mmm), ('ssp_2300_pc5', ssp_2300_pc5),
+                 ('ssp_2300_pc95', ssp_2300_pc95)])
 
-flx_cum_ssp119 = np.cumsum(flx_ssp119, axis=1)
-flx_cum_ssp126 = np.cumsum(flx_ssp126, axis=1)
-flx_cum_ssp245 = np.cumsum(flx_ssp245, axis=1)
-flx_cum_ssp534 = np.cumsum(flx_ssp534, axis=1)
-flx_cum_ssp370 = np.cumsum(flx_ssp370, axis=1)
-flx_cum_ssp585 = np.cumsum(flx_ssp585, axis=1)
 
-flx_cum_mmm = dict([('ssp119', np.mean(flx_cum_ssp119,axis=0)), ('ssp126', np.mean(flx_cum_ssp126,axis=0)),
-             ('ssp245', np.mean(flx_cum_ssp245,axis=0)), ('ssp534', np.mean(flx_cum_ssp534,axis=0)), ('ssp370', np.mean(flx_cum_ssp370,axis=0)),
-             ('ssp585', np.mean(flx_cum_ssp585,axis=0))])
+# calculate cumulative fluxes from annuals
+#
+@ts5_pipeline.stage(outputs=['flx_cum', 'flx_cum_mmm', 'flx_cum_pc5', 'flx_cum_pc95'])
+def cumulative_flux(flx_sum):
+    flx_cum = dict([(i, flx_sum[i][:, 1:]) for i in flx_sum])
 
-flx_cum_pc5 = dict([('ssp119', np.percentile(flx_cum_ssp119,5,axis=0)), ('ssp126', np.percentile(flx_cum_ssp126,5,axis=0)),
-             ('ssp245', np.percentile(flx_cum_ssp245,5,axis=0)), ('ssp534', np.percentile(flx_cum_ssp534,5,axis=0)), ('ssp370', np.percentile(flx_cum_ssp370,5,axis=0)),
-             ('ssp585', np.percentile(flx_cum_ssp585,5,axis=0))])
+    flx_cum_mmm, (flx_cum_pc5, flx_cum_pc95) = ts5_stats.ens_stats(flx_cum, pcs)
 
-flx_cum_pc95 = dict([('ssp119', np.percentile(flx_cum_ssp119,95,axis=0)), ('ssp126', np.percentile(flx_cum_ssp126,95,axis=0)),
-             ('ssp245', np.percentile(flx_cum_ssp245,95,axis=0)), ('ssp534', np.percentile(flx_cum_ssp534,95,axis=0)), ('ssp370', np.percentile(flx_cum_ssp370,95,axis=0)),
-             ('ssp585', np.percentile(flx_cum_ssp585,95,axis=0))])
+    return dict([('flx_cum', flx_cum), ('flx_cum_mmm', flx_cum_mmm),
+                 ('flx_cum_pc5', flx_cum_pc5), ('flx_cum_pc95', flx_cum_pc95)])
 
 
 # to calculate sink fractions need to account for land use
@@ -313,69 +302,103 @@ ssp534_LU = [0.959301818, 1.077263489, 1.240992571, 0.936726687, 0.75137482, 1.3
 
 y_LU = [2015,2020,2030,2040,2050,2060,2070,2080,2090,2100]
 
+ssp_LU = dict([('ssp370', ssp370_LU), ('ssp119', ssp119_LU), ('ssp126', ssp126_LU),
+             ('ssp245', ssp245_LU), ('ssp585', ssp585_LU), ('ssp534', ssp534_LU)])
+
 
 # historical land-use data created by Julia Pongratz, and available here:
 # http://c4mip.net/cmip6-experiments
 # c4mip.net/fileadmin/user_upload/c4mip/CMIP6_C4MIP_landuse_emissions.nc.gz
 
-LU_hist = iris.load('/data/users/hadcn/CMIP6_C4MIP_landuse_emissions.nc')[0]
-
-# account for different units and interpolate to annual timesteps
-#
-y_lu = np.concatenate([np.arange(1850,2015), np.arange(2015,2101,1)])
-ssp370_lu = np.concatenate([LU_hist.data*1e-12, np.interp(np.arange(2015,2101,1), y_LU, ssp370_LU)])
-ssp119_lu = np.concatenate([LU_hist.data*1e-12, np.interp(np.arange(2015,2101,1), y_LU, ssp119_LU)])
-ssp126_lu = np.concatenate([LU_hist.data*1e-12, np.interp(np.arange(2015,2101,1), y_LU, ssp126_LU)])
-ssp245_lu = np.concatenate([LU_hist.data*1e-12, np.interp(np.arange(2015,2101,1), y_LU, ssp245_LU)])
-ssp585_lu = np.concatenate([LU_hist.data*1e-12, np.interp(np.arange(2015,2101,1), y_LU, ssp585_LU)])
-ssp534_lu = np.concatenate([LU_hist.data*1e-12, np.interp(np.arange(2015,2101,1), y_LU, ssp534_LU)])
-
-
-# calculate sink-fraction with LU included
-#
-
-flxnep_ssp370 = ssp370_lu + flx_ssp370
-flxnep_cum_ssp370 = np.cumsum(flxnep_ssp370, axis=1)
-emisstot_cum_ssp370 = np.cumsum(emiss_ssp370 + ssp370_lu, axis=1)
-sink_fractot_ssp370 = flxnep_cum_ssp370 / emisstot_cum_ssp370
-
-flxnep_ssp119 = ssp119_lu + flx_ssp119
-flxnep_cum_ssp119 = np.cumsum(flxnep_ssp119, axis=1)
-emisstot_cum_ssp119 = np.cumsum(emiss_ssp119 + ssp119_lu, axis=1)
-sink_fractot_ssp119 = flxnep_cum_ssp119 / emisstot_cum_ssp119
+lu_hist_file = os.environ.get('TS5_LU_FILE', '/data/users/hadcn/CMIP6_C4MIP_landuse_emissions.nc')
 
-flxnep_ssp126 = ssp126_lu + flx_ssp126
-flxnep_cum_ssp126 = np.cumsum(flxnep_ssp126, axis=1)
-emisstot_cum_ssp126 = np.cumsum(emiss_ssp126 + ssp126_lu, axis=1)
-sink_fractot_ssp126 = flxnep_cum_ssp126 / emisstot_cum_ssp126
+@ts5_pipeline.stage(outputs=['y_lu', 'lu'], files=[lu_hist_file])
+def land_use():
+    LU_hist = ts5_store.load_cubes(lu_hist_file)[0]
 
-flxnep_ssp245 = ssp245_lu + flx_ssp245
-flxnep_cum_ssp245 = np.cumsum(flxnep_ssp245, axis=1)
-emisstot_cum_ssp245 = np.cumsum(emiss_ssp245 + ssp245_lu, axis=1)
-sink_fractot_ssp245 = flxnep_cum_ssp245 / emisstot_cum_ssp245
+    # account for different units and interpolate to annual timesteps,
+    # all scenarios in one (scenario, year) array
+    #
+    y_lu = ts5_timeline.index(1850, 2100)
+    lu_all = np.empty((len(ssp_LU), len(y_lu)))
+    ts5_timeline.place(y_lu, ts5_timeline.cube_years(LU_hist), LU_hist.data*1e-12, out=lu_all)
+    ts5_timeline.place(y_lu, np.arange(2015,2101,1),
+                       ts5_timeline.interp_batch(np.arange(2015,2101,1), y_LU, list(ssp_LU.values())), out=lu_all)
+    lu = dict(zip(ssp_LU, lu_all))
 
-flxnep_ssp585 = ssp585_lu + flx_ssp585
-flxnep_cum_ssp585 = np.cumsum(flxnep_ssp585, axis=1)
-emisstot_cum_ssp585 = np.cumsum(emiss_ssp585 + ssp585_lu, axis=1)
-sink_fractot_ssp585 = flxnep_cum_ssp585 / emisstot_cum_ssp585
+    return dict([('y_lu', y_lu), ('lu', lu)])
 
-flxnep_ssp534 = ssp534_lu + flx_ssp534
-flxnep_cum_ssp534 = np.cumsum(flxnep_ssp534, axis=1)
-emisstot_cum_ssp534 = np.cumsum(emiss_ssp534 + ssp534_lu, axis=1)
-sink_fractot_ssp534 = flxnep_cum_ssp534 / emisstot_cum_ssp534
 
+# prefix sums of the fluxes, emissions and land-use emissions along the years of y
+# (see ts5_timeline.prefix_sums). the cumulative quantities from the first year
+# and over any other window of years are differences of two of their entries
+#
+@ts5_pipeline.stage(outputs=['flx_sum', 'emiss_sum', 'lu_sum'])
+def prefix_index(flx, emiss, lu):
+    return dict([('flx_sum', dict([(i, ts5_timeline.prefix_sums(flx[i])) for i in flx])),
+                 ('emiss_sum', dict([(i, ts5_timeline.prefix_sums(emiss[i])) for i in emiss])),
+                 ('lu_sum', dict([(i, ts5_timeline.prefix_sums(lu[i])) for i in lu]))])
 
-sink_fractot_mmm = dict([('ssp119', np.mean(sink_fractot_ssp119,axis=0)), ('ssp126', np.mean(sink_fractot_ssp126,axis=0)),
-             ('ssp245', np.mean(sink_fractot_ssp245,axis=0)), ('ssp370', np.mean(sink_fractot_ssp370,axis=0)),
-             ('ssp534', np.mean(sink_fractot_ssp534,axis=0)), ('ssp585', np.mean(sink_fractot_ssp585,axis=0))])
 
-sink_fractot_pc5 = dict([('ssp119', np.percentile(sink_fractot_ssp119,5,axis=0)), ('ssp126', np.percentile(sink_fractot_ssp126,5,axis=0)),
-             ('ssp245', np.percentile(sink_fractot_ssp245,5,axis=0)), ('ssp370', np.percentile(sink_fractot_ssp370,5,axis=0)),
-             ('ssp534', np.percentile(sink_fractot_ssp534,5,axis=0)), ('ssp585', np.percentile(sink_fractot_ssp585,5,axis=0))])
+# calculate sink-fraction with LU included, for every scenario with fluxes and
+# land-use emissions
+#
+@ts5_pipeline.stage(outputs=['sink_fractot', 'sink_fractot_mmm', 'sink_fractot_pc5', 'sink_fractot_pc95'])
+def sink_fraction(flx_sum, emiss_sum, lu_sum):
+    sink_fractot = dict()
+    for i in sorted(i for i in flx_sum if i in lu_sum):
+        # cumulative net uptake over cumulative emissions, land use on both sides
+        flxnep_cum = flx_sum[i][:, 1:] + lu_sum[i][1:]
+        emisstot_cum = emiss_sum[i][..., 1:] + lu_sum[i][1:]
+        sink_fractot[i] = flxnep_cum / emisstot_cum
+
+    sink_fractot_mmm, (sink_fractot_pc5, sink_fractot_pc95) = ts5_stats.ens_stats(sink_fractot, pcs)
+
+    return dict([('sink_fractot', sink_fractot), ('sink_fractot_mmm', sink_fractot_mmm),
+                 ('sink_fractot_pc5', sink_fractot_pc5), ('sink_fractot_pc95', sink_fractot_pc95)])
+
+
+# cumulative uptake and sink fractions over windows of years (first and last year
+# included), per model and scenario, e.g. flx_win['ssp126'][:, 0] is the uptake
+# of every model over 2015-2050. the windows are answered from the prefix sums
+# with two lookups per model each
+sum_windows = [(2015, 2050), (2050, 2100)]
+
+@ts5_pipeline.stage(outputs=['flx_win', 'flx_win_mmm', 'flx_win_pc5', 'flx_win_pc95',
+             'sink_fractot_win', 'sink_fractot_win_mmm', 'sink_fractot_win_pc5', 'sink_fractot_win_pc95'])
+def window_totals(y, flx_sum, emiss_sum, lu_sum):
+    start, end = np.array(sum_windows).T
+
+    flx_win = dict()
+    sink_fractot_win = dict()
+    for i in sorted(i for i in flx_sum if i in lu_sum):
+        lu_win = ts5_timeline.window_sums(lu_sum[i], y, start, end)
+        flx_win[i] = ts5_timeline.window_sums(flx_sum[i], y, start, end)
+        sink_fractot_win[i] = (flx_win[i] + lu_win) / (ts5_timeline.window_sums(emiss_sum[i], y, start, end) + lu_win)
+
+    flx_win_mmm, (flx_win_pc5, flx_win_pc95) = ts5_stats.ens_stats(flx_win, pcs)
+    sink_fractot_win_mmm, (sink_fractot_win_pc5, sink_fractot_win_pc95) = ts5_stats.ens_stats(sink_fractot_win, pcs)
+
+    return dict([('flx_win', flx_win), ('flx_win_mmm', flx_win_mmm),
+                 ('flx_win_pc5', flx_win_pc5), ('flx_win_pc95', flx_win_pc95),
+                 ('sink_fractot_win', sink_fractot_win), ('sink_fractot_win_mmm', sink_fractot_win_mmm),
+                 ('sink_fractot_win_pc5', sink_fractot_win_pc5), ('sink_fractot_win_pc95', sink_fractot_win_pc95)])
+
+
+# bootstrap confidence intervals of the fluxes, cumulative fluxes and sink fractions.
+# only run when they are drawn (show_ci) or exported
+#
+@ts5_pipeline.stage(outputs=['flx_mmm_ci', 'flx_pc5_ci', 'flx_pc95_ci',
+             'flx_cum_mmm_ci', 'flx_cum_pc5_ci', 'flx_cum_pc95_ci',
+             'sink_fractot_mmm_ci', 'sink_fractot_pc5_ci', 'sink_fractot_pc95_ci'], on_demand=True)
+def bootstrap_ci(flx, flx_cum, sink_fractot):
+    out = dict()
+    for name, d in [('flx', flx), ('flx_cum', flx_cum), ('sink_fractot', sink_fractot)]:
+        mmm_ci, (pc5_ci, pc95_ci) = ts5_stats.ens_bootstrap(d, pcs, ci, n_boot=n_boot, seed=boot_seed,
+                                                            workers=os.cpu_count())
+        out.update([(name + '_mmm_ci', mmm_ci), (name + '_pc5_ci', pc5_ci), (name + '_pc95_ci', pc95_ci)])
 
-sink_fractot_pc95 = dict([('ssp119', np.percentile(sink_fractot_ssp119,95,axis=0)), ('ssp126', np.percentile(sink_fractot_ssp126,95,axis=0)),
-             ('ssp245', np.percentile(sink_fractot_ssp245,95,axis=0)), ('ssp370', np.percentile(sink_fractot_ssp370,95,axis=0)),
-             ('ssp534', np.percentile(sink_fractot_ssp534,95,axis=0)), ('ssp585', np.percentile(sink_fractot_ssp585,95,axis=0))])
+    return out
 
 
 # beta / gamma maps
@@ -387,27 +410,170 @@ https://github.com/ckoven/cmip6_beta_gamma_maps/blob/master/cmip6_beta_gamma_map
 doi 10.5281/zenodo.6039693 
 '''
 
-cubes = iris.load('carbon_feedback_parameters.nc')
+# only these variables are read, in one pass, and their lat/lon coordinates get
+# the names Iris plotting expects as they are loaded. the data stay lazy until
+# they are drawn
+feedback_vars = ['beta_ensmean', 'gamma_ensmean',
+             'beta_fraction_sign_agreement', 'gamma_fraction_sign_agreement',
+             'beta_land_zonalmean_ensmean', 'beta_ocean_zonalmean_ensmean',
+             'gamma_land_zonalmean_ensmean', 'gamma_ocean_zonalmean_ensmean',
+             'beta_land_zonalmean_ensstd', 'beta_ocean_zonalmean_ensstd',
+             'gamma_land_zonalmean_ensstd', 'gamma_ocean_zonalmean_ensstd']
+
+@ts5_pipeline.stage(outputs=['beta', 'gamma', 'beta_agr', 'gamma_agr',
+             'zon_beta_land_av', 'zon_beta_ocn_av', 'zon_gamma_land_av', 'zon_gamma_ocn_av',
+             'zon_beta_land_std', 'zon_beta_ocn_std', 'zon_gamma_land_std', 'zon_gamma_ocn_std'],
+             files=['carbon_feedback_parameters.nc'])
+def load_feedback():
+    (beta, gamma, beta_agr, gamma_agr,
+     zon_beta_land_av, zon_beta_ocn_av, zon_gamma_land_av, zon_gamma_ocn_av,
+     zon_beta_land_std, zon_beta_ocn_std, zon_gamma_land_std, zon_gamma_ocn_std) = ts5_store.load_cubes(
+        'carbon_feedback_parameters.nc', feedback_vars, rename=dict([('lat', 'latitude'), ('lon', 'longitude')]))
+
+    return dict([('beta', beta), ('gamma', gamma), ('beta_agr', beta_agr), ('gamma_agr', gamma_agr),
+                 ('zon_beta_land_av', zon_beta_land_av), ('zon_beta_ocn_av', zon_beta_ocn_av),
+                 ('zon_gamma_land_av', zon_gamma_land_av), ('zon_gamma_ocn_av', zon_gamma_ocn_av),
+                 ('zon_beta_land_std', zon_beta_land_std), ('zon_beta_ocn_std', zon_beta_ocn_std),
+                 ('zon_gamma_land_std', zon_gamma_land_std), ('zon_gamma_ocn_std', zon_gamma_ocn_std)])
+
+
+# zonal profiles of panels a and b, land and ocean, as zon_av and zon_std dicts
+# keyed beta_land, beta_ocean, gamma_land and gamma_ocean on the latitudes lat.
+# the means are computed from the beta and gamma maps on every render when the
+# land fraction land_frac_file (CMIP sftlf, TS5_LAND_FRAC) is in the data
+# directory or the store, e.g. for another mask or new model fields: they are
+# the integrals along the land or ocean part of each latitude circle, as in the
+# feedback file (see ts5_grid.zonal_stats), and are compared with the file's,
+# which they match to within ts5_grid.profile_rtol for the mask the file was
+# made with. otherwise they are the file's ensemble means. TS5_ZONAL=file or
+# maps forces either. the shading is always the ensemble spread of the file, as
+# the maps hold no ensemble members, interpolated to the latitudes of the maps
+# where the file's profiles are on others
+land_frac_file = os.environ.get('TS5_LAND_FRAC', 'sftlf.nc')
+zonal_source = os.environ.get('TS5_ZONAL', 'auto')
+zonal_from_maps = zonal_source == 'maps' or (zonal_source == 'auto' and (
+    os.path.exists(land_frac_file) or ts5_store.entry(land_frac_file) is not None))
+
+@ts5_pipeline.stage(outputs=['lat', 'zon_av', 'zon_std'], files=[land_frac_file] if zonal_from_maps else [])
+def zonal_profiles(beta, gamma, zon_beta_land_av, zon_beta_ocn_av, zon_gamma_land_av, zon_gamma_ocn_av,
+                   zon_beta_land_std, zon_beta_ocn_std, zon_gamma_land_std, zon_gamma_ocn_std):
+    keys = ['beta_land', 'beta_ocean', 'gamma_land', 'gamma_ocean']
+
+    lat = zon_beta_land_av.coord('latitude').points
+    zon_av = dict(zip(keys, [c.data for c in [zon_beta_land_av, zon_beta_ocn_av,
+                                              zon_gamma_land_av, zon_gamma_ocn_av]]))
+    zon_std = dict(zip(keys, [c.data for c in [zon_beta_land_std, zon_beta_ocn_std,
+                                               zon_gamma_land_std, zon_gamma_ocn_std]]))
+    if not zonal_from_maps:
+        return dict([('lat', lat), ('zon_av', zon_av), ('zon_std', zon_std)])
+
+    # both maps and both regions in one call, as (field, region, lat) arrays
+    land_frac = ts5_store.load_cubes(land_frac_file, rename=dict([('lat', 'latitude'), ('lon', 'longitude')]))[0]
+    total = ts5_grid.zonal_stats([ts5_grid.latlon_data(c) for c in [beta, gamma]],
+                                 ts5_grid.region_weights(beta, land_frac))[0]
+
+    maps = dict(zip(keys, (total * ts5_grid.profile_scale).reshape(4, -1)))
+
+    # the profiles of the file may be on other latitudes than the maps: the
+    # spread is drawn, and the means compared, on those of the maps
+    map_lat = beta.coord('latitude').points
+    zon_av = dict([(k, ts5_grid.profile_on(v, lat, map_lat)) for k, v in zon_av.items()])
+    zon_std = dict([(k, ts5_grid.profile_on(v, lat, map_lat)) for k, v in zon_std.items()])
+    for k in keys:
+        err = ts5_grid.profile_error(maps[k], zon_av[k])
+        if not err <= ts5_grid.profile_rtol:
+            print('zonal %s from the maps differs from carbon_feedback_parameters.nc by %.2g of its largest '
+                  'value (within %g for the same land fraction)' % (k, err, ts5_grid.profile_rtol))
+
+    return dict([('lat', map_lat), ('zon_av', maps), ('zon_std', zon_std)])
+
+
+# columnar export: with TS5_EXPORT=<file.parquet or file.npz> every series of
+# panels e-g (and the cumulative fluxes) is written in tidy form, one row per
+# panel, scenario, statistic and year, with the number of models behind it (see
+# ts5_export.py). TS5_EXPORT_APPEND=1 adds the rows to an existing export, as
+# those of the run TS5_EXPORT_RUN (by default a key of the inputs and settings
+# behind the series), so runs with other data or settings can share one file
+export_file = os.environ.get('TS5_EXPORT')
+export_run = os.environ.get('TS5_EXPORT_RUN')
+
+# (panel, statistic, variable, years variable, ensemble variable) of every exported series
+pc_lo, pc_hi = ['pc%g' % p for p in pcs]
+export_series = [('e', 'concentration', 'data', 'yr_data', None),
+             ('e', 'esm_ssp585_pc5', 'co2_e_pc5', 'y_e', None),
+             ('e', 'esm_ssp585_pc95', 'co2_e_pc95', 'y_e', None),
+             ('e', 'magicc_mean', 'magicc_mmm', 'magicc_yr', None),
+             ('e', 'magicc_' + pc_lo, 'magicc_pc5', 'magicc_yr', None),
+             ('e', 'magicc_' + pc_hi, 'magicc_pc95', 'magicc_yr', None)] + \
+            [(panel, stat, var + suffix, years, var)
+             for panel, var, years in [('f', 'flx', 'y'), ('f_cumulative', 'flx_cum', 'y'),
+                                       ('g', 'sink_fractot', 'y')]
+             for stat, suffix in [('mmm', '_mmm'), (pc_lo, '_pc5'), (pc_hi, '_pc95'),
+                                  ('mmm_ci', '_mmm_ci'), (pc_lo + '_ci', '_pc5_ci'), (pc_hi + '_ci', '_pc95_ci')]] + \
+            [('f_2300', stat, 'ssp_2300' + suffix, 'year', 'data_2300')
+             for stat, suffix in [('mmm', '_mmm'), (pc_lo, '_pc5'), (pc_hi, '_pc95')]]
+
+if export_file:
+    export_vars = list(dict.fromkeys(v for s in export_series for v in s[2:] if v is not None))
+    export_values = ts5_pipeline.run(globals(), export_vars)
+    export_run = export_run or ts5_pipeline.run_key(globals(), export_vars)
+    n = ts5_export.write(export_file, export_series, export_values, export_run,
+                         append=os.environ.get('TS5_EXPORT_APPEND', '0') != '0')
+    print('exported %d rows of run %s to %s' % (n, export_run, export_file))
+
+
+# numbers only: with TS5_DATA_ONLY=<file.npz> the stages behind the CO2
+# concentrations and ranges, the fluxes, cumulative fluxes and sink fractions are
+# run, their outputs are written to that file (dicts flattened to name/scenario)
+# and the script stops there. matplotlib and iris.plot are never imported. stages
+# reading NetCDF that are not cached import Iris, which brings in cartopy, so
+# only runs with those stages cached skip the whole plotting stack
+data_only = os.environ.get('TS5_DATA_ONLY')
+
+data_only_vars = ['data', 'yr_data', 'y_e', 'co2_e_pc5', 'co2_e_pc95',
+             'magicc_yr', 'magicc_mmm', 'magicc_pc5', 'magicc_pc95',
+             'y', 'flx', 'flx_mmm', 'flx_pc5', 'flx_pc95',
+             'year', 'ssp_2300_mmm', 'ssp_2300_pc5', 'ssp_2300_pc95',
+             'flx_cum', 'flx_cum_mmm', 'flx_cum_pc5', 'flx_cum_pc95',
+             'sink_fractot', 'sink_fractot_mmm', 'sink_fractot_pc5', 'sink_fractot_pc95',
+             'flx_win', 'flx_win_mmm', 'flx_win_pc5', 'flx_win_pc95',
+             'sink_fractot_win', 'sink_fractot_win_mmm', 'sink_fractot_win_pc5', 'sink_fractot_win_pc95']
+
+if data_only:
+    out = ts5_pipeline.run(globals(), data_only_vars)
+
+    arrays = dict()
+    for v in data_only_vars:
+        if isinstance(out[v], dict):
+            arrays.update([('%s/%s' % (v, k), out[v][k]) for k in out[v]])
+        else:
+            arrays[v] = out[v]
+    np.savez(data_only, **arrays)
+
+    ts5_profile.report(data_only)
+    sys.exit(0)
+
+
+# plot the figure
+#
 
-beta  = cubes.extract('beta_ensmean')[0]
-gamma = cubes.extract('gamma_ensmean')[0]
+# the plotting stack is only imported from here on
 
-beta_agr  = cubes.extract('beta_fraction_sign_agreement')[0]
-gamma_agr = cubes.extract('gamma_fraction_sign_agreement')[0]
+# requires the Iris package. See:
+# https://scitools.org.uk/
+# https://scitools-iris.readthedocs.io/en/stable/
+#
+import iris
+import iris.plot as iplt
+import matplotlib.pyplot as plt
+from matplotlib import gridspec
+import cartopy.crs as ccrs
 
-zon_beta_land_av  = cubes.extract('beta_land_zonalmean_ensmean')[0]
-zon_beta_ocn_av  = cubes.extract('beta_ocean_zonalmean_ensmean')[0]
-zon_gamma_land_av  = cubes.extract('gamma_land_zonalmean_ensmean')[0]
-zon_gamma_ocn_av  = cubes.extract('gamma_ocean_zonalmean_ensmean')[0]
+# serial or parallel per-panel rendering, see ts5_render.py
+import ts5_render
 
-zon_beta_land_std  = cubes.extract('beta_land_zonalmean_ensstd')[0]
-zon_beta_ocn_std  = cubes.extract('beta_ocean_zonalmean_ensstd')[0]
-zon_gamma_land_std  = cubes.extract('gamma_land_zonalmean_ensstd')[0]
-zon_gamma_ocn_std  = cubes.extract('gamma_ocean_zonalmean_ensstd')[0]
+print("The Iris version is ", iris.__version__)
 
-for c in [beta, gamma, beta_agr, gamma_agr]:
-    c.coord('lat').rename('latitude')
-    c.coord('lon').rename('longitude')
 
 beta_levs = np.linspace(-.02,.02,16)
 beta_cmap = plt.cm.get_cmap('PiYG')
@@ -415,158 +581,200 @@ beta_cmap = plt.cm.get_cmap('PiYG')
 gamma_levs = np.linspace(-1.2,1.2,16)
 gamma_cmap = plt.cm.get_cmap('PiYG')
 
-lat = zon_beta_land_av.coord('lat').points
-
-# plot the figure
-#
-
-fig = plt.figure(figsize=(20,30))
 
 spec_1 = gridspec.GridSpec(ncols=4, nrows=4, width_ratios = [1,4,4,1], wspace=0.01)
 spec_2 = gridspec.GridSpec(ncols=2, nrows=4, width_ratios = [2,1], wspace=0)
 
 spec_1b = gridspec.GridSpec(ncols=4, nrows=4, width_ratios = [1,2,2,1])
 
-# set all lines to True, but can be configured to select subset
-plot_data = dict([('hist', True), ('ssp119', True), ('ssp126', True),
-             ('ssp245', True), ('ssp534', True), ('ssp370', True),
-             ('ssp585', True)])
-
-# top row
-# grid spec positions:
+# order of the model counts printed in panels f and g
+nmod_order = ['ssp119', 'ssp126', 'ssp245', 'ssp370', 'ssp534', 'ssp585']
 
-ax1 = fig.add_axes([0.11, .745, .08, .11])
-ax4 = fig.add_axes([0.81, .745, .08, .11])
+# year ranges of the time-series panels
+xr = [1990,2100]
+xr2300 = [2100,2300]
 
-# second row
-ax5 = fig.add_subplot(spec_2[1,0])
+# ticks of the time-series panels: the flux axis of panel f (also its grid lines),
+# the years of the extension to 2300 and the size of the tick labels
+flx_ticks = np.arange(-4,16,2)
+ticks_2300 = [2150,2200,2250,2300]
+tick_size = 18
+
+# draw each panel group in its own worker process and composite the results
+# (see ts5_render.py). the default draws everything into one figure
+render_parallel = False
+
+# keep each panel group as a rendered layer, so later renders only redraw the
+# groups whose inputs changed (see render_figure). on with TS5_LAYERS=1 and for
+# variants and watch mode; a single render draws one figure
+render_layers = os.environ.get('TS5_LAYERS', '0') != '0'
+
+# draft previews for layout work: with TS5_DRAFT=1 the maps are contoured from
+# fields coarsened draft_coarsen times (area-weighted block means) without
+# coastlines, and the figure is rendered at draft_dpi to <name>_draft.png. the
+# figure size and every axes position are those of the final figure
+draft = os.environ.get('TS5_DRAFT', '0') != '0'
+draft_coarsen = 4
+draft_dpi = 30
+
+# output formats: TS5_FORMATS=png,pdf,svg writes TS.5.png, TS.5.pdf and TS.5.svg
+# from one draw (the format of the file name by default). in vector outputs the
+# map fills and hatching are embedded as images at raster_dpi, while text,
+# coastlines and the time series stay vectors
+formats = [f for f in os.environ.get('TS5_FORMATS', '').split(',') if f]
+raster_dpi = 200
 
-# third row
-ax6 = fig.add_subplot(spec_2[2,0])
-ax7 = fig.add_subplot(spec_2[2,1])
 
-#fourth row
-ax8 = fig.add_subplot(spec_2[3,0])
-ax8b = fig.add_subplot(spec_2[3,1])
+'''
+creates the empty 20x30 inch figure that every panel group is drawn into
+'''
+fig_size = (20,30)
 
+def new_figure():
+    return plt.figure(figsize=fig_size, dpi=draft_dpi if draft else None)
 
-# hide various axes, set ticks etc
-axes=[ax1,ax4,ax5,ax6,ax7,ax8,ax8b]
 
-for ax in axes:
-    ax.tick_params(labelsize=15)
-    for z in ['top', 'right']:
-        ax.spines[z].set_visible(False)
+'''
+marks the fills (and hatching) of a contour set for rasterization in vector outputs
+'''
+def rasterize(cs):
+    # contour sets are single collections from matplotlib 3.8
+    for c in ([cs] if hasattr(cs, 'set_rasterized') else cs.collections):
+        c.set_rasterized(True)
 
-for ax in [ax4,ax7,ax8b]:
-    ax.tick_params(labelsize=15)
-    for z in ['left']:
-        ax.spines[z].set_visible(False)
 
-ax4.spines['right'].set_visible(True)
-ax8b.spines['bottom'].set_visible(False)
-        
-ax8b.axes.get_yaxis().set_visible(False)
-ax8b.axes.get_xaxis().set_visible(False)
+'''
+hides the top and right spines (and the left one for panels on the right) and sets tick labels
+'''
+def style_axes(axes, right=[]):
+    for ax in axes:
+        ax.tick_params(labelsize=15)
+        for z in ['top', 'right']:
+            ax.spines[z].set_visible(False)
 
-ax7.axes.get_yaxis().set_visible(False)
+    for ax in right:
+        ax.tick_params(labelsize=15)
+        for z in ['left']:
+            ax.spines[z].set_visible(False)
 
-# manual intervention on ticks:
-ax1.set_xticks([0,.1,.2])
-ax1.set_yticks(np.arange(-90,120,30))
 
-ax4.set_xticks([-20,-10,0,10])
-ax4.set_yticks(np.arange(-90,120,30))
+######
+#
+# panels a-d, zonal profiles
+#
 
-ax6.set_yticks(np.arange(-4,16,2))
+def draw_zonal(fig):
+    # top row
+    # grid spec positions:
+    ax1 = fig.add_axes([0.11, .745, .08, .11])
+    ax4 = fig.add_axes([0.81, .745, .08, .11])
+
+    style_axes([ax1,ax4], right=[ax4])
+    ax4.spines['right'].set_visible(True)
+
+    # manual intervention on ticks:
+    ax1.set_xticks([0,.1,.2])
+    ax1.set_yticks(np.arange(-90,120,30))
+
+    ax4.set_xticks([-20,-10,0,10])
+    ax4.set_yticks(np.arange(-90,120,30))
+
+    ax1.plot(zon_av['beta_land'], lat, 'g')
+    ax1.plot(zon_av['beta_ocean'], lat, 'b')
+    ax1.fill_betweenx(lat,zon_av['beta_land']-zon_std['beta_land'], zon_av['beta_land']+zon_std['beta_land'],
+                      facecolor='g',alpha=0.2)
+    ax1.fill_betweenx(lat,zon_av['beta_ocean']-zon_std['beta_ocean'], zon_av['beta_ocean']+zon_std['beta_ocean'],
+                      facecolor='b',alpha=0.2)
+    ax1.set_xlim(-.02,.3)
+    ax1.set_ylim(-95,95)
+    ax1.set_title('                  (a, b) Carbon uptake response to CO$_2$', fontsize=20)
+    ax1.set_xlabel('10$^6$ kg C m$^{-1}$ ppm$^{-1}$', fontsize=16)
+    ax1.set_ylabel('latitude', fontsize=16)
+    ax1.text(.15,-30,'Land', color='g', fontsize=14)
+    ax1.text(.15,-50,'Ocean', color='b', fontsize=14)
+
+    ax4.plot(zon_av['gamma_land'], lat, 'g')
+    ax4.plot(zon_av['gamma_ocean'], lat, 'b')
+    ax4.fill_betweenx(lat,zon_av['gamma_land']-zon_std['gamma_land'], zon_av['gamma_land']+zon_std['gamma_land'],
+                      facecolor='g',alpha=0.2)
+    ax4.fill_betweenx(lat,zon_av['gamma_ocean']-zon_std['gamma_ocean'], zon_av['gamma_ocean']+zon_std['gamma_ocean'],
+                      facecolor='b',alpha=0.2)
+    ax4.yaxis.tick_right()
+    ax4.set_ylim(-95,95)
+    ax4.set_xlabel('10$^6$ kg C m$^{-1}$ $^o$C$^{-1}$', fontsize=16)
+
+    for i in np.arange(-75,100,25):
+        ax1.hlines(i, -0.01,0.3, 'gray', alpha=0.2)
+        ax4.hlines(i, -20,10, 'gray', alpha=0.2)
 
-ax7.set_xticks([2150,2200,2250,2300])
 
 ######
 #
-# panels a-d
+# panels a-d, beta and gamma maps
 #
 
-ax1.plot(zon_beta_land_av.data, lat, 'g')
-ax1.plot(zon_beta_ocn_av.data, lat, 'b')
-ax1.fill_betweenx(lat,zon_beta_land_av.data-zon_beta_land_std.data, zon_beta_land_av.data+zon_beta_land_std.data,
-                  facecolor='g',alpha=0.2)
-ax1.fill_betweenx(lat,zon_beta_ocn_av.data-zon_beta_ocn_std.data, zon_beta_ocn_av.data+zon_beta_ocn_std.data,
-                  facecolor='b',alpha=0.2)
-ax1.set_xlim(-.02,.3)
-ax1.set_ylim(-95,95)
-ax1.set_title('                  (a, b) Carbon uptake response to CO$_2$', fontsize=20)
-ax1.set_xlabel('10$^6$ kg C m$^{-1}$ ppm$^{-1}$', fontsize=16)
-ax1.set_ylabel('latitude', fontsize=16)
-ax1.text(.15,-30,'Land', color='g', fontsize=14)
-ax1.text(.15,-50,'Ocean', color='b', fontsize=14)
-
-ax4.plot(zon_gamma_land_av.data, lat, 'g')
-ax4.plot(zon_gamma_ocn_av.data, lat, 'b')
-ax4.fill_betweenx(lat,zon_gamma_land_av.data-zon_gamma_land_std.data, zon_gamma_land_av.data+zon_gamma_land_std.data,
-                  facecolor='g',alpha=0.2)
-ax4.fill_betweenx(lat,zon_gamma_ocn_av.data-zon_gamma_ocn_std.data, zon_gamma_ocn_av.data+zon_gamma_ocn_std.data,
-                  facecolor='b',alpha=0.2)
-ax4.yaxis.tick_right()
-ax4.set_ylim(-95,95)
-ax4.set_xlabel('10$^6$ kg C m$^{-1}$ $^o$C$^{-1}$', fontsize=16)
-
-for i in np.arange(-75,100,25):
-    ax1.hlines(i, -0.01,0.3, 'gray', alpha=0.2)
-    ax4.hlines(i, -20,10, 'gray', alpha=0.2)
-
-    
-ax2 = fig.add_subplot(spec_1[0,1], projection = ccrs.Robinson(central_longitude= 0))
-coldata = iplt.contourf(beta, beta_levs, cmap = beta_cmap, extend='both')
-ax_map = plt.gca()
-contour_stipple_lo = iplt.contourf(beta_agr,colors='None',levels=[0,.8],hatches=['////'])
-
-ax_map.coastlines()
-ax_map.set_xlim(ax_map.projection.x_limits)
-ax_map.set_ylim(ax_map.projection.y_limits)
-
-bar_pos = [0.23, 0.725, 0.26, 0.01]  # [left,bottom,width,height]
-bar_orientation = "horizontal"     # or "vertical"  or "none" (to skip)
-bar_ticklen  = 0
-bar_ticklabs = [-.02,-.01,0,.01,.02]
-bar_label    = u"kg C m$^{-2}$ ppm$^{-1}$"
-
-bar2_axes = fig.add_axes(bar_pos)
-bar2 = fig.colorbar(coldata, cax=bar2_axes,
-                   orientation=bar_orientation,
-                   drawedges=False, extend='max')
-
-bar2.ax.tick_params(length=bar_ticklen)
-bar2.ax.tick_params(labelsize=15)
-bar2.set_ticks(bar_ticklabs)
-bar2.set_label(bar_label, fontsize=16) 
-
-ax_map.set_xlim(ax_map.projection.x_limits)
-ax_map.set_ylim(ax_map.projection.y_limits)
-
-
-ax3 = fig.add_subplot(spec_1[0,2], projection = ccrs.Robinson(central_longitude= 0))
-coldata = iplt.contourf(gamma, gamma_levs, cmap = gamma_cmap, extend='both')
-ax_map = plt.gca()
-contour_stipple_lo = iplt.contourf(gamma_agr,colors='None',levels=[0,.8],hatches=['////'])
-
-ax_map.coastlines()
-ax_map.set_title('(c,d) Carbon uptake response to climate warming', fontsize=20)
-
-bar_label    = u"kg C m$^{-2}$ $^o$C$^{-1}$"
-
-bar_pos = [0.54, 0.725, 0.26, 0.01]  # [left,bottom,width,height]
-bar3_axes = fig.add_axes(bar_pos)
-bar_ticklabs = [-1, -.5, 0, .5, 1]
-
-bar3 = fig.colorbar(coldata, cax=bar3_axes,
-                   orientation=bar_orientation,
-                   drawedges=False, extend='min')
-
-bar3.ax.tick_params(length=bar_ticklen)
-bar3.ax.tick_params(labelsize=15)
-bar3.set_ticks(bar_ticklabs)
-bar3.set_label(bar_label, fontsize=16)
+def draw_maps(fig):
+    if draft:
+        beta_map, gamma_map, beta_agr_map, gamma_agr_map = [ts5_grid.coarsen(c, draft_coarsen)
+                                                             for c in [beta, gamma, beta_agr, gamma_agr]]
+    else:
+        beta_map, gamma_map, beta_agr_map, gamma_agr_map = beta, gamma, beta_agr, gamma_agr
+
+    ax2 = fig.add_subplot(spec_1[0,1], projection = ccrs.Robinson(central_longitude= 0))
+    coldata = iplt.contourf(beta_map, beta_levs, cmap = beta_cmap, extend='both')
+    ax_map = plt.gca()
+    contour_stipple_lo = iplt.contourf(beta_agr_map,colors='None',levels=[0,.8],hatches=['////'])
+    rasterize(coldata)
+    rasterize(contour_stipple_lo)
+
+    if not draft: ax_map.coastlines()
+    ax_map.set_xlim(ax_map.projection.x_limits)
+    ax_map.set_ylim(ax_map.projection.y_limits)
+
+    bar_pos = [0.23, 0.725, 0.26, 0.01]  # [left,bottom,width,height]
+    bar_orientation = "horizontal"     # or "vertical"  or "none" (to skip)
+    bar_ticklen  = 0
+    bar_ticklabs = [-.02,-.01,0,.01,.02]
+    bar_label    = u"kg C m$^{-2}$ ppm$^{-1}$"
+
+    bar2_axes = fig.add_axes(bar_pos)
+    bar2 = fig.colorbar(coldata, cax=bar2_axes,
+                       orientation=bar_orientation,
+                       drawedges=False, extend='max')
+
+    bar2.ax.tick_params(length=bar_ticklen)
+    bar2.ax.tick_params(labelsize=15)
+    bar2.set_ticks(bar_ticklabs)
+    bar2.set_label(bar_label, fontsize=16) 
+
+    ax_map.set_xlim(ax_map.projection.x_limits)
+    ax_map.set_ylim(ax_map.projection.y_limits)
+
+
+    ax3 = fig.add_subplot(spec_1[0,2], projection = ccrs.Robinson(central_longitude= 0))
+    coldata = iplt.contourf(gamma_map, gamma_levs, cmap = gamma_cmap, extend='both')
+    ax_map = plt.gca()
+    contour_stipple_lo = iplt.contourf(gamma_agr_map,colors='None',levels=[0,.8],hatches=['////'])
+    rasterize(coldata)
+    rasterize(contour_stipple_lo)
+
+    if not draft: ax_map.coastlines()
+    ax_map.set_title('(c,d) Carbon uptake response to climate warming', fontsize=20)
+
+    bar_label    = u"kg C m$^{-2}$ $^o$C$^{-1}$"
+
+    bar_pos = [0.54, 0.725, 0.26, 0.01]  # [left,bottom,width,height]
+    bar3_axes = fig.add_axes(bar_pos)
+    bar_ticklabs = [-1, -.5, 0, .5, 1]
+
+    bar3 = fig.colorbar(coldata, cax=bar3_axes,
+                       orientation=bar_orientation,
+                       drawedges=False, extend='min')
+
+    bar3.ax.tick_params(length=bar_ticklen)
+    bar3.ax.tick_params(labelsize=15)
+    bar3.set_ticks(bar_ticklabs)
+    bar3.set_label(bar_label, fontsize=16)
 
 
 ######
@@ -574,31 +782,30 @@ bar3.set_label(bar_label, fontsize=16)
 # panel e
 #
 
-xr = [1990,2100]
+def draw_panel_e(fig):
+    # second row
+    ax5 = fig.add_subplot(spec_2[1,0])
+    style_axes([ax5])
 
-for i in np.arange(300,1200,100):
-    ax5.hlines(i, xr[0], xr[1], 'gray', alpha=0.2)
-    
-for i in data:
-    if plot_data[i]: ax5.plot(yr_data[i], data[i], color=col[i], label=lab[i])
+    for i in np.arange(300,1200,100):
+        ax5.hlines(i, xr[0], xr[1], 'gray', alpha=0.2)
+        
+    for i in data:
+        if plot_data[i]: ax5.plot(yr_data[i], data[i], color=col[i], label=lab[i])
 
-ax5.fill_between(y_e,co2_e_pc5,co2_e_pc95, facecolor=col_ssp585,alpha=0.1, label='emiss-driven')
-ax5.fill_between(magicc_yr, magicc_ssp126_pc5, magicc_ssp126_pc95, facecolor=col_ssp126,alpha=0.1)
-ax5.fill_between(magicc_yr, magicc_ssp119_pc5, magicc_ssp119_pc95, facecolor=col_ssp119,alpha=0.1)
-ax5.fill_between(magicc_yr, magicc_ssp245_pc5, magicc_ssp245_pc95, facecolor=col_ssp245,alpha=0.1)
-ax5.fill_between(magicc_yr, magicc_ssp534_pc5, magicc_ssp534_pc95, facecolor=col_ssp534,alpha=0.1)
-ax5.fill_between(magicc_yr, magicc_ssp370_pc5, magicc_ssp370_pc95, facecolor=col_ssp370,alpha=0.1)
+    ax5.fill_between(y_e,co2_e_pc5,co2_e_pc95, facecolor=col_ssp585,alpha=0.1, label='emiss-driven')
+    for i in magicc_mmm:
+        if plot_data[i]: ax5.fill_between(magicc_yr, magicc_pc5[i], magicc_pc95[i], facecolor=col[i],alpha=0.1)
 
-ax5.legend(fontsize=18, loc='upper left', bbox_to_anchor=(1.1,1))
+    ax5.legend(fontsize=18, loc='upper left', bbox_to_anchor=(1.1,1))
 
-ax5.set_title('(e) CO$_2$ concentration (ppm)', fontsize=24, loc='left')
-ax5.set_xlim(xr[0], xr[1])
-ax5.set_ylim(300,1200)
+    ax5.set_title('(e) CO$_2$ concentration (ppm)', fontsize=24, loc='left')
+    ax5.set_xlim(xr[0], xr[1])
+    ax5.set_ylim(300,1200)
 
-ax5.text(1995,1110,'10', fontsize=18, color=col['ssp585'])
+    ax5.text(1995,1110,'10', fontsize=18, color=col['ssp585'])
 
-for axes in [ax5,ax6,ax7,ax8]:
-    axes.tick_params(labelsize=18)
+    ax5.tick_params(labelsize=tick_size)
 
 
 ######
@@ -606,47 +813,59 @@ for axes in [ax5,ax6,ax7,ax8]:
 # panel f
 #
 
-xr2300 = [2100,2300]
+def draw_panel_f(fig):
+    # third row
+    ax6 = fig.add_subplot(spec_2[2,0])
+    ax7 = fig.add_subplot(spec_2[2,1])
+    style_axes([ax6,ax7], right=[ax7])
+
+    ax7.axes.get_yaxis().set_visible(False)
+
+    ax6.set_yticks(flx_ticks)
+    ax7.set_xticks(ticks_2300)
 
-for i in flx_mmm:
-    if plot_data[i]:
-        ax6.plot(y, flx_mmm[i], color=col[i], label=lab[i])
+    for i in flx_mmm:
+        if plot_data[i]:
+            ax6.plot(y, flx_mmm[i], color=col[i], label=lab[i])
 
-ax6.fill_between(y, flx_pc5['ssp126'], flx_pc95['ssp126'], facecolor=col['ssp126'], alpha=0.1)
-ax6.fill_between(y, flx_pc5['ssp370'], flx_pc95['ssp370'], facecolor=col['ssp370'], alpha=0.1)
+    for i in shade:
+        ax6.fill_between(y, flx_pc5[i], flx_pc95[i], facecolor=col[i], alpha=0.1)
+        if show_ci:
+            ax6.plot(y, flx_mmm_ci[i].T, color=col[i], linestyle='dotted', linewidth=1)
 
-for i in np.arange(-4,16,2):
-    ax6.hlines(i, xr[0],xr[1], 'gray', alpha=0.2)
-    ax7.hlines(i, xr2300[0],xr2300[1], 'gray', alpha=0.2)
+    for i in flx_ticks:
+        ax6.hlines(i, xr[0],xr[1], 'gray', alpha=0.2)
+        ax7.hlines(i, xr2300[0],xr2300[1], 'gray', alpha=0.2)
 
-ax6.hlines(0, xr[0],xr[1], 'k', alpha=0.5)
-ax7.hlines(0, xr2300[0],xr2300[1], 'k', alpha=0.5)
-ax7.vlines(2100, -10,20, 'k', linestyle='dashed')
+    ax6.hlines(0, xr[0],xr[1], 'k', alpha=0.5)
+    ax7.hlines(0, xr2300[0],xr2300[1], 'k', alpha=0.5)
+    ax7.vlines(2100, -10,20, 'k', linestyle='dashed')
 
-ax6.set_ylim(-5,15)
-ax7.set_ylim(-5,15)
-ax6.set_xlim(xr[0], xr[1])
-ax7.set_xlim(xr2300[0], xr2300[1])
+    ax6.set_ylim(-5,15)
+    ax7.set_ylim(-5,15)
+    ax6.set_xlim(xr[0], xr[1])
+    ax7.set_xlim(xr2300[0], xr2300[1])
 
-ax7.fill_between(year, smooth(ssp126_2300_pc5,5), smooth(ssp126_2300_pc95,5), facecolor=col['ssp126'], alpha=.1)
-ax7.plot(year, ssp126_2300_mmm, col['ssp126'])
-ax7.plot(year, ssp534_2300_mmm, col['ssp534'])
-ax7.plot(year, ssp585_2300_mmm, col['ssp585'])
+    for i in shade:
+        if i in ssp_2300_mmm:
+            band_lo, band_hi = smooth([ssp_2300_pc5[i], ssp_2300_pc95[i]], 5)
+            ax7.fill_between(year, band_lo, band_hi, facecolor=col[i], alpha=.1)
+    for i in ssp_2300_mmm:
+        ax7.plot(year, ssp_2300_mmm[i], col[i])
 
-ax6.set_title('(f) Net land and ocean carbon fluxes (PgC yr$^{-1}$)', fontsize=24, loc='left')
+    ax6.set_title('(f) Net land and ocean carbon fluxes (PgC yr$^{-1}$)', fontsize=24, loc='left')
 
-# print number of models used for each scenario/time period
-ax6.text(1995,12.5,'5', fontsize=18, color=col['ssp119'])
-ax6.text(1998,12.5,'9', fontsize=18, color=col['ssp126'])
-ax6.text(2001,12.5,'9', fontsize=18, color=col['ssp245'])
-ax6.text(2004,12.5,'9', fontsize=18, color=col['ssp370'])
-ax6.text(2007,12.5,'4', fontsize=18, color=col['ssp534'])
-ax6.text(2010,12.5,'9', fontsize=18, color=col['ssp585'])
+    # print number of models used for each scenario/time period
+    for k, i in enumerate(nmod_order):
+        if i in flx_nmod: ax6.text(1995+3*k,12.5,'%d' % flx_nmod[i], fontsize=18, color=col[i])
 
-ax7.text(2120,12.5,'simulations extended to 2300 for:', fontsize=16)
-ax7.text(2240,10.5,'SSP5-8.5 [4]', fontsize=18, color=col['ssp585'])
-ax7.text(2240,9,'SSP5-3.4-OS [4]', fontsize=18, color=col['ssp534'])
-ax7.text(2240,7.5,'SSP1-2.6 [4]', fontsize=18, color=col['ssp126'])
+    ax7.text(2120,12.5,'simulations extended to 2300 for:', fontsize=16)
+    ax7.text(2240,10.5,'SSP5-8.5 [%d]' % nmod_2300['ssp585'], fontsize=18, color=col['ssp585'])
+    ax7.text(2240,9,'SSP5-3.4-OS [%d]' % nmod_2300['ssp534'], fontsize=18, color=col['ssp534'])
+    ax7.text(2240,7.5,'SSP1-2.6 [%d]' % nmod_2300['ssp126'], fontsize=18, color=col['ssp126'])
+
+    for axes in [ax6,ax7]:
+        axes.tick_params(labelsize=tick_size)
 
 
 ######
@@ -654,41 +873,178 @@ ax7.text(2240,7.5,'SSP1-2.6 [4]', fontsize=18, color=col['ssp126'])
 # panel g
 #
 
-for i in sink_fractot_mmm:
-    if plot_data[i]:
-        ax8.plot(y, sink_fractot_mmm[i], color=col[i], label=lab[i])
+def draw_panel_g(fig):
+    #fourth row
+    ax8 = fig.add_subplot(spec_2[3,0])
+    ax8b = fig.add_subplot(spec_2[3,1])
+    style_axes([ax8,ax8b], right=[ax8b])
 
-ax8.fill_between(y, sink_fractot_pc5['ssp126'], sink_fractot_pc95['ssp126'], facecolor=col['ssp126'], alpha=0.1)
-ax8.fill_between(y, sink_fractot_pc5['ssp370'], sink_fractot_pc95['ssp370'], facecolor=col['ssp370'], alpha=0.1)
+    ax8b.spines['bottom'].set_visible(False)
+    ax8b.axes.get_yaxis().set_visible(False)
+    ax8b.axes.get_xaxis().set_visible(False)
 
-        
-for i in np.arange(0,1,.1):
-    ax8.hlines(i, xr[0],xr[1], 'gray', alpha=0.2)
+    for i in sink_fractot_mmm:
+        if plot_data[i]:
+            ax8.plot(y, sink_fractot_mmm[i], color=col[i], label=lab[i])
+
+    for i in shade:
+        ax8.fill_between(y, sink_fractot_pc5[i], sink_fractot_pc95[i], facecolor=col[i], alpha=0.1)
+        if show_ci:
+            ax8.plot(y, sink_fractot_mmm_ci[i].T, color=col[i], linestyle='dotted', linewidth=1)
+
+            
+    for i in np.arange(0,1,.1):
+        ax8.hlines(i, xr[0],xr[1], 'gray', alpha=0.2)
+
+    ax8.hlines(0, xr[0],xr[1], 'k', alpha=0.5)
+
+    ax8.set_xlim(xr[0],xr[1])
+    ax8.set_ylim(0.25,.75)
+
+    ax8.set_title('(g) Sink fraction', fontsize=24, loc='left')
+    ax8.set_xlabel('Year', fontsize=24)
+
+    for k, i in enumerate(nmod_order):
+        if i in flx_nmod: ax8.text(1995+3*k,.31,'%d' % flx_nmod[i], fontsize=18, color=col[i])
+
+    ax8b.plot([0])
+    ax8b.set_xlim(0,10)
+    ax8b.set_ylim(0,10)
+    ax8b.arrow(1,9,0,-6,color='gray', head_width=.4)
+    ax8b.text(2,7.8,'At higher CO$_2$ concentrations,', fontsize=18)
+    ax8b.text(2,7,'land and ocean carbon stores', fontsize=18)
+    ax8b.text(2,6.2,'take-up a reduced fraction', fontsize=18)
+    ax8b.text(2,5.4,'of our emissions,', fontsize=18)
+    ax8b.text(2,4.6,'despite growing larger', fontsize=18)
+
+    ax8.tick_params(labelsize=tick_size)
 
-ax8.hlines(0, xr[0],xr[1], 'k', alpha=0.5)
 
-ax8.set_xlim(xr[0],xr[1])
-ax8.set_ylim(0.25,.75)
+'''
+draws panels a-d: the zonal profiles and the maps they sit beside, which share
+one group as the profile axes and their titles reach into the map area
+'''
+def draw_maps_zonal(fig):
+    draw_zonal(fig)
+    draw_maps(fig)
+
+
+# panel groups in drawing order
+panels = dict([('maps', draw_maps_zonal), ('e', draw_panel_e), ('f', draw_panel_f),
+             ('g', draw_panel_g)])
+
+'''
+brings the data up to date with the current settings and renders the figure to fname
+(in each of formats when set), returning the files written.
+with render_layers set every panel group is cached as a rendered layer, keyed on
+its drawing code and the data and settings it refers to (see
+ts5_pipeline.code_key). reruns only redraw the panels whose inputs have changed,
+e.g. the projected and contoured maps are not redone when only the time-series
+panels change. the composited image is the one a single-figure draw saves
+'''
+def render_figure(fname):
+    base, ext = os.path.splitext(fname)
+    if draft:
+        base += '_draft'
+    fnames = [base + '.' + f for f in formats] if formats else [base + ext]
+
+    # run (or load) the stages and make their outputs available to the panels,
+    # the bootstrap only when its intervals are drawn
+    globals().update(ts5_pipeline.run(globals(), list(ts5_pipeline.producers) if show_ci else None))
+
+    layer_keys = None
+    if render_layers:
+        dpi = draft_dpi if draft else plt.rcParams['figure.dpi']
+        layer_keys = dict([(i, 'layer-%s-' % i + ts5_pipeline.code_key(panels[i], globals(),
+                     extra=[new_figure.__code__, fig_size, dpi, ts5_render])) for i in panels])
+
+    ts5_render.render(new_figure, panels, fnames, parallel=render_parallel,
+                 layer_keys=layer_keys, raster_dpi=raster_dpi)
+
+    for f, out in ts5_render.outputs.items():
+        print('wrote %s, %.2f MB in %.2f s' % (f, out['bytes'] / 2**20, out['seconds']))
 
-ax8.set_title('(g) Sink fraction', fontsize=24, loc='left')
-ax8.set_xlabel('Year', fontsize=24)
+    ts5_profile.report(fnames[0])
+    return fnames
 
-ax8.text(1995,.31,'5', fontsize=18, color=col['ssp119'])
-ax8.text(1998,.31,'9', fontsize=18, color=col['ssp126'])
-ax8.text(2001,.31,'9', fontsize=18, color=col['ssp245'])
-ax8.text(2004,.31,'9', fontsize=18, color=col['ssp370'])
-ax8.text(2007,.31,'4', fontsize=18, color=col['ssp534'])
-ax8.text(2010,.31,'9', fontsize=18, color=col['ssp585'])
 
-ax8b.plot([0])
-ax8b.set_xlim(0,10)
-ax8b.set_ylim(0,10)
-ax8b.arrow(1,9,0,-6,color='gray', head_width=.4)
-ax8b.text(2,7.8,'At higher CO$_2$ concentrations,', fontsize=18)
-ax8b.text(2,7,'land and ocean carbon stores', fontsize=18)
-ax8b.text(2,6.2,'take-up a reduced fraction', fontsize=18)
-ax8b.text(2,5.4,'of our emissions,', fontsize=18)
-ax8b.text(2,4.6,'despite growing larger', fontsize=18)
+# batch of variants of the figure: TS5_VARIANTS names a json file with a list of
+# dicts, each giving an output file name (fname) and any of the settings below.
+# dict settings (plot_data) are merged into the defaults, the others replace them,
+# e.g. [{"fname": "TS.5_low.png", "plot_data": {"ssp370": false, "ssp585": false},
+#        "shade": ["ssp119"], "pcs": [17, 83]}, ...]
+# data are loaded once; each variant recomputes only the statistics its settings
+# change and redraws only the panel groups that differ, the others (the maps in
+# particular) are reused as rendered layers
+variant_settings = ['plot_data', 'shade', 'pcs', 'xr', 'xr2300', 'show_ci']
 
+variants_file = os.environ.get('TS5_VARIANTS')
 
-plt.savefig('TS.5.png')
+# watch mode: with TS5_WATCH=<settings.json> the figure is rendered and then
+# rendered again whenever an input file or the settings file changes, and the
+# latest image is shown on http://localhost:<TS5_WATCH_PORT, default 8050>/ (see
+# ts5_watch.py). the settings file holds one dict of the settings below, given
+# as for a variant; col_<scenario> also sets that scenario's colour in col.
+# only the stages and panels the change affects are redone
+watch_settings = variant_settings + ['col', 'lab', 'nmod_order', 'beta_levs', 'gamma_levs',
+             'flx_ticks', 'ticks_2300', 'tick_size'] + ['col_' + i for i in col]
+
+watch_file = os.environ.get('TS5_WATCH')
+
+
+'''
+sets the settings named in v (dict of name -> value) and resets the others in
+defaults to their default values. dict settings are merged into their defaults
+and arrays (e.g. beta_levs) are given as lists
+'''
+def apply_settings(v, defaults):
+    for k in defaults:
+        if isinstance(defaults[k], dict):
+            globals()[k] = dict(defaults[k], **v.get(k, dict()))
+        elif k in v and isinstance(defaults[k], np.ndarray):
+            globals()[k] = np.asarray(v[k], dtype=defaults[k].dtype)
+        else:
+            globals()[k] = v.get(k, defaults[k])
+
+    for i in col:
+        if 'col_' + i in v:
+            col[i] = v['col_' + i]
+
+
+'''
+applies the settings of the watched settings file and renders the figure
+'''
+def render_watched(v):
+    unknown = [k for k in v if k not in watch_settings]
+    if unknown:
+        raise ValueError('unknown settings %s in %s' % (', '.join(unknown), watch_file))
+
+    apply_settings(v, watch_defaults)
+    return render_figure('TS.5.png')
+
+
+if watch_file:
+    import ts5_watch
+    render_layers = True
+    watch_defaults = dict([(k, globals()[k]) for k in watch_settings])
+    ts5_watch.watch(render_watched, watch_file, ts5_pipeline.input_files,
+                    port=int(os.environ.get('TS5_WATCH_PORT', '8050')))
+elif variants_file is None:
+    render_figure('TS.5.png')
+else:
+    import json
+    with open(variants_file) as f:
+        variants = json.load(f)
+
+    render_layers = True
+
+    defaults = dict([(k, globals()[k]) for k in variant_settings])
+    for v in variants:
+        unknown = [k for k in v if k not in variant_settings + ['fname']]
+        if unknown:
+            raise ValueError('unknown variant settings %s in %s' % (', '.join(unknown), variants_file))
+
+        apply_settings(v, defaults)
+
+        print('rendering', v['fname'])
+        render_figure(v['fname'])
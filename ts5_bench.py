@@ -0,0 +1,238 @@
+# coding: utf-8
+
+# benchmarks for Box TS.5, Figure 1
+#
+# runs the plotting script on synthetic inputs (ts5_synthetic.py) with the cache
+# switched off, each repeat in a fresh process, and times data loading, the
+# multi-model statistics, the sink fraction, the map render and the time-series
+# render separately from the stage and panel timings the script records (see
+# ts5_pipeline.timings and ts5_render.timings). startup is the wall time of a
+# data-only run (TS5_DATA_ONLY) with warm stage outputs in a new process, from
+# interpreter start to exit, which is held to startup_budget and must not load
+# the plotting stack. results are appended, with the git commit they were taken
+# at, to <out>/results.jsonl so runs at different commits can be compared.
+#
+# usage: python ts5_bench.py [--scale S] [--repeat N] [--out DIR] [--data DIR] [--compare]
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+
+here = os.path.dirname(os.path.abspath(__file__))
+script = os.path.join(here, 'Box5_Figure1_plotting script.py')
+
+# benchmark -> pipeline stages (or panel groups) it is made of
+groups = dict([
+    ('load', ['load_co2', 'magicc_stats', 'load_liddicoat', 'load_2300', 'land_use', 'load_feedback']),
+    ('statistics', ['flux_totals', 'flux_stats', 'flux_2300_stats', 'prefix_index', 'cumulative_flux',
+                    'window_totals', 'zonal_profiles']),
+    ('sink_fraction', ['sink_fraction']),
+    ('bootstrap', ['bootstrap_ci']),
+    ('map_render', ['maps']),
+    ('timeseries_render', ['e', 'f', 'g']),
+    ('savefig', ['savefig'])])
+
+# budget (s) for the startup benchmark, and the modules a data-only run must not import
+startup_budget = 1.0
+plotting_modules = ['matplotlib', 'cartopy', 'iris.plot']
+
+
+'''
+runs the script once in this process from the data directory and prints its stage
+and panel timings as json. called in a fresh process for every repeat
+'''
+def run_once(data):
+    os.environ['TS5_CACHE'] = '0'
+    os.environ['TS5_LU_FILE'] = os.path.join(data, 'CMIP6_C4MIP_landuse_emissions.nc')
+
+    import matplotlib
+    matplotlib.use('Agg')
+    import runpy
+
+    sys.path.insert(0, here)
+    os.chdir(data)
+
+    t0 = time.perf_counter()
+    g = runpy.run_path(script, run_name='__main__')
+    total = time.perf_counter() - t0
+
+    import ts5_pipeline
+    import ts5_render
+
+    # the bootstrap is not drawn by default, so it is timed on its own
+    ts5_pipeline.run(g['render_figure'].__globals__, ts5_pipeline.stages['bootstrap_ci']['outputs'])
+
+    timings = dict(ts5_pipeline.timings)
+    timings.update(ts5_render.timings)
+    timings['total'] = total
+    sys.stdout.write('\nTS5_BENCH ' + json.dumps(timings) + '\n')
+
+
+'''
+runs the script once in data-only mode in this process, with the stage outputs
+cached in the data directory, and prints which plotting modules it loaded
+'''
+def data_only_once(data):
+    os.environ['TS5_LU_FILE'] = os.path.join(data, 'CMIP6_C4MIP_landuse_emissions.nc')
+    os.environ['TS5_CACHE_DIR'] = os.path.join(data, '.ts5_cache')
+    os.environ['TS5_DATA_ONLY'] = os.path.join(data, 'ts5_numbers.npz')
+
+    import runpy
+
+    sys.path.insert(0, here)
+    os.chdir(data)
+
+    try:
+        runpy.run_path(script, run_name='__main__')
+    except SystemExit:
+        pass
+
+    loaded = [m for m in plotting_modules if m in sys.modules]
+    sys.stdout.write('\nTS5_BENCH ' + json.dumps(dict([('loaded', loaded)])) + '\n')
+
+
+'''
+runs this file in a new process with flag (--run-once or --data-only-once) and
+returns the json it prints
+'''
+def child(flag, data):
+    out = subprocess.run([sys.executable, os.path.abspath(__file__), flag, data],
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    for line in out.stdout.splitlines():
+        if line.startswith('TS5_BENCH '):
+            return json.loads(line[len('TS5_BENCH '):])
+    raise RuntimeError('benchmark run failed:\n' + out.stderr[-2000:])
+
+
+'''
+returns the stage and panel timings of one run of the script in a new process
+'''
+def timed_run(data):
+    return child('--run-once', data)
+
+
+'''
+returns the wall time of a data-only run in a new process and the plotting
+modules it loaded
+'''
+def startup_run(data):
+    t0 = time.perf_counter()
+    res = child('--data-only-once', data)
+    return time.perf_counter() - t0, res['loaded']
+
+
+'''
+returns the current git commit of the repository, or None outside a checkout
+'''
+def git_commit():
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=here,
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+    except OSError:
+        return None
+    return out.stdout.strip() or None
+
+
+'''
+returns the benchmarks of a list of timing dicts as name -> dict(min, median, runs)
+'''
+def summarise(runs):
+    res = dict()
+    names = list(groups) + ['total'] + sorted(set(k for r in runs for k in r))
+    for name in names:
+        if name in res:
+            continue
+        parts = groups.get(name, [name])
+        ts = sorted(sum(r.get(p, 0.) for p in parts) for r in runs)
+        res[name] = dict([('min', ts[0]), ('median', ts[len(ts) // 2]), ('runs', ts)])
+    return res
+
+
+'''
+prints the benchmarks of a result, and the ratio to a previous result if given
+'''
+def report(result, previous=None):
+    print('commit %s, scale %g, %d repeats' % (result['commit'], result['scale'], result['repeat']))
+    for name in result['benchmarks']:
+        t = result['benchmarks'][name]['min']
+        line = '  %-18s %8.3f s' % (name, t)
+        if previous and name in previous['benchmarks'] and previous['benchmarks'][name]['min'] > 0:
+            line += '   x%.2f vs %s' % (t / previous['benchmarks'][name]['min'], previous['commit'])
+        if name == 'startup' and t > result['startup_budget']:
+            line += '   over budget (%g s)' % result['startup_budget']
+        print(line)
+    if result.get('startup_loaded'):
+        print('  data-only run imported %s' % ', '.join(result['startup_loaded']))
+
+
+'''
+returns the last stored result at the given scale, or None
+'''
+def last_result(fname, scale):
+    if not os.path.exists(fname):
+        return None
+    last = None
+    with open(fname) as f:
+        for line in f:
+            r = json.loads(line)
+            if r['scale'] == scale:
+                last = r
+    return last
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmarks for Box TS.5, Figure 1')
+    parser.add_argument('--scale', type=float, default=1., help='size of the synthetic inputs (default 1)')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per benchmark, the fastest counts (default 3)')
+    parser.add_argument('--out', default=os.path.join(here, '.ts5_bench'), help='results directory')
+    parser.add_argument('--data', help='directory for the synthetic inputs (default a temporary one)')
+    parser.add_argument('--compare', action='store_true', help='compare with the last stored result at this scale')
+    parser.add_argument('--run-once', metavar='DATA', help=argparse.SUPPRESS)
+    parser.add_argument('--data-only-once', metavar='DATA', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_once:
+        return run_once(args.run_once)
+    if args.data_only_once:
+        return data_only_once(args.data_only_once)
+    if args.repeat < 1:
+        parser.error('--repeat must be at least 1')
+
+    import ts5_synthetic
+
+    with tempfile.TemporaryDirectory() as tmp:
+        data = os.path.abspath(args.data or tmp)
+        print('writing synthetic inputs (scale %g) to %s' % (args.scale, data))
+        ts5_synthetic.write_inputs(data, args.scale)
+
+        runs = []
+        for i in range(args.repeat):
+            runs.append(timed_run(data))
+
+        # the first data-only run fills the cache, the timed ones read it
+        startup_run(data)
+        for r in runs:
+            r['startup'], loaded = startup_run(data)
+
+    result = dict([('commit', git_commit()), ('date', datetime.datetime.now().isoformat(timespec='seconds')),
+                   ('host', platform.node()), ('python', platform.python_version()),
+                   ('scale', args.scale), ('repeat', args.repeat), ('benchmarks', summarise(runs)),
+                   ('startup_budget', startup_budget), ('startup_loaded', loaded)])
+
+    fname = os.path.join(args.out, 'results.jsonl')
+    report(result, last_result(fname, args.scale) if args.compare else None)
+
+    os.makedirs(args.out, exist_ok=True)
+    with open(fname, 'a') as f:
+        f.write(json.dumps(result) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+# coding: utf-8
+
+# persistent binary cache for the whitespace text inputs of Box TS.5, Figure 1
+#
+# the first time a file is read it is parsed with np.loadtxt and the result is
+# written to the cache directory as a .npy file. later runs memory-map that file
+# instead of re-parsing the text. entries are keyed on the file's path, size,
+# mtime and content hash (plus the loadtxt arguments), so an edited input always
+# gets a fresh entry and the stale one is removed. the cache is capped in size
+# and the least recently used entries are evicted first.
+#
+# other derived arrays, such as pre-rendered panel layers, are stored in the same
+# cache with get and put, and pipeline stage outputs with get_obj and put_obj,
+# under keys chosen by the caller.
+#
+# settings can be overridden from the environment:
+#   TS5_CACHE=0            switch the cache off (plain np.loadtxt)
+#   TS5_CACHE_DIR=<dir>    cache location (default .ts5_cache next to the data)
+#   TS5_CACHE_MAX_MB=<mb>  size cap (default 512)
+
+import hashlib
+import os
+import pickle
+
+import numpy as np
+
+
+cache_on = os.environ.get('TS5_CACHE', '1') != '0'
+cache_dir = os.environ.get('TS5_CACHE_DIR', '.ts5_cache')
+cache_max_bytes = int(float(os.environ.get('TS5_CACHE_MAX_MB', 512)) * 2**20)
+
+
+'''
+returns (path_tag, key) for a text file: path_tag identifies the file, key also
+covers its size, mtime, contents and the arguments it is parsed with
+'''
+def cache_key(fname, kwargs):
+    path = os.path.abspath(fname)
+    st = os.stat(path)
+    path_tag = hashlib.sha1(path.encode()).hexdigest()[:16]
+
+    h = hashlib.sha1()
+    h.update(('%s|%d|%d|%r' % (path, st.st_size, st.st_mtime_ns, sorted(kwargs.items()))).encode())
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+
+    return path_tag, h.hexdigest()
+
+
+'''
+remove least recently used entries until the cache fits in max_bytes
+'''
+def evict(max_bytes=None, keep=None):
+    if max_bytes is None:
+        max_bytes = cache_max_bytes
+    if not os.path.isdir(cache_dir):
+        return
+
+    entries = []
+    for f in os.listdir(cache_dir):
+        if f.endswith('.npy') or f.endswith('.pkl'):
+            # entries can go while we look when several loaders share the cache
+            try:
+                st = os.stat(os.path.join(cache_dir, f))
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, f))
+
+    total = sum(e[1] for e in entries)
+    for mtime, size, f in sorted(entries):
+        if total <= max_bytes:
+            break
+        if f == keep:
+            continue
+        try:
+            os.remove(os.path.join(cache_dir, f))
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+'''
+returns the cached array stored under name as a read-only memory map, or None
+'''
+def get(name):
+    if not cache_on:
+        return None
+
+    fpath = os.path.join(cache_dir, name + '.npy')
+    if not os.path.exists(fpath):
+        return None
+
+    try:
+        arr = np.load(fpath, mmap_mode='r')
+    except (ValueError, OSError):
+        # truncated or corrupt entry, the caller rebuilds it
+        os.remove(fpath)
+        return None
+
+    # touch the entry so it counts as recently used
+    os.utime(fpath)
+    return arr
+
+
+'''
+stores arr in the cache under name and returns it as a read-only memory map.
+entries starting with replaces + '-' are removed as stale
+'''
+def put(name, arr, replaces=None):
+    if not cache_on:
+        return arr
+
+    os.makedirs(cache_dir, exist_ok=True)
+    entry = name + '.npy'
+    fpath = os.path.join(cache_dir, entry)
+
+    if replaces:
+        for f in os.listdir(cache_dir):
+            if f.startswith(replaces + '-') and f != entry:
+                try:
+                    os.remove(os.path.join(cache_dir, f))
+                except FileNotFoundError:
+                    pass
+
+    # write to a temporary name first so readers never see a partial file
+    tmp = fpath + '.%d.tmp' % os.getpid()
+    with open(tmp, 'wb') as f:
+        np.save(f, arr)
+    os.replace(tmp, fpath)
+
+    evict(keep=entry)
+
+    return np.load(fpath, mmap_mode='r')
+
+
+'''
+returns the cached python object stored under name, or None
+'''
+def get_obj(name):
+    if not cache_on:
+        return None
+
+    fpath = os.path.join(cache_dir, name + '.pkl')
+    if not os.path.exists(fpath):
+        return None
+
+    try:
+        with open(fpath, 'rb') as f:
+            obj = pickle.load(f)
+    except Exception:
+        # truncated, corrupt or written by incompatible code, the caller rebuilds it
+        os.remove(fpath)
+        return None
+
+    os.utime(fpath)
+    return obj
+
+
+'''
+stores a picklable python object in the cache under name.
+entries starting with replaces + '-' are removed as stale
+'''
+def put_obj(name, obj, replaces=None):
+    if not cache_on:
+        return obj
+
+    os.makedirs(cache_dir, exist_ok=True)
+    entry = name + '.pkl'
+    fpath = os.path.join(cache_dir, entry)
+
+    if replaces:
+        for f in os.listdir(cache_dir):
+            if f.startswith(replaces + '-') and f != entry:
+                try:
+                    os.remove(os.path.join(cache_dir, f))
+                except FileNotFoundError:
+                    pass
+
+    tmp = fpath + '.%d.tmp' % os.getpid()
+    with open(tmp, 'wb') as f:
+        pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, fpath)
+
+    evict(keep=entry)
+
+    return obj
+
+
+'''
+drop-in replacement for np.loadtxt that goes through the binary cache.
+returns a read-only memory map of the parsed array on a cache hit
+'''
+def loadtxt(fname, **kwargs):
+    if not cache_on:
+        return np.loadtxt(fname, **kwargs)
+
+    path_tag, key = cache_key(fname, kwargs)
+    name = path_tag + '-' + key
+
+    arr = get(name)
+    if arr is not None:
+        return arr
+
+    # any other entry for this path is stale
+    return put(name, np.loadtxt(fname, **kwargs), replaces=path_tag)
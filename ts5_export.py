@@ -0,0 +1,198 @@
+# coding: utf-8
+
+# columnar export of the plotted series of Box TS.5, Figure 1
+#
+# every series behind the time-series panels (concentrations and ranges, flux,
+# cumulative flux and sink fraction statistics and their bootstrap intervals) is
+# written to one file in tidy form, one row per value, with the columns
+#   run, panel, scenario, statistic, year, value, n_models
+# run tells the rows of runs appended to one export apart: TS5_EXPORT_RUN or, by
+# default, the fingerprint of the stages behind the series (ts5_pipeline.run_key),
+# so runs with other inputs or settings get their own rows. n_models is the number of models with data in that year for ensemble
+# statistics, and -1 (null in Parquet) for series that are not one, e.g. the
+# prescribed concentrations or the MAGICC ranges.
+#
+# rows are written one chunk (run, panel, scenario, statistic) at a time, so the whole
+# table is never held in memory. two formats are chosen by the file extension:
+#   .parquet  one row group per chunk (needs pyarrow, not a dependency of the
+#             figure). readers load single columns and skip the row groups of
+#             other scenarios from their statistics. Parquet files cannot grow,
+#             so appending writes <name>-<n>.parquet next to it, which read()
+#             and pyarrow.dataset treat as one table
+#   .npz      numpy only: a zip of uncompressed .npy members named
+#             <run>/<panel>/<scenario>/<statistic>/<column>, so one column or
+#             one scenario is read without touching the rest and new chunks are
+#             appended to the archive in place. a run can be appended once
+#
+# usage: python ts5_export.py <file> [scenario]   prints a summary of an export
+
+import glob
+import os
+import sys
+import zipfile
+
+import numpy as np
+
+
+columns = ['run', 'panel', 'scenario', 'statistic', 'year', 'value', 'n_models']
+
+
+'''
+returns the chunks of the tidy table of run, one dict of columns per panel,
+scenario and statistic. series is a list of (panel, statistic, variable, years variable,
+members variable or None), values the dict holding those variables. dict
+variables give a chunk per scenario, 2-d ones (bootstrap intervals) a chunk per
+row, suffixed _lo and _hi
+'''
+def chunks(series, values, run):
+    for panel, statistic, var, years, members in series:
+        v = values[var]
+        items = list(v.items()) if isinstance(v, dict) else [(None, v)]
+        for scenario, arr in items:
+            yr = values[years][scenario] if isinstance(values[years], dict) else values[years]
+            arr = np.asarray(arr, dtype=float)
+
+            if members is None:
+                n = np.full(len(yr), -1, dtype=np.int32)
+            else:
+                n = np.sum(np.isfinite(values[members][scenario]), axis=0).astype(np.int32)
+
+            rows = [(statistic, arr)] if arr.ndim == 1 else \
+                   [(statistic + s, a) for s, a in zip(['_lo', '_hi'], arr)]
+            for stat, a in rows:
+                yield dict([('run', run), ('panel', panel), ('scenario', scenario or ''), ('statistic', stat),
+                            ('year', np.asarray(yr, dtype=np.int32)), ('value', a), ('n_models', n)])
+
+
+'''
+returns the file the next append to a Parquet export goes to: fname itself when it
+does not exist yet, else the first free <name>-<n>.parquet
+'''
+def parquet_part(fname):
+    if not os.path.exists(fname):
+        return fname
+    base = os.path.splitext(fname)[0]
+    n = 1
+    while os.path.exists('%s-%d.parquet' % (base, n)):
+        n += 1
+    return '%s-%d.parquet' % (base, n)
+
+
+'''
+returns the files making up a Parquet export, in the order they were written
+'''
+def parquet_parts(fname):
+    base = os.path.splitext(fname)[0]
+    parts = [p for p in glob.glob(glob.escape(base) + '-*.parquet') if p[len(base) + 1:-8].isdigit()]
+    return [fname] + sorted(parts, key=lambda p: int(p[len(base) + 1:-8]))
+
+
+'''
+writes chunks to a Parquet file, one row group each
+'''
+def write_parquet(fname, chunks, append):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    runs = set()
+    if append and os.path.exists(fname):
+        for p in parquet_parts(fname):
+            runs.update(pq.read_table(p, columns=['run']).column('run').unique().to_pylist())
+
+    schema = pa.schema([('run', pa.string()), ('panel', pa.string()), ('scenario', pa.string()),
+                        ('statistic', pa.string()), ('year', pa.int32()), ('value', pa.float64()),
+                        ('n_models', pa.int32())])
+
+    n = 0
+    with pq.ParquetWriter(parquet_part(fname) if append else fname, schema) as w:
+        for c in chunks:
+            if c['run'] in runs:
+                raise ValueError('%s already holds run %s' % (fname, c['run']))
+            nrow = len(c['year'])
+            table = pa.table([pa.array([c['run']] * nrow, pa.string()),
+                              pa.array([c['panel']] * nrow, pa.string()),
+                              pa.array([c['scenario']] * nrow, pa.string()),
+                              pa.array([c['statistic']] * nrow, pa.string()),
+                              pa.array(c['year'], pa.int32()), pa.array(c['value'], pa.float64()),
+                              pa.array(c['n_models'], pa.int32(), mask=c['n_models'] < 0)], schema=schema)
+            w.write_table(table, row_group_size=max(nrow, 1))
+            n += nrow
+    return n
+
+
+'''
+writes chunks to a zip of .npy columns, one set of members each
+'''
+def write_npz(fname, chunks, append):
+    n = 0
+    with zipfile.ZipFile(fname, 'a' if append else 'w', zipfile.ZIP_STORED, allowZip64=True) as zf:
+        names = set(zf.namelist())
+        runs = set(m.split('/', 1)[0] for m in names)
+        for c in chunks:
+            if c['run'] in runs:
+                raise ValueError('%s already holds run %s' % (fname, c['run']))
+            nrow = len(c['year'])
+            chunk = '%s/%s/%s/%s' % (c['run'], c['panel'], c['scenario'], c['statistic'])
+            if chunk + '/value.npy' in names:
+                raise ValueError('%s already holds %s' % (fname, chunk))
+            names.add(chunk + '/value.npy')
+
+            for col in columns:
+                arr = c[col] if col in ['year', 'value', 'n_models'] else np.full(nrow, c[col])
+                with zf.open('%s/%s.npy' % (chunk, col), 'w', force_zip64=True) as f:
+                    np.lib.format.write_array(f, np.ascontiguousarray(arr), allow_pickle=False)
+            n += nrow
+    return n
+
+
+'''
+writes the series (see chunks) of values to fname, .parquet or .npz, as the rows
+of run, streaming one chunk at a time. with append the rows are added to an
+existing export. returns the number of rows written
+'''
+def write(fname, series, values, run, append=False):
+    if not run or '/' in run:
+        raise ValueError('%r: the run of an export is a name without /' % run)
+    if fname.endswith('.parquet'):
+        return write_parquet(fname, chunks(series, values, run), append)
+    if fname.endswith('.npz'):
+        return write_npz(fname, chunks(series, values, run), append)
+    raise ValueError('%s: export files end in .parquet or .npz' % fname)
+
+
+'''
+reads an export back as a dict of column arrays, only the columns asked for
+(all by default) and only the rows of the given run, panel, scenario and statistic
+'''
+def read(fname, cols=None, run=None, panel=None, scenario=None, statistic=None):
+    cols = cols or columns
+    want = [('run', run), ('panel', panel), ('scenario', scenario), ('statistic', statistic)]
+
+    if fname.endswith('.parquet'):
+        import pyarrow.parquet as pq
+
+        filters = [(k, '==', v) for k, v in want if v is not None] or None
+        tables = [pq.read_table(p, columns=cols, filters=filters) for p in parquet_parts(fname)]
+        return dict([(c, np.concatenate([t.column(c).to_numpy(zero_copy_only=False) for t in tables]))
+                     for c in cols])
+
+    out = dict([(c, []) for c in cols])
+    with np.load(fname) as npz:
+        for chunk in dict.fromkeys(m.rsplit('/', 1)[0] for m in npz.files):
+            keys = dict(zip(['run', 'panel', 'scenario', 'statistic'], chunk.split('/')))
+            if any(v is not None and keys[k] != v for k, v in want):
+                continue
+            for c in cols:
+                out[c].append(npz['%s/%s' % (chunk, c)])
+    return dict([(c, np.concatenate(v) if v else np.empty(0)) for c, v in out.items()])
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        sys.exit('usage: python ts5_export.py <file> [scenario]')
+    t = read(sys.argv[1], scenario=sys.argv[2] if len(sys.argv) > 2 else None)
+    print('%s: %d rows' % (sys.argv[1], len(t['value'])))
+    for key in sorted(set(zip(t['run'], t['panel'], t['scenario'], t['statistic']))):
+        sel = (t['run'] == key[0]) & (t['panel'] == key[1]) & (t['scenario'] == key[2]) & (t['statistic'] == key[3])
+        print('  %-12s %-12s %-8s %-14s %4d-%4d  %d rows' %
+              (key + (t['year'][sel].min(), t['year'][sel].max(), sel.sum())))
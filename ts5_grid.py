@@ -0,0 +1,266 @@
+# coding: utf-8
+
+# area-weighted operations on the latitude-longitude grids of Box TS.5, Figure 1
+#
+# cell areas on a regular grid are proportional to
+#
+#     (sin(lat_north) - sin(lat_south)) * (lon_east - lon_west)
+#
+# taken from the cell bounds (guessed halfway between points where a coordinate
+# has none). missing cells (masked or NaN) carry no weight, so a coarse cell is
+# the area mean of the fine cells that have data and is missing only when all
+# of them are.
+#
+# the zonal profiles of panels a and b are integrals along the latitude circles
+# of the land or ocean part of a field, per metre of latitude: the sum over a
+# row of field times land (or ocean) fraction times cell width, where the width
+# of a cell is its area over its meridional extent. zonal_stats computes them,
+# with means and spreads along the circle, for every field, region and latitude
+# in one pass.
+#
+# the profiles in the feedback file are ensemble means of each model's integrals
+# on its own grid and with its own land fraction, while the maps are ensemble
+# means regridded to a common grid. profiles computed from the maps and the
+# ensemble-mean land fraction therefore differ from the file's by the regridding
+# and by the spread of the models' coastlines, and are checked against them to
+# within profile_rtol of the largest value of each profile. ts5_synthetic.py
+# builds its feedback file that way, from models on finer grids, and agrees to
+# about 3%. the shipped file has not been checked against its models' land
+# fractions here, as they are not part of the inputs.
+#
+# usage: python ts5_grid.py <feedback file> <land fraction file>
+#   compares the zonal profiles computed from the beta and gamma maps with those
+#   in the file and exits with status 1 if any differs by more than profile_rtol
+
+import hashlib
+import sys
+
+import numpy as np
+
+
+# mean radius of the Earth (m)
+earth_radius = 6371e3
+
+# the zonal profiles of the feedback file are in 10^6 kg C per metre of latitude
+profile_scale = 1e-6
+
+# largest difference, relative to the largest magnitude of the profile, allowed
+# between a profile computed from the maps and the file's (see the top of this file)
+profile_rtol = 0.05
+
+# land and ocean weights by grid and land fraction, see region_weights
+_regions = dict()
+
+
+'''
+returns the (n, 2) bounds of a coordinate: its own, or halfway between points with
+the end cells as wide as their neighbours. latitudes are clipped to the poles
+'''
+def cell_bounds(coord, lat=False):
+    if coord.has_bounds():
+        return np.asarray(coord.bounds, dtype=float)
+
+    p = np.asarray(coord.points, dtype=float)
+    if len(p) == 1:
+        edges = np.array([p[0] - .5, p[0] + .5])
+    else:
+        mid = (p[1:] + p[:-1]) / 2
+        edges = np.concatenate([[2 * p[0] - mid[0]], mid, [2 * p[-1] - mid[-1]]])
+    if lat:
+        edges = np.clip(edges, -90., 90.)
+    return np.stack([edges[:-1], edges[1:]], axis=1)
+
+
+'''
+returns the (lat, lon) relative cell areas of a 2-d cube with latitude and
+longitude coordinates
+'''
+def area_weights(cube):
+    lat = np.radians(cell_bounds(cube.coord('latitude'), lat=True))
+    lon = np.radians(cell_bounds(cube.coord('longitude')))
+    return np.outer(np.abs(np.sin(lat[:, 1]) - np.sin(lat[:, 0])), np.abs(lon[:, 1] - lon[:, 0]))
+
+
+'''
+returns the area-weighted means of n x n blocks of a (lat, lon) array, as a masked
+array, with the weights of the fine cells. edge blocks of grids that are not a
+multiple of n are averaged over the cells there are
+'''
+def block_mean(data, weights, n):
+    data = np.ma.masked_invalid(np.ma.asarray(data, dtype=float))
+    w = np.where(np.ma.getmaskarray(data), 0., weights)
+    v = np.ma.filled(data, 0.) * w
+
+    ny, nx = data.shape
+    py, px = -ny % n, -nx % n
+    w = np.pad(w, ((0, py), (0, px))).reshape((ny + py) // n, n, (nx + px) // n, n).sum(axis=(1, 3))
+    v = np.pad(v, ((0, py), (0, px))).reshape((ny + py) // n, n, (nx + px) // n, n).sum(axis=(1, 3))
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.ma.masked_array(v / w, mask=w == 0)
+
+
+'''
+returns a copy of a 2-d (latitude, longitude) cube on a grid n times coarser,
+each cell the area-weighted mean of the n x n cells it covers (see block_mean).
+the coarse coordinates span the bounds of the cells they cover, and a global
+longitude becomes circular
+'''
+def coarsen(cube, n):
+    if n <= 1:
+        return cube
+
+    lat_dim, = cube.coord_dims('latitude')
+    lon_dim, = cube.coord_dims('longitude')
+    if cube.ndim != 2 or lat_dim == lon_dim:
+        raise ValueError('%s: can only coarsen 2-d latitude-longitude cubes' % cube.name())
+
+    data = cube.data if lat_dim == 0 else cube.data.T
+    coarse = block_mean(data, area_weights(cube), n)
+    if lat_dim != 0:
+        coarse = coarse.T
+
+    out = cube[tuple(slice(None, None, n) for d in range(2))].copy(data=coarse)
+    for name in ['latitude', 'longitude']:
+        b = cell_bounds(cube.coord(name), lat=name == 'latitude')
+        lo = b[::n, 0]
+        hi = b[np.minimum(np.arange(n - 1, len(b) + n - 1, n), len(b) - 1), 1]
+        coord = out.coord(name)
+        coord.bounds = None
+        coord.points = (lo + hi) / 2
+        coord.bounds = np.stack([lo, hi], axis=1)
+
+    # a global grid wraps, so plotting closes the gap the wider cells leave at the seam
+    lon = out.coord('longitude')
+    if np.isclose(lon.bounds[-1, 1] - lon.bounds[0, 0], 360.) and hasattr(lon, 'circular'):
+        lon.circular = True
+
+    return out
+
+
+'''
+returns the data of a 2-d latitude-longitude cube as a (lat, lon) array
+'''
+def latlon_data(cube):
+    lat_dim, = cube.coord_dims('latitude')
+    return cube.data if lat_dim == 0 else cube.data.T
+
+
+'''
+returns the (lat, lon) widths in metres of the cells of a 2-d cube along their
+latitude circles, their areas over their meridional extents
+'''
+def cell_widths(cube):
+    lat = np.radians(cell_bounds(cube.coord('latitude'), lat=True))
+    height = np.abs(lat[:, 1] - lat[:, 0])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(height[:, None] > 0, earth_radius * area_weights(cube) / height[:, None], 0.)
+
+
+'''
+returns the (2, lat, lon) land and ocean weights of the cells of a 2-d cube: their
+widths (see cell_widths) times the land fraction and times its complement.
+land_frac is a cube on the same grid, in units of % (as CMIP sftlf) or 1 (a
+fraction); missing cells count as ocean. the weights are cached by grid and land fraction
+'''
+def region_weights(cube, land_frac):
+    for name in ['latitude', 'longitude']:
+        p, q = cube.coord(name).points, land_frac.coord(name).points
+        if p.shape != q.shape or not np.allclose(p, q):
+            raise ValueError('%s: the land fraction is not on the grid of %s' % (land_frac.name(), cube.name()))
+
+    units = land_frac.units
+    if units.is_unknown() or units.is_no_unit() or not units.is_convertible('1'):
+        raise ValueError('%s: land fraction in units of %s, expected %% or 1' % (land_frac.name(), units))
+
+    frac = np.ma.filled(np.ma.masked_invalid(np.ma.asarray(latlon_data(land_frac), dtype=float)), 0.)
+    frac = units.convert(frac, '1')
+    h = hashlib.sha1(frac.tobytes())
+    for name in ['latitude', 'longitude']:
+        h.update(np.asarray(cell_bounds(cube.coord(name)), dtype=float).tobytes())
+
+    key = h.hexdigest()
+    if key not in _regions:
+        w = cell_widths(cube)
+        _regions[key] = np.stack([w * frac, w * (1 - frac)])
+    return _regions[key]
+
+
+'''
+reduces fields along their latitude circles, every field, region and latitude in
+one masked pass. data is a (..., lat, lon) stack of fields, masked or NaN where
+missing, and weights the (region, lat, lon) weights of the cells in each region
+(e.g. from region_weights). returns four (..., region, lat) arrays:
+  total  the sum of field times weight over the cells with data, the integral
+         per metre of latitude with the weights of region_weights
+  mean   the weighted mean of the field
+  std    its weighted standard deviation about the mean
+  width  the sum of the weights of the cells with data
+latitudes without data in a region have a zero total and width and a NaN mean and std
+'''
+def zonal_stats(data, weights):
+    data = np.ma.masked_invalid(np.ma.asarray(data, dtype=float))
+    x = np.ma.filled(data, 0.)
+    w = np.where(np.ma.getmaskarray(data)[..., None, :, :], 0., weights)
+
+    width = w.sum(axis=-1)
+    total = np.einsum('...rij,...ij->...ri', w, x)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total / width
+        std = np.sqrt(np.einsum('...rij,...rij->...ri', w, (x[..., None, :, :] - mean[..., None]) ** 2) / width)
+
+    return total, mean, std, width
+
+
+'''
+returns the largest difference between a computed and a reference zonal profile,
+relative to the largest magnitude of the reference (see profile_rtol)
+'''
+def profile_error(computed, reference):
+    reference = np.ma.filled(np.ma.masked_invalid(np.ma.asarray(reference, dtype=float)), np.nan)
+    computed = np.ma.filled(np.ma.masked_invalid(np.ma.asarray(computed, dtype=float)), np.nan)
+    return np.nanmax(np.abs(computed - reference)) / np.nanmax(np.abs(reference))
+
+
+'''
+returns a zonal profile on the latitudes lat as on the latitudes new_lat: itself
+when they are the same, otherwise interpolated linearly and held constant beyond
+the outermost latitudes. missing values are NaN
+'''
+def profile_on(profile, lat, new_lat):
+    profile = np.ma.filled(np.ma.masked_invalid(np.ma.asarray(profile, dtype=float)), np.nan)
+    lat, new_lat = np.asarray(lat, dtype=float), np.asarray(new_lat, dtype=float)
+    if lat.shape == new_lat.shape and np.allclose(lat, new_lat):
+        return profile
+
+    order = np.argsort(lat)
+    return np.interp(new_lat, lat[order], profile[order])
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        sys.exit('usage: python ts5_grid.py <feedback file> <land fraction file>')
+
+    import iris
+
+    cubes = iris.load(sys.argv[1])
+    land_frac = iris.load_cube(sys.argv[2])
+    maps = [cubes.extract_cube(iris.NameConstraint(var_name='%s_ensmean' % v)) for v in ['beta', 'gamma']]
+    for c in [land_frac] + list(cubes):
+        for coord in c.coords():
+            coord.rename(dict([('lat', 'latitude'), ('lon', 'longitude')]).get(coord.name(), coord.name()))
+
+    total = zonal_stats([latlon_data(c) for c in maps], region_weights(maps[0], land_frac))[0] * profile_scale
+    failed = []
+    for k, v in enumerate(['beta', 'gamma']):
+        for r, region in enumerate(['land', 'ocean']):
+            name = '%s_%s_zonalmean_ensmean' % (v, region)
+            ref = cubes.extract_cube(iris.NameConstraint(var_name=name))
+            err = profile_error(total[k, r], profile_on(ref.data, ref.coord('latitude').points,
+                                                        maps[0].coord('latitude').points))
+            print('%-30s max difference %.2g of the largest value%s' %
+                  (name, err, '' if err <= profile_rtol else ', over %g' % profile_rtol))
+            if not err <= profile_rtol:
+                failed.append(name)
+
+    sys.exit(1 if failed else 0)
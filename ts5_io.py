@@ -0,0 +1,294 @@
+# coding: utf-8
+
+# input loaders for Box TS.5, Figure 1
+#
+# requires the Iris package. See:
+# https://scitools.org.uk/
+# https://scitools-iris.readthedocs.io/en/stable/
+#
+# Iris is imported by the loaders that need it, so that importing this module
+# stays cheap (see the data-only mode of the script)
+
+import hashlib
+import multiprocessing
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+import ts5_cache
+import ts5_stats
+import ts5_store
+import ts5_timeline
+
+
+'''
+loads one MAGICC probabilistic ensemble (member, year) and reduces it over the
+member axis. the cube is loaded lazily and its data is realized only inside this
+function, so just the (year,) reductions leave the worker. with chunk set, members
+are read chunk at a time into a bounded-memory sketch (see ts5_stats.sketch_new)
+instead of realizing the whole ensemble
+'''
+def reduce_magicc(fname, pcs, chunk=None, delta=200):
+    cube = ts5_store.load_cube(fname)
+
+    if chunk:
+        ens = cube.lazy_data()
+        sk = ts5_stats.sketch_new(ens.shape[1], delta)
+        for i in range(0, ens.shape[0], chunk):
+            ts5_stats.sketch_add(sk, np.asarray(ens[i:i + chunk].compute()))
+        mmm, pc = ts5_stats.sketch_stats(sk, pcs)
+        return ts5_timeline.cube_years(cube), mmm, pc
+
+    ens = cube.lazy_data().compute() if cube.has_lazy_data() else cube.data
+
+    # the files are already spread over the workers of load_magicc
+    mmm, pc = ts5_stats.ens_stats(dict([('ens', ens)]), pcs, pool='serial')
+
+    return ts5_timeline.cube_years(cube), mmm['ens'], [p['ens'] for p in pc]
+
+
+'''
+initializer for forked workers: dask's thread pool does not survive a fork, so
+lazy Iris data is computed with the synchronous scheduler inside the worker
+'''
+def worker_init():
+    import dask
+    dask.config.set(scheduler='synchronous')
+
+
+'''
+returns a process or thread pool executor. process pools are forked, because the
+plotting script is not import-safe and a spawned worker would re-run it; where
+fork is not available threads are used instead
+'''
+def pool_executor(pool, workers):
+    if pool == 'process' and 'fork' in multiprocessing.get_all_start_methods():
+        return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'),
+                                   initializer=worker_init)
+    return ThreadPoolExecutor(max_workers=workers)
+
+
+'''
+loads the MAGICC ensembles in files (dict of scenario -> file name) concurrently
+and returns (years, mmm, [pc dict for each of pcs]) keyed by scenario. pool is
+'process' (default) or 'thread'; wall time is bounded by the slowest file.
+chunk (members per read) switches to streaming statistics for very large ensembles
+'''
+def load_magicc(files, pcs=(5, 95), pool='process', workers=None, chunk=None):
+    if not files:
+        return None, dict(), [dict() for p in pcs]
+
+    workers = workers or min(len(files), os.cpu_count() or 1)
+
+    with pool_executor(pool, workers) as ex:
+        futures = dict([(k, ex.submit(reduce_magicc, f, pcs, chunk)) for k, f in files.items()])
+        res = dict([(k, fut.result()) for k, fut in futures.items()])
+
+    yr = next(iter(res.values()))[0]
+    mmm = dict([(k, r[1]) for k, r in res.items()])
+    pc = [dict([(k, r[2][j]) for k, r in res.items()]) for j in range(len(pcs))]
+
+    return yr, mmm, pc
+
+
+# raw MAGICC ensembles loaded in this session as file tag -> (1 + member, year)
+# array of years and members, so that settings changing only their reduction do
+# not reload them
+_ensembles = dict()
+
+
+'''
+loads one MAGICC probabilistic ensemble and returns its years and (member, year)
+values as one (1 + member, year) array
+'''
+def read_ensemble(fname):
+    cube = ts5_store.load_cube(fname)
+    ens = cube.lazy_data().compute() if cube.has_lazy_data() else cube.data
+    ens = np.asarray(ens, dtype=float).reshape(-1, ens.shape[-1])
+    return np.concatenate([ts5_timeline.cube_years(cube)[np.newaxis].astype(float), ens])
+
+
+'''
+loads the raw MAGICC ensembles in files (dict of scenario -> file name) and returns
+(years, dict of scenario -> (member, year) array). each file is loaded once per
+version of the file (see ts5_store.file_tag): from this session, the binary cache
+or, for the others, concurrently in a pool (see pool_executor). the reductions of
+the ensembles are left to the caller, so a change of percentiles or scenarios
+reloads nothing
+'''
+def load_ensembles(files, pool='process', workers=None):
+    if not files:
+        return None, dict()
+
+    keys = dict()
+    arrs = dict()
+    for k, f in files.items():
+        tag = ts5_store.file_tag(f)
+        path_tag = hashlib.sha1(os.path.abspath(f).encode()).hexdigest()[:16]
+        keys[k] = (tag, 'ens-%s-%s' % (path_tag, hashlib.sha1(tag.encode()).hexdigest()[:16]))
+        if tag in _ensembles:
+            arrs[k] = _ensembles[tag]
+        elif ts5_store.entry(f) is None:
+            arrs[k] = ts5_cache.get(keys[k][1])
+
+    todo = [k for k in files if arrs.get(k) is None]
+    if todo:
+        workers = workers or min(len(todo), os.cpu_count() or 1)
+        with pool_executor(pool, workers) as ex:
+            for k, arr in zip(todo, ex.map(read_ensemble, [files[k] for k in todo])):
+                # files in the store are memory maps already
+                if ts5_store.entry(files[k]) is None:
+                    arr = ts5_cache.put(keys[k][1], arr, replaces=keys[k][1].rsplit('-', 1)[0])
+                arrs[k] = arr
+
+    for k in files:
+        _ensembles[keys[k][0]] = arrs[k]
+
+    yr = next(iter(arrs.values()))[0]
+    return yr, dict([(k, a[1:]) for k, a in arrs.items()])
+
+
+# tables being parsed by load_columns as (file name, rows to skip, output view),
+# inherited by forked workers so only table numbers have to be sent to them
+_parse = dict()
+
+
+'''
+returns the (columns, rows) of the whitespace table fname after skiprows lines:
+the values on its first data line and the number of data lines, without parsing
+the numbers. as for np.loadtxt, blank lines and '#' comments are not data
+'''
+def table_shape(fname, skiprows=0):
+    with open(fname, 'rb') as f:
+        for i in range(skiprows):
+            f.readline()
+        text = f.read()
+
+    lines = [l for l in (l.split(b'#', 1)[0] for l in text.split(b'\n')) if l.strip()]
+    if not lines:
+        raise ValueError('no data after %d header line(s)' % skiprows)
+    return len(lines[0].split()), len(lines)
+
+
+'''
+worker entry point of load_columns: parses table k of the job with numpy's C
+parser and copies it into its output view. returns None, or the problem with
+the file
+'''
+def parse_table(k):
+    fname, skiprows, out = _parse['tables'][k]
+    try:
+        values = np.loadtxt(fname, skiprows=skiprows, ndmin=2)
+    except (OSError, ValueError) as e:
+        return '%s: %s' % (fname, e)
+
+    if values.shape != out.shape[::-1]:
+        return '%s: expected %d rows of %d values, read %d rows of %d' \
+               % ((fname,) + out.shape[::-1] + values.shape)
+
+    # the one copy: rows of the file become columns of the output
+    out[...] = values.T
+    return None
+
+
+'''
+reads the whitespace tables fnames, each after skiprows header lines, as
+(column, row) arrays, e.g. a table of year and model columns as years =
+t[0] and (model, year) fluxes = t[1:], in the order of fnames.
+
+tables in the store (ts5_store.py) or the binary cache come from there. the others
+are checked for their shapes first, then parsed concurrently by np.loadtxt (C)
+into one preallocated buffer shared with the workers, and added to the cache.
+
+pool is 'process' (forked workers, scales with the cores), 'thread' or 'auto':
+processes for more than a few MB of text. every file that cannot be read is
+reported, in one ValueError
+'''
+def load_columns(fnames, skiprows=0, pool='auto', workers=None):
+    kwargs = dict([('skiprows', skiprows)]) if skiprows else dict()
+    out = [None] * len(fnames)
+
+    todo = []
+    for k, f in enumerate(fnames):
+        e = ts5_store.entry(f)
+        if e is not None and e['kind'] == 'table' and e['kwargs'] == kwargs:
+            out[k] = ts5_store.array(ts5_store.open_store(), e['data']).T
+        elif ts5_cache.cache_on and os.path.exists(f):
+            arr = ts5_cache.get('-'.join(ts5_cache.cache_key(f, kwargs)))
+            if arr is not None:
+                out[k] = arr.T
+        if out[k] is None:
+            todo.append(k)
+
+    if not todo:
+        return out
+
+    errors = []
+    shapes = dict()
+    for k in todo:
+        try:
+            shapes[k] = table_shape(fnames[k], skiprows)
+        except (OSError, ValueError) as e:
+            errors.append('%s: %s' % (fnames[k], e))
+
+    # one buffer for all tables, in shared memory so forked workers write into it
+    buf = ts5_stats.shared_array(sum(c * r for c, r in shapes.values()))
+    tables = dict()
+    i = 0
+    for k, (c, r) in shapes.items():
+        out[k] = buf[i:i + c * r].reshape(c, r)
+        tables[k] = (fnames[k], skiprows, out[k])
+        i += c * r
+
+    if pool == 'auto':
+        size = sum(os.path.getsize(fnames[k]) for k in tables)
+        pool = 'process' if size > 4 * 2**20 and len(tables) > 1 else 'thread'
+    workers = workers or min(len(tables), os.cpu_count() or 1) or 1
+
+    _parse['tables'] = tables
+    try:
+        with pool_executor(pool, workers) as ex:
+            errors += [e for e in ex.map(parse_table, list(tables)) if e]
+    finally:
+        _parse.clear()
+
+    if errors:
+        raise ValueError('could not read %d table(s):\n  %s' % (len(errors), '\n  '.join(errors)))
+
+    for k in tables:
+        if ts5_cache.cache_on:
+            path_tag, key = ts5_cache.cache_key(fnames[k], kwargs)
+            out[k] = ts5_cache.put(path_tag + '-' + key, out[k].T, replaces=path_tag).T
+
+    return out
+
+
+'''
+returns the models of the extensions to 2300 found in directory (or the store):
+every <model> with both <model>_nbp.dat and <model>_fgco2.dat, sorted by name
+'''
+def discover_2300(directory='.'):
+    names = set(ts5_store.listdir(directory))
+    return [m.group(1) for m in [re.match('(.+)_nbp\\.dat$', f) for f in sorted(names)]
+            if m and m.group(1) + '_fgco2.dat' in names]
+
+
+'''
+returns the scenarios of the Liddicoat et al. files found in directory (or the
+store) as dict of scenario (e.g. ssp534) -> file tag (e.g. Ssp534os), for every
+tag with its FGCO2, NBP and fossil-fuel emission files. with scenarios given only
+those are returned, in that order, otherwise all of them sorted
+'''
+def discover_liddicoat(directory='.', scenarios=None):
+    names = set(ts5_store.listdir(directory))
+    found = dict()
+    for f in sorted(names):
+        m = re.match('global_total_FGCO2_GtC_yr_Historical(Ssp([0-9]+)[A-Za-z]*)\\.txt$', f)
+        if m and 'global_total_NBP_GtC_yr_Historical%s.txt' % m.group(1) in names and \
+                'ffEmsHistorical%s_GtCyr.txt' % m.group(1) in names:
+            found['ssp' + m.group(2)] = m.group(1)
+
+    keys = [k for k in scenarios if k in found] if scenarios is not None else sorted(found)
+    return dict([(k, found[k]) for k in keys])
@@ -0,0 +1,294 @@
+# coding: utf-8
+
+# incremental rebuild of the derived quantities of Box TS.5, Figure 1
+#
+# the script's computations are registered as named stages. a stage is a function
+# whose arguments are the names of variables produced by other stages and which
+# returns a dict of the variables it produces. it can also read input files and
+# module-level settings of the script (plot_data, colours, levels, ...).
+#
+# every stage has a fingerprint made of its own code, the code and values of the
+# script globals it refers to (helper modules by the source of every ts5_* module
+# they import, directly or not), the size and mtime of its input files (or of the
+# input store, see ts5_store.py) and the fingerprints of the stages it depends
+# on. stage outputs are persisted in the binary cache (ts5_cache.py) under that
+# fingerprint, so a run recomputes only the stages downstream of a changed
+# input, parameter or piece of code and loads everything else from disk.
+#
+# panels use the same fingerprints (see code_key): a panel layer is redrawn only
+# when its drawing code or the data and settings it refers to have changed.
+
+import dis
+import hashlib
+import os
+import pickle
+import re
+import sys
+import time
+import types
+
+import numpy as np
+
+import ts5_cache
+import ts5_profile
+import ts5_store
+
+
+# stage name -> dict(fn, outputs, files, on_demand)
+stages = dict()
+
+# variable name -> name of the stage producing it
+producers = dict()
+
+# stage outputs of this session by stage name, as (fingerprint, outputs)
+results = dict()
+
+# wall time (s) of the stages computed in this session by stage name
+timings = dict()
+
+# names of the globals referred to by a code object, see code_names
+_global_names = dict()
+
+# local modules imported by a helper module, by (path, mtime), see local_imports
+_local_imports = dict()
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+
+'''
+registers a pipeline stage producing the variables in outputs from the input files
+in files. used as a decorator, the stage is named after the function. on_demand
+stages (e.g. costly extras not drawn by default) only run when one of their
+outputs is asked for by name, see run
+'''
+def stage(outputs, files=(), on_demand=False):
+    def register(fn):
+        name = fn.__name__
+        stages[name] = dict([('fn', fn), ('outputs', list(outputs)), ('files', list(files)),
+                             ('on_demand', on_demand)])
+        for v in outputs:
+            producers[v] = name
+        return fn
+    return register
+
+
+'''
+returns the input files of all stages, in the order the stages were registered
+'''
+def input_files():
+    return list(dict.fromkeys(f for st in stages.values() for f in st['files']))
+
+
+'''
+returns the names of the arguments of a stage function, i.e. the variables it needs
+'''
+def stage_inputs(name):
+    code = stages[name]['fn'].__code__
+    return list(code.co_varnames[:code.co_argcount])
+
+
+'''
+feeds a stable representation of obj into hash h. arrays are hashed by content,
+containers recursively, functions by their code, colormaps by their colours and
+anything else by pickle
+'''
+def hash_value(h, obj):
+    if isinstance(obj, np.ndarray):
+        h.update(('%s%s' % (obj.dtype, obj.shape)).encode())
+        h.update(np.ascontiguousarray(np.ma.filled(obj, np.nan) if np.ma.isMaskedArray(obj) else obj).tobytes())
+    elif isinstance(obj, dict):
+        h.update(b'{')
+        for k in obj:
+            hash_value(h, k)
+            hash_value(h, obj[k])
+        h.update(b'}')
+    elif isinstance(obj, (list, tuple)):
+        h.update(b'[')
+        for v in obj:
+            hash_value(h, v)
+        h.update(b']')
+    elif isinstance(obj, (str, bytes, int, float, bool, type(None))):
+        h.update(repr(obj).encode())
+    elif 'matplotlib.colors' in sys.modules and isinstance(obj, sys.modules['matplotlib.colors'].Colormap):
+        # by its colours: a colormap's pickle changes once it has been used.
+        # matplotlib is not imported here, a colormap means it is loaded already
+        h.update(('%s%s' % (type(obj).__name__, obj.name)).encode())
+        hash_value(h, obj(np.linspace(0, 1, obj.N)))
+        hash_value(h, [obj.get_under(), obj.get_over(), obj.get_bad()])
+    elif isinstance(obj, types.CodeType):
+        h.update(obj.co_code)
+        for c in obj.co_consts:
+            hash_value(h, c)
+    elif isinstance(obj, types.ModuleType):
+        # helper modules next to this one are hashed by source, together with the
+        # helpers they import (directly or not), others by version
+        f = getattr(obj, '__file__', None) or ''
+        if os.path.dirname(os.path.abspath(f)) == here:
+            for path in module_closure(os.path.abspath(f)):
+                with open(path, 'rb') as fh:
+                    h.update(fh.read())
+        else:
+            h.update(('%s %s' % (obj.__name__, getattr(obj, '__version__', ''))).encode())
+    else:
+        try:
+            h.update(pickle.dumps(obj, protocol=4))
+        except Exception:
+            h.update(type(obj).__name__.encode())
+
+
+'''
+returns the paths of the helper modules (ts5_*.py next to this file) that the
+source file path imports, at top level or inside functions
+'''
+def local_imports(path):
+    key = (path, os.stat(path).st_mtime_ns)
+    if key not in _local_imports:
+        with open(path) as f:
+            names = re.findall(r'^\s*(?:import|from)\s+(ts5_\w+)', f.read(), re.M)
+        _local_imports[key] = [p for p in [os.path.join(here, n + '.py') for n in dict.fromkeys(names)]
+                               if os.path.exists(p)]
+    return _local_imports[key]
+
+
+'''
+returns the path of a helper module and of every helper module reachable from it
+through imports, in a stable order
+'''
+def module_closure(path):
+    seen = [path]
+    for p in seen:
+        seen += [q for q in local_imports(p) if q not in seen]
+    return [path] + sorted(seen[1:])
+
+
+'''
+returns the names of globals referred to by a code object, nested code included.
+attribute names (e.g. the data of cube.data) are not globals, so they do not tie
+a function to a script variable of the same name
+'''
+def code_names(code):
+    if code not in _global_names:
+        names = [i.argval for i in dis.get_instructions(code) if i.opname in ['LOAD_GLOBAL', 'LOAD_NAME']]
+        for c in code.co_consts:
+            if isinstance(c, types.CodeType):
+                names += code_names(c)
+        _global_names[code] = names
+    return _global_names[code]
+
+
+'''
+returns a fingerprint of a function: its code, the code of script functions it
+calls and the values of script globals it refers to. variables produced by a
+stage are covered by that stage's fingerprint instead of their value
+'''
+def code_key(fn, namespace, extra=(), seen=None):
+    seen = seen if seen is not None else set()
+    seen.add(fn)
+
+    h = hashlib.sha1()
+    hash_value(h, fn.__code__)
+    for v in extra:
+        hash_value(h, v)
+
+    for name in sorted(set(code_names(fn.__code__))):
+        if name in producers:
+            h.update(('%s=%s' % (name, fingerprint(producers[name], namespace))).encode())
+        elif name in namespace:
+            obj = namespace[name]
+            if isinstance(obj, types.FunctionType):
+                if obj not in seen:
+                    h.update(('%s=%s' % (name, code_key(obj, namespace, seen=seen))).encode())
+            else:
+                h.update(name.encode())
+                hash_value(h, obj)
+
+    return h.hexdigest()
+
+
+'''
+returns the fingerprint of a stage, see the top of this file
+'''
+def fingerprint(name, namespace, memo=None):
+    memo = memo if memo is not None else namespace.setdefault('_ts5_fingerprints', dict())
+    if name in memo:
+        return memo[name]
+
+    st = stages[name]
+    h = hashlib.sha1(name.encode())
+    h.update(code_key(st['fn'], namespace).encode())
+
+    for f in st['files']:
+        h.update(ts5_store.file_tag(f).encode())
+
+    for v in stage_inputs(name):
+        h.update(('%s=%s' % (v, fingerprint(producers[v], namespace, memo))).encode())
+
+    memo[name] = h.hexdigest()
+    return memo[name]
+
+
+'''
+returns a short key of the values of the variables in names, made of the
+fingerprints of the stages producing them: runs with other inputs, settings or
+code get other keys (see ts5_export.py)
+'''
+def run_key(namespace, names):
+    h = hashlib.sha1()
+    for name in sorted(set(producers[v] for v in names)):
+        h.update(fingerprint(name, namespace).encode())
+    return h.hexdigest()[:12]
+
+
+'''
+runs (or loads) the stage called name and returns its outputs as a dict
+'''
+def run_stage(name, namespace, persist=True):
+    fp = fingerprint(name, namespace)
+    if name in results and results[name][0] == fp:
+        return results[name][1]
+
+    out = None
+    if persist:
+        with ts5_profile.measure(name, cached=True):
+            out = ts5_cache.get_obj('stage-%s-%s' % (name, fp))
+
+    if out is None:
+        args = [run_variable(v, namespace, persist) for v in stage_inputs(name)]
+        t0 = time.perf_counter()
+        with ts5_profile.measure(name, stages[name]['files'], cached=False):
+            out = stages[name]['fn'](*args)
+        timings[name] = time.perf_counter() - t0
+
+        missing = [v for v in stages[name]['outputs'] if v not in out]
+        if missing:
+            raise ValueError('stage %s did not produce %s' % (name, ', '.join(missing)))
+
+        if persist:
+            ts5_cache.put_obj('stage-%s-%s' % (name, fp), out, replaces='stage-%s' % name)
+
+    results[name] = (fp, out)
+    return out
+
+
+'''
+returns the value of one pipeline variable
+'''
+def run_variable(v, namespace, persist=True):
+    if v not in producers:
+        raise KeyError('no pipeline stage produces %s' % v)
+    return run_stage(producers[v], namespace, persist)[v]
+
+
+'''
+returns a dict with the values of the variables in names (by default all outputs
+of the stages that are not on_demand), running only the stages needed for them
+that are not up to date. fingerprints are taken afresh, so settings changed since
+the last run count
+'''
+def run(namespace, names=None, persist=True):
+    namespace['_ts5_fingerprints'] = dict()
+
+    if names is None:
+        names = [v for v in producers if not stages[producers[v]]['on_demand']]
+
+    return dict([(v, run_variable(v, namespace, persist)) for v in names])
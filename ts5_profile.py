@@ -0,0 +1,160 @@
+# coding: utf-8
+
+# run instrumentation for Box TS.5, Figure 1
+#
+# records, for every pipeline stage (ts5_pipeline.py) and every rendered panel
+# group and savefig (ts5_render.py), the wall time, the CPU time, the peak RSS of
+# the process and the bytes read, plus the size of every input file a stage
+# reads. the records are written as a json report next to the figure. the peak
+# of python/numpy memory allocated in each stage (tracemalloc) and the cProfile
+# statistics of the slowest stage (read them with python -m pstats) can be added;
+# both slow the run down considerably, the map contouring most of all.
+#
+# instrumentation is off by default and measure() then returns straight away.
+# settings can be overridden from the environment, options separated by commas:
+#   TS5_PROFILE=1          write <figure>.profile.json
+#   TS5_PROFILE=memory     also record the tracemalloc peak of every stage
+#   TS5_PROFILE=cprofile   also write <figure>.prof for the slowest stage
+
+import contextlib
+import cProfile
+import json
+import marshal
+import os
+import resource
+import time
+import tracemalloc
+
+
+profile_mode = os.environ.get('TS5_PROFILE', '0').split(',')
+profile_on = profile_mode != ['0']
+profile_memory = 'memory' in profile_mode
+profile_cprofile = 'cprofile' in profile_mode
+
+# measured block name -> record dict, in the order they finished
+records = dict()
+
+# measured block name -> cProfile statistics (as dumped by cProfile), with cprofile on
+profiles = dict()
+
+# input file -> size in bytes, for the files of measured stages
+files = dict()
+
+
+'''
+returns the bytes this process has read so far (rchar from /proc/self/io), or None
+where that is not available
+'''
+def bytes_read():
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+    return None
+
+
+'''
+returns the peak resident set size (MB) of this process and of its finished children
+'''
+def max_rss():
+    # ru_maxrss is in kB on linux and in bytes on macOS
+    unit = 1. if os.uname().sysname == 'Darwin' else 1024.
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit / 2**20,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit / 2**20)
+
+
+'''
+context manager measuring the block it wraps under name. fnames are the input
+files the block reads, info is added to its record as it is
+'''
+@contextlib.contextmanager
+def measure(name, fnames=(), **info):
+    if not profile_on:
+        yield
+        return
+
+    if profile_memory:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        mem0 = tracemalloc.get_traced_memory()[0]
+    read0 = bytes_read()
+
+    prof = cProfile.Profile() if profile_cprofile else None
+    cpu0 = time.process_time()
+    t0 = time.perf_counter()
+    if prof:
+        prof.enable()
+    try:
+        yield
+    finally:
+        if prof:
+            prof.disable()
+        wall = time.perf_counter() - t0
+        cpu = time.process_time() - cpu0
+        read1 = bytes_read()
+        rss, rss_children = max_rss()
+
+        rec = dict([('wall_s', wall), ('cpu_s', cpu),
+                    ('max_rss_mb', rss), ('max_rss_children_mb', rss_children),
+                    ('bytes_read', read1 - read0 if read0 is not None and read1 is not None else None)])
+        if profile_memory:
+            rec['peak_alloc_mb'] = (tracemalloc.get_traced_memory()[1] - mem0) / 2**20
+        if fnames:
+            rec['files'] = list(fnames)
+            for f in fnames:
+                # inputs served from the store (ts5_store.py) need not exist as files
+                files[f] = os.path.getsize(f) if os.path.exists(f) else None
+        rec.update(info)
+        records[name] = rec
+
+        if prof:
+            prof.create_stats()
+            profiles[name] = prof.stats
+
+
+'''
+adds a record (and cProfile statistics) measured in another process, e.g. a render worker
+'''
+def add(name, rec, stats=None):
+    if rec is not None:
+        records[name] = rec
+    if stats is not None:
+        profiles[name] = stats
+
+
+'''
+writes the report for the figure written to fname: <fname minus extension>.profile.json
+and, with cprofile on, <...>.prof with the statistics of the slowest measured block,
+and starts a new one. does nothing when instrumentation is off
+'''
+def report(fname):
+    if not profile_on:
+        return None
+
+    base = os.path.splitext(fname)[0]
+    hottest = max(records, key=lambda k: records[k]['wall_s']) if records else None
+
+    out = dict([('figure', fname), ('stages', records), ('files', files), ('hottest', hottest),
+                ('wall_s', sum(r['wall_s'] for r in records.values())),
+                ('cpu_s', sum(r['cpu_s'] for r in records.values())),
+                ('max_rss_mb', max_rss()[0]), ('max_rss_children_mb', max_rss()[1])])
+
+    if profile_cprofile and hottest in profiles:
+        # same format as cProfile.Profile.dump_stats
+        with open(base + '.prof', 'wb') as f:
+            marshal.dump(profiles[hottest], f)
+        out['cprofile'] = base + '.prof'
+
+    with open(base + '.profile.json', 'w') as f:
+        json.dump(out, f, indent=1)
+
+    # the next figure of a batch gets a report of its own
+    records.clear()
+    profiles.clear()
+    files.clear()
+
+    return base + '.profile.json'
@@ -0,0 +1,352 @@
+# coding: utf-8
+
+# rendering of Box TS.5, Figure 1
+#
+# the figure is drawn by a set of panel-group functions, each taking the figure
+# and adding its own axes at fixed gridspec/add_axes positions. by default they
+# all draw into one figure, which is saved with savefig.
+#
+# groups can also be kept as layers, to reuse unchanged groups between renders
+# (layer_keys) or to draw each group in a forked worker process (parallel). a
+# layer is a group drawn alone into its own copy of the figure, on the figure
+# background: its colours are exactly those of a single-figure draw wherever no
+# other group draws. its alpha channel marks the region the group's artists can
+# touch (their extents, padded for anti-aliasing), and the composite takes each
+# pixel from the layer whose region covers it. as long as the regions of the
+# groups do not overlap the composite is byte-for-byte the single-figure image;
+# where they do, the figure is drawn directly instead. wall time in parallel mode
+# is set by the slowest group (the two maps). the last composite is kept, so when
+# a render changes only some groups (e.g. a restyled time-series panel) just the
+# region they cover is composited again.
+#
+# one render can write several files. raster formats are all written from the
+# same layers or figure. vector formats (pdf, svg, eps) need the artists, so
+# then every group is drawn into one figure and all files are saved from that
+# draw, each in its own forked process where there is more than one. artists
+# the panels mark as rasterized (the map fills and hatching) are embedded as
+# images at raster_dpi, and text and lines stay vectors.
+
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import matplotlib
+import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+import ts5_cache
+import ts5_io
+import ts5_profile
+
+
+# figure factory and panel groups of the current parallel render, inherited by
+# the forked workers so only group names have to be sent to them
+_job = dict()
+
+# wall time (s) of the panel groups drawn in this session by group name
+timings = dict()
+
+# last layer rendered in this session for each group, as (key, layer), so that
+# batches of variants reuse unchanged groups even with the disk cache off
+latest = dict()
+
+# output file -> dict(bytes, seconds) of the files written by the last render
+outputs = dict()
+
+# file extensions written as vector graphics
+vector_formats = ['.pdf', '.svg', '.eps', '.ps']
+
+# last composited figure of this session, as dict(keys, layers, pixels), so that a
+# render changing a few groups only recomposites their region
+_composed = dict()
+
+
+'''
+returns the (top, bottom, left, right) pixel boxes of a drawn figure that its
+artists can touch: the extents of its axes (with their ticks, titles and
+legends) and of the artists placed on the figure itself, padded by pad pixels
+for anti-aliasing. the figure background is not included
+'''
+def artist_boxes(fig, renderer, pad=2):
+    height, width = renderer.height, renderer.width
+    boxes = []
+    for a in fig.get_children():
+        if a is fig.patch or not a.get_visible():
+            continue
+        bb = a.get_tightbbox(renderer)
+        if bb is None or not np.all(np.isfinite(bb.extents)) or bb.width <= 0 or bb.height <= 0:
+            continue
+        top = max(0, int(np.floor(height - bb.y1)) - pad)
+        bottom = min(height, int(np.ceil(height - bb.y0)) + pad)
+        left = max(0, int(np.floor(bb.x0)) - pad)
+        right = min(width, int(np.ceil(bb.x1)) + pad)
+        if top < bottom and left < right:
+            boxes.append((top, bottom, left, right))
+    return boxes
+
+
+'''
+draws one panel group alone into a copy of the figure and returns its RGBA uint8
+pixels: the colours of the copy, with an alpha of 255 over the region the
+group's artists can touch (see artist_boxes) and 0 elsewhere
+'''
+def draw_layer(new_figure, draw):
+    fig = new_figure()
+    canvas = FigureCanvasAgg(fig)
+
+    draw(fig)
+
+    canvas.draw()
+    layer = np.array(canvas.buffer_rgba())
+    layer[..., 3] = 0
+    for top, bottom, left, right in artist_boxes(fig, canvas.get_renderer()):
+        layer[top:bottom, left:right, 3] = 255
+    plt.close(fig)
+
+    return layer
+
+
+'''
+draws one panel group as a layer and records its wall time
+'''
+def timed_layer(new_figure, group, draw):
+    t0 = time.perf_counter()
+    with ts5_profile.measure(group):
+        layer = draw_layer(new_figure, draw)
+    timings[group] = time.perf_counter() - t0
+    return layer
+
+
+'''
+worker entry point of a parallel render. returns the layer, its wall time and
+the instrumentation record of the worker (see ts5_profile.py)
+'''
+def render_layer(group):
+    t0 = time.perf_counter()
+    with ts5_profile.measure(group):
+        layer = draw_layer(_job['new_figure'], _job['panels'][group])
+    return layer, time.perf_counter() - t0, ts5_profile.records.get(group), ts5_profile.profiles.get(group)
+
+
+'''
+returns the (top, bottom, left, right) bounds of the region of a layer (its
+non-zero alpha), or None when it has none
+'''
+def visible_box(layer):
+    rows = np.flatnonzero(layer[..., 3].any(axis=1))
+    if len(rows) == 0:
+        return None
+    cols = np.flatnonzero(layer[rows[0]:rows[-1] + 1, :, 3].any(axis=0))
+    return rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+
+
+'''
+composites layers (see draw_layer), in drawing order, into opaque RGBA uint8
+pixels: each pixel comes from the layer whose region covers it, and from the
+first layer, which is figure background there, where none does. returns None
+when the regions of two layers overlap, as the pixels they share cannot be
+reproduced from the layers. with out and region (top, bottom, left, right)
+given, only that region of out is composited again
+'''
+def composite(layers, out=None, region=None):
+    if out is None:
+        out = np.empty(layers[0].shape, dtype=np.uint8)
+        region = (0, out.shape[0], 0, out.shape[1])
+    top, bottom, left, right = region
+
+    part = out[top:bottom, left:right]
+    part[..., :3] = layers[0][top:bottom, left:right, :3]
+    part[..., 3] = 255
+
+    covered = np.zeros(part.shape[:2], dtype=bool)
+    for layer in layers:
+        # only the bounding box of the layer's region
+        box = visible_box(layer)
+        if box is None:
+            continue
+        t, b, l, r = max(box[0], top), min(box[1], bottom), max(box[2], left), min(box[3], right)
+        if t >= b or l >= r:
+            continue
+
+        mask = layer[t:b, l:r, 3] > 0
+        seen = covered[t - top:b - top, l - left:r - left]
+        if np.any(seen & mask):
+            return None
+        seen |= mask
+        np.copyto(out[t:b, l:r, :3], layer[t:b, l:r, :3], where=mask[..., np.newaxis])
+
+    return out
+
+
+'''
+returns the composite of the layers of the groups in keys (dict of group -> layer
+key or None, in drawing order) as RGBA uint8 pixels, or None when their regions
+overlap (see composite). when the last composite had the same groups, only the
+region covered by the groups whose key changed (before and after the change) is
+composited again
+'''
+def composed_pixels(keys, layers):
+    last = _composed
+    if last and list(last['keys']) == list(keys) and last['pixels'].shape == layers[0].shape:
+        changed = [g for g, k in keys.items() if k is None or last['keys'][g] != k]
+        boxes = [b for g in changed for b in [visible_box(last['layers'][g]), visible_box(layers[list(keys).index(g)])]
+                 if b is not None]
+        pixels = last['pixels']
+        if boxes:
+            region = (min(b[0] for b in boxes), max(b[1] for b in boxes),
+                      min(b[2] for b in boxes), max(b[3] for b in boxes))
+            pixels = composite(layers, out=pixels, region=region)
+    else:
+        pixels = composite(layers)
+
+    if pixels is None:
+        last.clear()
+        return None
+
+    last.update([('keys', dict(keys)), ('layers', dict(zip(keys, layers))), ('pixels', pixels)])
+    return pixels
+
+
+'''
+worker entry point of a parallel save: writes the figure of the job to fname and
+returns the time taken
+'''
+def save_figure(fname):
+    t0 = time.perf_counter()
+    _job['fig'].savefig(fname, dpi=_job['dpi'].get(fname, 'figure'))
+    return time.perf_counter() - t0
+
+
+'''
+saves a drawn figure to every file in fnames, vector formats with rasterized
+artists at raster_dpi, in parallel where there are several and fork is available.
+records their sizes and times in outputs
+'''
+def save_all(fig, fnames, raster_dpi=None):
+    dpi = dict([(f, raster_dpi) for f in fnames
+                if raster_dpi and os.path.splitext(f)[1].lower() in vector_formats])
+
+    if len(fnames) > 1 and 'fork' in multiprocessing.get_all_start_methods():
+        _job['fig'] = fig
+        _job['dpi'] = dpi
+        ctx = multiprocessing.get_context('fork')
+        with ProcessPoolExecutor(max_workers=min(len(fnames), os.cpu_count() or 1), mp_context=ctx,
+                                 initializer=ts5_io.worker_init) as ex:
+            ts = list(ex.map(save_figure, fnames))
+        _job.clear()
+    else:
+        ts = []
+        for f in fnames:
+            t0 = time.perf_counter()
+            fig.savefig(f, dpi=dpi.get(f, 'figure'))
+            ts.append(time.perf_counter() - t0)
+
+    for f, t in zip(fnames, ts):
+        outputs[f] = dict([('bytes', os.path.getsize(f)), ('seconds', t)])
+
+
+'''
+returns the layers of the panel groups in drawing order: from memory or the layer
+cache for the groups named in layer_keys (dict of name -> key), drawn otherwise,
+in worker processes with parallel set. drawn layers of keyed groups are stored
+'''
+def group_layers(new_figure, panels, parallel, workers, layer_keys):
+    layers = dict()
+    for group in layer_keys:
+        if group in latest and latest[group][0] == layer_keys[group]:
+            layers[group] = latest[group][1]
+            continue
+        layer = ts5_cache.get(layer_keys[group])
+        if layer is not None:
+            layers[group] = layer
+
+    todo = [group for group in panels if group not in layers]
+    if todo and parallel:
+        _job['new_figure'] = new_figure
+        _job['panels'] = panels
+
+        workers = workers or min(len(todo), os.cpu_count() or 1)
+        ctx = multiprocessing.get_context('fork')
+        with ProcessPoolExecutor(max_workers=workers, mp_context=ctx, initializer=ts5_io.worker_init) as ex:
+            for group, (layer, t, rec, stats) in zip(todo, ex.map(render_layer, todo)):
+                layers[group] = layer
+                timings[group] = t
+                ts5_profile.add(group, rec, stats)
+
+        _job.clear()
+    else:
+        for group in todo:
+            layers[group] = timed_layer(new_figure, group, panels[group])
+
+    for group in todo:
+        if group in layer_keys:
+            layers[group] = ts5_cache.put(layer_keys[group], layers[group],
+                                          replaces=layer_keys[group].rsplit('-', 1)[0])
+    for group in layer_keys:
+        latest[group] = (layer_keys[group], layers[group])
+
+    return [layers[group] for group in panels]
+
+
+'''
+draws the panel groups (dict of name -> function(fig), in drawing order) into the
+figure made by new_figure and saves it to fname, a file name or a list of them
+(one per format). by default the groups are drawn into one figure, which is
+saved with savefig. with parallel set, or groups named in layer_keys (dict of
+name -> key) to reuse from memory or the layer cache, the groups are rendered
+as layers (in worker processes with parallel set) and raster outputs are
+written from their composite, which is the single-figure image; the figure is
+drawn directly when the groups' regions overlap. vector outputs are saved from
+one figure with every group drawn, with rasterized artists at raster_dpi (the
+figure dpi by default). the figure is closed once saved
+'''
+def render(new_figure, panels, fname, parallel=False, workers=None, layer_keys=None, raster_dpi=None):
+    fnames = [fname] if isinstance(fname, str) else list(fname)
+    outputs.clear()
+
+    layer_keys = layer_keys or dict()
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        parallel = False
+
+    # layers are pixels, so vector outputs are drawn from the panel functions
+    layered = parallel or bool(layer_keys)
+    if any(os.path.splitext(f)[1].lower() in vector_formats for f in fnames):
+        layered = False
+
+    if layered:
+        layers = group_layers(new_figure, panels, parallel, workers, layer_keys)
+
+        fig = new_figure()
+        dpi = fig.dpi
+        plt.close(fig)
+
+        t0 = time.perf_counter()
+        with ts5_profile.measure('savefig', outputs=fnames):
+            pixels = composed_pixels(dict([(group, layer_keys.get(group)) for group in panels]), layers)
+            if pixels is not None:
+                # the path savefig writes raster files through, so the files are the same
+                for f in fnames:
+                    t1 = time.perf_counter()
+                    plt.imsave(f, pixels, dpi=dpi)
+                    outputs[f] = dict([('bytes', os.path.getsize(f)), ('seconds', time.perf_counter() - t1)])
+        if pixels is not None:
+            timings['savefig'] = time.perf_counter() - t0
+            return
+
+    # closed once written, as watch mode and variants render many figures in one session
+    fig = new_figure()
+    try:
+        for group in panels:
+            t0 = time.perf_counter()
+            with ts5_profile.measure(group):
+                panels[group](fig)
+            timings[group] = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        with ts5_profile.measure('savefig', outputs=fnames):
+            save_all(fig, fnames, raster_dpi)
+        timings['savefig'] = time.perf_counter() - t0
+    finally:
+        plt.close(fig)
@@ -0,0 +1,416 @@
+# coding: utf-8
+
+# ensemble statistics for Box TS.5, Figure 1
+#
+# all scenarios of a quantity are stacked into one (scenario, model, year) array,
+# padded with NaN where the number of models (or years) differs between scenarios,
+# and the multi-model mean and every requested percentile are taken from a single
+# sort along the model axis. percentiles use the same linear interpolation as
+# np.percentile, so results match the per-scenario np.percentile calls exactly.
+#
+# for many scenarios with large ensembles the reductions are fanned out over a
+# pool of forked processes: the stack and the preallocated outputs are placed in
+# shared memory, the workers inherit them with the fork and each task (a scenario
+# and a block of its years) is sent as a number and writes its mean and
+# percentiles in place, so no data is pickled either way. every year is reduced
+# on its own, so results do not depend on how the work is split.
+#
+# settings can be overridden from the environment:
+#   TS5_STATS_POOL=serial|thread|process|auto   where the reductions run (default
+#                      auto: processes for stacks over auto_bytes on more than one core)
+#   TS5_STATS_WORKERS=<n>                       pool size (default the number of cores)
+
+import mmap
+import os
+
+import numpy as np
+
+
+stats_pool = os.environ.get('TS5_STATS_POOL', 'auto')
+stats_workers = int(os.environ.get('TS5_STATS_WORKERS', '0')) or None
+
+# data size above which 'auto' fans a reduction out over processes
+auto_bytes = 64 * 2**20
+
+# arrays and tasks of the reduction being fanned out, see fan_out
+_job = dict()
+
+
+'''
+returns a float array of shape in anonymous shared memory, which forked workers
+write into and the parent sees
+'''
+def shared_array(shape):
+    size = int(np.prod(shape))
+    return np.frombuffer(mmap.mmap(-1, 8 * max(1, size)), dtype=float)[:size].reshape(shape)
+
+
+'''
+returns where a reduction over nbytes of data runs: 'thread', 'process' or None
+for this process. pool is one of TS5_STATS_POOL (the setting when None); 'auto'
+picks processes for more than auto_bytes on more than one core and default
+otherwise
+'''
+def reduction_pool(pool, nbytes, default=None):
+    pool = pool or stats_pool
+    if pool == 'auto':
+        return 'process' if nbytes > auto_bytes and (os.cpu_count() or 1) > 1 else default
+    if pool not in ['serial', 'thread', 'process']:
+        raise ValueError('unknown pool %r, expected serial, thread, process or auto' % pool)
+    return None if pool == 'serial' else pool
+
+
+'''
+worker entry point of fan_out: runs task k of the job
+'''
+def run_task(k):
+    fn, args = _job['tasks'][k]
+    fn(*args)
+
+
+'''
+runs fn(*args) for every (fn, args) in tasks, in this process (pool None) or on a
+pool of threads or forked processes (see ts5_io.pool_executor). the tasks read
+the arrays of the job in _job and write their results into shared output
+arrays, so only task numbers are sent to the workers and nothing comes back.
+the job is cleared when all tasks are done
+'''
+def fan_out(tasks, pool, workers=None):
+    _job['tasks'] = tasks
+    try:
+        if pool is None:
+            for k in range(len(tasks)):
+                run_task(k)
+            return
+
+        # ts5_io imports this module
+        import ts5_io
+
+        workers = min(len(tasks), workers or stats_workers or os.cpu_count() or 1)
+        with ts5_io.pool_executor(pool, workers) as ex:
+            list(ex.map(run_task, range(len(tasks))))
+    finally:
+        _job.clear()
+
+
+'''
+stacks a dict of scenario -> (model, year) arrays into one (scenario, model, year)
+array padded with NaN, with room for extra NaN models (in shared memory with
+shared=True). returns the keys, the stack and the year length of each entry
+'''
+def ens_stack(data, extra=0, shared=False):
+    keys = list(data)
+    arrs = [np.asarray(data[k], dtype=float) for k in keys]
+    arrs = [a.reshape(-1, a.shape[-1]) for a in arrs]
+
+    nmod = max(a.shape[0] for a in arrs) + extra
+    nyr = max(a.shape[1] for a in arrs)
+
+    if shared:
+        stack = shared_array((len(arrs), nmod, nyr))
+        stack[...] = np.nan
+    else:
+        stack = np.full((len(arrs), nmod, nyr), np.nan)
+    for i, a in enumerate(arrs):
+        stack[i, :a.shape[0], :a.shape[1]] = a
+
+    return keys, stack, [a.shape[1] for a in arrs]
+
+
+'''
+percentiles along the model axis (-2) of a NaN padded stack, NaNs count as missing
+models. returns an array with a leading axis over pcs
+'''
+def ens_percentiles(stack, pcs):
+    q = np.asarray(pcs, dtype=float) / 100.
+
+    # one sort per stack: NaN padding sorts to the end of the model axis
+    srt = np.sort(stack, axis=-2)
+    n = np.sum(~np.isnan(stack), axis=-2)
+
+    # virtual index (n-1)*q as in np.percentile(..., method='linear')
+    pos = (n - 1)[np.newaxis] * q.reshape((-1,) + (1,) * n.ndim)
+    pos = np.clip(pos, 0, None)
+    lo = np.floor(pos).astype(int)
+    hi = np.minimum(lo + 1, np.maximum(n - 1, 0))
+    frac = pos - lo
+
+    srt = np.broadcast_to(srt, (len(q),) + srt.shape)
+    a = np.take_along_axis(srt, lo[..., np.newaxis, :], axis=-2)[..., 0, :]
+    b = np.take_along_axis(srt, hi[..., np.newaxis, :], axis=-2)[..., 0, :]
+
+    # same lerp as numpy, which is exact at both ends of the interval
+    diff = b - a
+    res = np.where(frac >= 0.5, b - diff * (1 - frac), a + diff * frac)
+
+    return np.where(n > 0, res, np.nan)
+
+
+'''
+multi-model mean and percentiles of a (scenario, model, year) stack, as a
+(1 + pcs, scenario, year) array. writes them into out when given
+'''
+def stack_stats(stack, pcs, out=None):
+    if out is None:
+        out = np.empty((1 + len(pcs),) + stack.shape[::2])
+
+    n = np.sum(~np.isnan(stack), axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mmm = np.nansum(stack, axis=1) / n
+    out[0] = np.where(n > 0, mmm, np.nan)
+
+    out[1:] = ens_percentiles(stack, pcs)
+    return out
+
+
+'''
+task of ens_stats: the statistics of scenario i over years y0 to y1 of the job
+'''
+def stats_task(i, y0, y1):
+    stack_stats(_job['stack'][i:i + 1, :, y0:y1], _job['pcs'], out=_job['out'][:, i:i + 1, y0:y1])
+
+
+'''
+returns (scenario, first year, last year + 1) tasks over a (scenario, model, year)
+stack: a task per scenario, with the years split into blocks where there are
+fewer scenarios than twice the workers, so that all workers stay busy
+'''
+def stack_tasks(shape, workers):
+    nblock = -(-2 * workers // shape[0])
+    step = -(-shape[2] // nblock)
+    return [(i, y0, min(y0 + step, shape[2])) for i in range(shape[0]) for y0 in range(0, shape[2], step)]
+
+
+'''
+multi-model mean and percentiles of a dict of scenario -> (model, year) arrays,
+all in one vectorized pass. returns (mmm, [pc dict for each of pcs]) with the
+same keys as data. pool and workers say where the reductions run (see
+reduction_pool); on a pool the stack and the results are in shared memory
+'''
+def ens_stats(data, pcs=(5, 95), pool=None, workers=None):
+    size = sum(np.size(v) for v in data.values()) * 8
+    pool = reduction_pool(pool, size)
+    keys, stack, nyr = ens_stack(data, shared=pool == 'process')
+
+    if pool is None:
+        res = stack_stats(stack, pcs)
+    else:
+        workers = workers or stats_workers or os.cpu_count() or 1
+        res = shared_array((1 + len(pcs),) + stack.shape[::2]) if pool == 'process' \
+            else np.empty((1 + len(pcs),) + stack.shape[::2])
+        _job.update([('stack', stack), ('pcs', pcs), ('out', res)])
+        fan_out([(stats_task, t) for t in stack_tasks(stack.shape, workers)], pool, workers)
+    mmm, pc = res[0], res[1:]
+
+    mmm_dict = dict([(k, mmm[i, :nyr[i]]) for i, k in enumerate(keys)])
+    pc_dicts = [dict([(k, pc[j, i, :nyr[i]]) for i, k in enumerate(keys)]) for j in range(len(pcs))]
+
+    return mmm_dict, pc_dicts
+
+
+# streaming statistics for ensembles too large to hold in memory
+#
+# members are fed in chunks into a per-year quantile sketch: a merging digest
+# with the t-digest k1 scale function, vectorized over years. each year keeps at
+# most delta/2 + 2 weighted centroids plus an exact running sum, min and max,
+# so memory is O(year * delta) whatever the number of members, and two sketches
+# of the same years can be merged (e.g. from parallel workers).
+#
+# error bound: a percentile q (as a fraction) estimated from N members is the
+# exact value at some rank fraction q' with
+#
+#     |q' - q| <= 2 * pi * sqrt(q * (1 - q)) / delta + 2 / N
+#
+# i.e. with the default delta = 200 the 5th and 95th percentiles lie between the
+# exact np.percentile values at about the 4.3rd-5.7th and 94.3rd-95.7th
+# percentiles. the mean is exact. for ensembles smaller than about delta/2
+# members every member is kept and the percentiles equal np.percentile.
+
+'''
+returns an empty sketch for nyr years
+'''
+def sketch_new(nyr, delta=200):
+    nb = int(delta) // 2 + 2
+    return dict([('delta', float(delta)), ('n', 0), ('sum', np.zeros(nyr)),
+                 ('min', np.full(nyr, np.inf)), ('max', np.full(nyr, -np.inf)),
+                 ('c', np.full((nyr, nb), np.nan)), ('w', np.zeros((nyr, nb)))])
+
+
+'''
+merges weighted centroids c, w (year, n) into at most delta/2 + 2 per year.
+centroids are bucketed by the k1 scale function of their mid-point rank and
+each bucket is replaced by its weighted mean, for all years in one bincount
+'''
+def sketch_compress(c, w, delta):
+    nyr = c.shape[0]
+    nb = int(delta) // 2 + 2
+
+    order = np.argsort(np.where(w > 0, c, np.inf), axis=1, kind='stable')
+    c = np.take_along_axis(c, order, axis=1)
+    w = np.take_along_axis(w, order, axis=1)
+
+    qmid = (np.cumsum(w, axis=1) - w / 2) / w.sum(axis=1, keepdims=True)
+    b = np.floor(delta / (2 * np.pi) * np.arcsin(np.clip(2 * qmid - 1, -1, 1)) + delta / 4).astype(int)
+    b = np.clip(b, 0, nb - 2)
+
+    # empty slots go to the last bucket, which is dropped
+    b = np.where(w > 0, b, nb - 1)
+    flat = (np.arange(nyr)[:, np.newaxis] * nb + b).ravel()
+
+    ws = np.bincount(flat, weights=w.ravel(), minlength=nyr * nb).reshape(nyr, nb)
+    cs = np.bincount(flat, weights=(np.where(w > 0, c, 0) * w).ravel(), minlength=nyr * nb).reshape(nyr, nb)
+    ws[:, -1] = 0
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cs = np.where(ws > 0, cs / ws, np.nan)
+
+    return cs, ws
+
+
+'''
+adds a chunk of members (member, year) to a sketch
+'''
+def sketch_add(sk, chunk):
+    chunk = np.asarray(chunk, dtype=float).reshape(-1, sk['sum'].size)
+    if chunk.shape[0] == 0:
+        return sk
+
+    sk['n'] += chunk.shape[0]
+    sk['sum'] += chunk.sum(axis=0)
+    sk['min'] = np.minimum(sk['min'], chunk.min(axis=0))
+    sk['max'] = np.maximum(sk['max'], chunk.max(axis=0))
+
+    c = np.concatenate([sk['c'], chunk.T], axis=1)
+    w = np.concatenate([sk['w'], np.ones(chunk.T.shape)], axis=1)
+    sk['c'], sk['w'] = sketch_compress(c, w, sk['delta'])
+
+    return sk
+
+
+'''
+merges two sketches of the same years into a new one
+'''
+def sketch_merge(a, b):
+    sk = sketch_new(a['sum'].size, a['delta'])
+    sk['n'] = a['n'] + b['n']
+    sk['sum'] = a['sum'] + b['sum']
+    sk['min'] = np.minimum(a['min'], b['min'])
+    sk['max'] = np.maximum(a['max'], b['max'])
+    sk['c'], sk['w'] = sketch_compress(np.concatenate([a['c'], b['c']], axis=1),
+                                       np.concatenate([a['w'], b['w']], axis=1), a['delta'])
+    return sk
+
+
+'''
+mean and percentiles (list over pcs) from a sketch. centroids sit at the rank of
+their centre and values in between are linearly interpolated as np.percentile does
+'''
+def sketch_stats(sk, pcs=(5, 95)):
+    n, c, w = sk['n'], sk['c'], sk['w']
+    nyr = c.shape[0]
+
+    # ranks (0 .. n-1) and values of min, centroid centres and max, in rank order
+    centre = np.where(w > 0, np.cumsum(w, axis=1) - w / 2 - 0.5, np.inf)
+    rs = np.concatenate([np.zeros((nyr, 1)), centre, np.full((nyr, 1), n - 1.)], axis=1)
+    xs = np.concatenate([sk['min'][:, np.newaxis], c, sk['max'][:, np.newaxis]], axis=1)
+    order = np.argsort(rs, axis=1, kind='stable')
+    rs = np.take_along_axis(rs, order, axis=1)
+    xs = np.take_along_axis(xs, order, axis=1)
+
+    r = np.asarray(pcs, dtype=float)[:, np.newaxis] / 100. * (n - 1)
+    i = np.sum(rs[np.newaxis] <= r[..., np.newaxis], axis=-1) - 1
+    i = np.clip(i, 0, rs.shape[1] - 2)
+
+    rows = np.arange(nyr)
+    r0, r1 = rs[rows, i], rs[rows, i + 1]
+    x0, x1 = xs[rows, i], xs[rows, i + 1]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        f = np.where(np.isfinite(r1) & (r1 > r0), (r - r0) / (r1 - r0), 0.)
+
+    pc = x0 + (x1 - x0) * np.clip(f, 0, 1)
+
+    return sk['sum'] / n, list(pc)
+
+
+# bootstrap confidence intervals for the multi-model statistics
+#
+# with 4-9 models per scenario the mean and percentiles are themselves uncertain.
+# models are resampled with replacement, separately for each scenario and the
+# same way for every year, so a resample keeps whole model time series. all
+# resamples are drawn up front from a seeded generator as one (scenario,
+# resample, model) index array, so results do not depend on how the work is
+# split. the statistics of all resamples are taken in one vectorized pass per
+# block of years, and the confidence limits are percentiles of those over the
+# resamples. blocks are sized to about 32 MB and can be spread over threads
+# (numpy releases the GIL in the gather and the sorts) or forked processes
+# writing into a shared output (see fan_out).
+
+'''
+returns bootstrap indices (scenario, resample, model) for scenarios with nmod
+models each. positions beyond a scenario's model count hold max(nmod), the
+index of the NaN model ens_bootstrap adds to the stack
+'''
+def boot_indices(nmod, n_boot, seed=0):
+    nmod = np.asarray(nmod)
+    size = int(nmod.max())
+
+    rng = np.random.default_rng(seed)
+    idx = rng.integers(0, np.maximum(nmod, 1)[:, np.newaxis, np.newaxis], size=(len(nmod), n_boot, size))
+
+    return np.where(np.arange(size) < nmod[:, np.newaxis, np.newaxis], idx, size)
+
+
+'''
+confidence limits ci of the mean and percentiles pcs over the resamples idx of a
+(scenario, model, year) stack. returns (ci, 1 + pcs, scenario, year)
+'''
+def boot_block(stack, idx, pcs, ci):
+    res = stack[np.arange(stack.shape[0])[:, np.newaxis, np.newaxis], idx]
+
+    n = np.sum(~np.isnan(res), axis=-2)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mmm = np.where(n > 0, np.nansum(res, axis=-2) / n, np.nan)
+
+    st = np.concatenate([mmm[np.newaxis], ens_percentiles(res, pcs)])
+
+    # the resample axis is second to last, as the model axis of a stack
+    return ens_percentiles(st, ci)
+
+
+'''
+task of ens_bootstrap: the confidence limits over years y0 to y1 of the job
+'''
+def boot_task(y0, y1):
+    _job['out'][..., y0:y1] = boot_block(_job['stack'][..., y0:y1], _job['idx'], _job['pcs'], _job['ci'])
+
+
+'''
+bootstrap confidence intervals of the multi-model mean and percentiles of a dict
+of scenario -> (model, year) arrays. returns (mmm_ci, [pc_ci for each of pcs])
+with the keys of data, each entry a (len(ci), year) array of the lower and upper
+limits. the year blocks run where pool says (see reduction_pool), on threads
+for workers > 1 when it leaves the choice
+'''
+def ens_bootstrap(data, pcs=(5, 95), ci=(2.5, 97.5), n_boot=1000, seed=0, workers=None, pool=None):
+    # the resamples gather n_boot copies of the stack
+    shapes = [np.shape(v) for v in data.values()]
+    size = n_boot * len(shapes) * max(int(np.prod(s[:-1])) for s in shapes) * max(s[-1] for s in shapes) * 8
+    pool = reduction_pool(pool, size, 'thread' if workers and workers > 1 else None)
+
+    # the extra model is the NaN one the indices of missing models point to
+    keys, stack, nyr = ens_stack(data, extra=1, shared=pool == 'process')
+    nmod = np.sum(~np.all(np.isnan(stack), axis=-1), axis=1)
+    idx = boot_indices(nmod, n_boot, seed)
+
+    shape = (len(ci), 1 + len(pcs)) + stack.shape[::2]
+    res = shared_array(shape) if pool == 'process' else np.empty(shape)
+
+    block = max(1, (32 * 2**20) // (idx.size * 8))
+    _job.update([('stack', stack), ('idx', idx), ('pcs', pcs), ('ci', ci), ('out', res)])
+    fan_out([(boot_task, (i, min(i + block, stack.shape[-1]))) for i in range(0, stack.shape[-1], block)],
+            pool, workers)
+
+    mmm_ci = dict([(k, res[:, 0, i, :nyr[i]]) for i, k in enumerate(keys)])
+    pc_ci = [dict([(k, res[:, j + 1, i, :nyr[i]]) for i, k in enumerate(keys)]) for j in range(len(pcs))]
+
+    return mmm_ci, pc_ci
@@ -0,0 +1,331 @@
+# coding: utf-8
+
+# consolidated input store for Box TS.5, Figure 1
+#
+# the whitespace tables, the NetCDF files and the land-use file on the private
+# filesystem are ingested once into a single store file that can be copied to
+# wherever the figure is made. the store is a zip archive of uncompressed .npy
+# members (the container np.savez writes) plus a json manifest with, for every
+# source file, its variables, their year coordinates, model/column and scenario
+# labels, units and the Iris metadata needed to rebuild its cubes. every member
+# is a contiguous block in the file and is memory-mapped where it lies, so
+# reading a variable is zero-copy, slicing it only touches the pages needed and a
+# cold start costs one read of the zip directory and manifest.
+#
+# the script reads its inputs through loadtxt and load_cubes below, which serve
+# a file from the store when the store holds it and read the file itself
+# (through the binary cache for text) otherwise. h5py and zarr are not
+# dependencies of the figure, so the store only needs numpy and the zipfile
+# module.
+#
+# usage: python ts5_store.py <store> <input files...>
+#   e.g. python ts5_store.py ts5_inputs.npz *.dat *.txt *.nc /data/users/hadcn/CMIP6_C4MIP_landuse_emissions.nc
+#
+# settings can be overridden from the environment:
+#   TS5_STORE=<file>   store to read from (default ts5_inputs.npz, used if it exists)
+#   TS5_STORE=0        never read from a store
+
+import json
+import os
+import re
+import struct
+import sys
+import zipfile
+
+import numpy as np
+
+import ts5_cache
+
+
+store_path = os.environ.get('TS5_STORE', 'ts5_inputs.npz')
+store_on = store_path != '0'
+
+# units of the whitespace tables by file name pattern
+table_units = [('GtC_?yr', 'PgC yr-1'), ('_(nbp|fgco2)\\.dat$', 'PgC yr-1'), ('CO2\\.dat$', 'ppm')]
+
+# open store as dict(path, stat, manifest, offsets), see open_store
+_store = dict()
+
+
+'''
+returns the scenario named in a file name (e.g. ssp534os), or None
+'''
+def scenario_label(fname):
+    m = re.search('ssp[0-9]+(os|-over)?', os.path.basename(fname), re.IGNORECASE)
+    return m.group(0).lower() if m else None
+
+
+'''
+returns the manifest entry of a whitespace table: the loadtxt arguments it is read
+with (skiprows=1 when the first line is a header), its column labels and units
+'''
+def table_entry(fname):
+    with open(fname) as f:
+        first = f.readline().split()
+
+    try:
+        [float(v) for v in first]
+        header = None
+    except ValueError:
+        header = first
+
+    units = None
+    for pattern, u in table_units:
+        if re.search(pattern, os.path.basename(fname)):
+            units = u
+            break
+
+    return dict([('kind', 'table'), ('kwargs', dict([('skiprows', 1)]) if header else dict()),
+                 ('columns', header), ('scenario', scenario_label(fname)), ('units', units)])
+
+
+'''
+returns the json-safe part of an Iris attributes dict
+'''
+def plain_attributes(attributes):
+    return dict([(k, v.item() if isinstance(v, np.generic) else v) for k, v in attributes.items()
+                 if isinstance(v, (str, int, float, np.generic))])
+
+
+'''
+writes the store: every file in fnames is parsed (tables with np.loadtxt, NetCDF
+with Iris) and its arrays and manifest entry are added under its base name
+'''
+def ingest(store, fnames):
+    import iris
+    import ts5_timeline
+
+    manifest = dict([('version', 1), ('files', dict())])
+    tmp = store + '.%d.tmp' % os.getpid()
+
+    with zipfile.ZipFile(tmp, 'w', zipfile.ZIP_STORED, allowZip64=True) as zf:
+        def add(member, arr):
+            with zf.open(member + '.npy', 'w', force_zip64=True) as f:
+                np.lib.format.write_array(f, np.ascontiguousarray(arr), allow_pickle=False)
+            return member
+
+        for fname in fnames:
+            name = os.path.basename(fname)
+            if name in manifest['files']:
+                raise ValueError('two inputs named %s' % name)
+
+            if not fname.endswith('.nc'):
+                entry = table_entry(fname)
+                entry['data'] = add(name, np.loadtxt(fname, **entry['kwargs']))
+                manifest['files'][name] = entry
+                continue
+
+            cubes = []
+            for i, cube in enumerate(iris.load(fname)):
+                member = '%s/%d-%s' % (name, i, cube.var_name or cube.name())
+
+                # masked points are stored as NaN and masked again when read
+                data = cube.data
+                masked = np.ma.isMaskedArray(data) and bool(np.ma.getmaskarray(data).any())
+                if masked:
+                    data = np.ma.filled(data.astype(np.result_type(data.dtype, np.float32)), np.nan)
+
+                c = dict([('data', add(member, data)), ('masked', masked), ('standard_name', cube.standard_name),
+                          ('long_name', cube.long_name), ('var_name', cube.var_name),
+                          ('units', str(cube.units)), ('attributes', plain_attributes(cube.attributes)),
+                          ('coords', []), ('years', None)])
+
+                for coord in cube.coords():
+                    c['coords'].append(dict([
+                        ('points', add('%s/%s' % (member, coord.name()), coord.points)),
+                        ('bounds', add('%s/%s_bounds' % (member, coord.name()), coord.bounds)
+                            if coord.has_bounds() else None),
+                        ('dims', list(cube.coord_dims(coord))), ('dim_coord', coord in cube.dim_coords),
+                        ('standard_name', coord.standard_name), ('long_name', coord.long_name),
+                        ('var_name', coord.var_name), ('units', str(coord.units)),
+                        ('calendar', coord.units.calendar)]))
+
+                if cube.coords('time'):
+                    c['years'] = add(member + '/years', ts5_timeline.cube_years(cube))
+                cubes.append(c)
+
+            manifest['files'][name] = dict([('kind', 'cubes'), ('scenario', scenario_label(fname)),
+                                            ('cubes', cubes)])
+
+        zf.writestr('manifest.json', json.dumps(manifest, indent=1))
+
+    os.replace(tmp, store)
+    _store.clear()
+    return manifest
+
+
+'''
+opens the store at path (the configured one by default): reads the manifest and
+the offsets of the members in the file. returns the open store, or None where
+there is none
+'''
+def open_store(path=None):
+    path = os.path.abspath(path or store_path)
+    if not store_on or not os.path.exists(path):
+        return None
+
+    st = os.stat(path)
+    if _store.get('path') == path and _store['stat'] == (st.st_size, st.st_mtime_ns):
+        return _store
+
+    offsets = dict()
+    with zipfile.ZipFile(path) as zf, open(path, 'rb') as f:
+        manifest = json.loads(zf.read('manifest.json'))
+        for info in zf.infolist():
+            if not info.filename.endswith('.npy'):
+                continue
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError('%s: member %s is compressed and cannot be mapped' % (path, info.filename))
+
+            # the data follow the local file header, whose name and extra field
+            # lengths can differ from those in the central directory
+            f.seek(info.header_offset + 26)
+            n, m = struct.unpack('<HH', f.read(4))
+            f.seek(info.header_offset + 30 + n + m)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran, dtype = np.lib.format.read_array_header_2_0(f)
+            offsets[info.filename[:-4]] = (f.tell(), shape, fortran, dtype)
+
+    _store.clear()
+    _store.update([('path', path), ('stat', (st.st_size, st.st_mtime_ns)),
+                   ('manifest', manifest), ('offsets', offsets)])
+    return _store
+
+
+'''
+returns a store member as a read-only memory map
+'''
+def array(store, member):
+    offset, shape, fortran, dtype = store['offsets'][member]
+    if 0 in shape:
+        return np.empty(shape, dtype)
+    return np.memmap(store['path'], dtype=dtype, mode='r', offset=offset, shape=shape,
+                     order='F' if fortran else 'C')
+
+
+'''
+returns the manifest entry of a file in the store, or None when it is not there
+'''
+def entry(fname):
+    store = open_store()
+    if store is None:
+        return None
+    return store['manifest']['files'].get(os.path.basename(fname))
+
+
+'''
+returns the sorted names of the input files available in directory: the files
+there and the files the store holds
+'''
+def listdir(directory='.'):
+    names = set(f for f in os.listdir(directory) if os.path.isfile(os.path.join(directory, f)))
+    store = open_store()
+    if store is not None:
+        names.update(store['manifest']['files'])
+    return sorted(names)
+
+
+'''
+returns a string identifying the current version of an input file, for the stage
+fingerprints of ts5_pipeline.py: the store's when the file is served from it
+'''
+def file_tag(fname):
+    if entry(fname) is not None:
+        return 'store:%s:%s|%d|%d' % ((_store['path'], os.path.basename(fname)) + _store['stat'])
+    st = os.stat(fname)
+    return '%s|%d|%d' % (os.path.abspath(fname), st.st_size, st.st_mtime_ns)
+
+
+'''
+drop-in replacement for np.loadtxt: the table from the store (a read-only memory
+map) when the store holds it with the same arguments, else ts5_cache.loadtxt
+'''
+def loadtxt(fname, **kwargs):
+    e = entry(fname)
+    if e is not None and e['kind'] == 'table' and e['kwargs'] == kwargs:
+        return array(_store, e['data'])
+    return ts5_cache.loadtxt(fname, **kwargs)
+
+
+'''
+renames the coordinates of a cube named in rename (dict of old -> new name)
+'''
+def rename_coords(cube, rename):
+    for coord in cube.coords():
+        if coord.name() in rename:
+            coord.rename(rename[coord.name()])
+
+
+'''
+returns the cubes of a NetCDF file as an Iris CubeList, rebuilt around memory
+maps of the store when it holds the file and loaded with iris.load otherwise.
+var_names selects variables by NetCDF name, in one pass and in that order; the
+others are never read. coordinates named in rename (dict of old -> new name) are
+renamed as the cubes are loaded. data loaded from the file stay lazy
+'''
+def load_cubes(fname, var_names=None, rename=None):
+    import iris
+    import cf_units
+    from iris.coords import AuxCoord, DimCoord
+    from iris.cube import Cube, CubeList
+
+    rename = rename or dict()
+
+    e = entry(fname)
+    if e is None or e['kind'] != 'cubes':
+        callback = (lambda cube, field, filename: rename_coords(cube, rename)) if rename else None
+        if var_names is None:
+            return iris.load(fname, callback=callback)
+        return iris.load_cubes(fname, [iris.NameConstraint(var_name=v) for v in var_names], callback=callback)
+
+    stored = e['cubes']
+    if var_names is not None:
+        by_name = dict([(c['var_name'], c) for c in stored])
+        missing = [v for v in var_names if v not in by_name]
+        if missing:
+            raise ValueError('%s has no variables %s' % (fname, ', '.join(missing)))
+        stored = [by_name[v] for v in var_names]
+
+    cubes = CubeList()
+    for c in stored:
+        dim_coords, aux_coords = [], []
+        for co in c['coords']:
+            kind = DimCoord if co['dim_coord'] else AuxCoord
+            coord = kind(np.asarray(array(_store, co['points'])),
+                         bounds=np.asarray(array(_store, co['bounds'])) if co['bounds'] else None,
+                         standard_name=co['standard_name'], long_name=co['long_name'], var_name=co['var_name'],
+                         units=cf_units.Unit(co['units'], calendar=co['calendar']))
+            (dim_coords if co['dim_coord'] else aux_coords).append((coord, co['dims']))
+
+        data = array(_store, c['data'])
+        if c['masked']:
+            data = np.ma.masked_invalid(data)
+
+        cube = Cube(data, standard_name=c['standard_name'], long_name=c['long_name'],
+                    var_name=c['var_name'], units=c['units'], attributes=c['attributes'],
+                    dim_coords_and_dims=[(co, d[0]) for co, d in dim_coords],
+                    aux_coords_and_dims=aux_coords)
+        rename_coords(cube, rename)
+        cubes.append(cube)
+
+    return cubes
+
+
+'''
+returns the first cube of a NetCDF file, as iris.load(fname)[0]
+'''
+def load_cube(fname):
+    cubes = load_cubes(fname)
+    if not cubes:
+        raise ValueError('%s holds no cubes' % fname)
+    return cubes[0]
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        sys.exit('usage: python ts5_store.py <store> <input files...>')
+    m = ingest(sys.argv[1], sys.argv[2:])
+    print('%s: %d files, %.1f MB' % (sys.argv[1], len(m['files']), os.path.getsize(sys.argv[1]) / 2**20))
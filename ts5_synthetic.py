@@ -0,0 +1,229 @@
+# coding: utf-8
+
+# synthetic inputs for Box TS.5, Figure 1
+#
+# writes files with the same names, layouts and shapes as the real input data
+# (see readme_for_code_ipcc_ar6_wg1_Box_TS5_Fig1.txt), filled with smooth random
+# series of plausible magnitude. used by the benchmarks (ts5_bench.py) and for
+# running the script where the real data are not available. scale multiplies the
+# number of models, ensemble members and map grid points.
+#
+# usage: python ts5_synthetic.py <output dir> [scale]
+
+import os
+import sys
+
+import numpy as np
+
+
+# models per scenario in the Liddicoat et al. tables
+liddicoat_models = dict([('Ssp119', 5), ('Ssp126', 9), ('Ssp245', 9), ('Ssp370', 9),
+             ('Ssp434', 5), ('Ssp460', 5), ('Ssp534os', 4), ('Ssp585', 9)])
+
+# end-of-century CO2 increase (ppm) of the MAGICC scenarios
+magicc_rise = dict([('ssp119', 50), ('ssp126', 100), ('ssp245', 300), ('ssp370', 500),
+             ('ssp534-over', 200), ('ssp585', 800)])
+
+esm_2300 = ['CanESM5', 'IPSL-CM6A-LR', 'UKESM1-0-LL', 'CESM2-WACCM']
+
+lu_file = 'CMIP6_C4MIP_landuse_emissions.nc'
+
+land_frac_file = 'sftlf.nc'
+
+# models of the synthetic feedback ensemble, on grids feedback_native times finer
+# than the maps
+feedback_models = 5
+feedback_native = 2
+
+
+'''
+writes a whitespace table with an optional one-line header
+'''
+def write_table(fname, columns, header=None):
+    np.savetxt(fname, np.column_stack(columns), fmt='%.6f',
+               header=header or '', comments='')
+
+
+'''
+returns an annual time coordinate (mid-year, days since 1850-01-01) for years
+'''
+def time_coord(years):
+    import cf_units
+    from iris.coords import DimCoord
+
+    units = cf_units.Unit('days since 1850-01-01', calendar='365_day')
+    return DimCoord((np.asarray(years) - 1850) * 365. + 182., standard_name='time', units=units)
+
+
+'''
+writes the CMIP6 concentration tables
+'''
+def write_co2(rng):
+    y_hist = np.arange(1850, 2015)
+    co2_hist = 285 + 112 * np.linspace(0, 1, len(y_hist)) ** 3
+    write_table('CMIP6_HIST_CO2.dat', [y_hist, co2_hist], 'year co2')
+
+    y_ssp = np.arange(2015, 2101)
+    ramp = np.linspace(0, 1, len(y_ssp))
+    write_table('CMIP6_SSP_CO2.dat', [y_ssp] + [400 + k * ramp for k in (10, 50, 200, 100, 450, 700)],
+                'year ssp119 ssp126 ssp245 ssp534 ssp370 ssp585')
+
+    y_2300 = np.arange(2015, 2301)
+    ramp = np.linspace(0, 1, len(y_2300))
+    write_table('CMIP6_SSP2300_CO2.dat', [y_2300] + [400 + k * ramp for k in (50, 100, 1700)],
+                'year ssp126 ssp534 ssp585')
+
+    write_table('CMIP6_e-CO2.dat', [y_ssp, 400 + 750 * ramp[:86], 390 + 650 * ramp[:86], 410 + 850 * ramp[:86]],
+                'year mmm pc5 pc95')
+
+
+'''
+writes the MAGICC probabilistic ensembles as (member, year) NetCDF cubes
+'''
+def write_magicc(rng, members):
+    import iris
+    from iris.coords import DimCoord
+    from iris.cube import Cube
+
+    years = np.arange(1850, 2101)
+    ramp = np.linspace(0, 1, len(years)) ** 2
+    for s in magicc_rise:
+        spread = 1 + 0.1 * rng.standard_normal((members, 1))
+        ens = 280 + magicc_rise[s] * ramp * spread + rng.standard_normal((members, len(years)))
+        cube = Cube(ens.astype('f4'), long_name='atmospheric_co2', units='ppm',
+                    dim_coords_and_dims=[(DimCoord(np.arange(members), long_name='run_id'), 0),
+                                         (time_coord(years), 1)])
+        iris.save(cube, 'MAGICCv7.5.1_atmospheric-co2_esm-%s.nc' % s)
+
+
+'''
+writes the Liddicoat et al. flux and emission tables (year, model columns)
+'''
+def write_liddicoat(rng, scale):
+    years = np.arange(1850, 2101)
+    ramp = np.linspace(0, 1, len(years))
+    for s in liddicoat_models:
+        n = max(1, int(round(liddicoat_models[s] * scale)))
+        header = 'year ' + ' '.join('model%d' % i for i in range(n))
+        write_table('global_total_FGCO2_GtC_yr_Historical%s.txt' % s,
+                    [years] + [3 * ramp + 0.2 * rng.standard_normal(len(years)) for i in range(n)], header)
+        write_table('global_total_NBP_GtC_yr_Historical%s.txt' % s,
+                    [years] + [2 * ramp + 0.5 * rng.standard_normal(len(years)) for i in range(n)], header)
+        write_table('ffEms%s_GtCyr.txt' % ('Historical' + s),
+                    [years[1:]] + [0.1 + 12 * ramp[1:] + 0.1 * rng.standard_normal(len(years) - 1) for i in range(n)],
+                    header)
+
+
+'''
+writes the 2300 extensions (year, ssp126, ssp534, ssp585 columns, no header)
+'''
+def write_2300(rng):
+    years = np.arange(2015, 2301)
+    for m in esm_2300:
+        for v, base in [('nbp', 1.), ('fgco2', 2.)]:
+            write_table('%s_%s.dat' % (m, v), [years] + [base + k + rng.standard_normal(len(years)) for k in (0, 1, 2)])
+
+
+'''
+writes the historical land-use emissions (kg C yr-1, 1850-2014)
+'''
+def write_land_use(rng):
+    import iris
+    from iris.cube import Cube
+
+    years = np.arange(1850, 2015)
+    cube = Cube(1e12 * (0.5 + 0.5 * rng.random(len(years))), long_name='landuse_emissions', units='kg yr-1',
+                dim_coords_and_dims=[(time_coord(years), 0)])
+    iris.save(cube, lu_file)
+
+
+'''
+writes carbon_feedback_parameters.nc: beta/gamma ensemble means and sign agreement
+on a lat-lon grid plus land/ocean zonal means and spreads, and the land fraction
+of the grid to land_frac_file. the files are built like the real ones, from an
+ensemble of feedback_models models on grids feedback_native times finer than the
+maps, each with its own continents: the zonal means and spreads are the ensemble
+mean and standard deviation of each model's integrals over the land and ocean
+parts of its latitude circles, and the maps and land fraction are ensemble means
+regridded (area-weighted) to the map grid. the profiles ts5_grid.py computes from
+the maps therefore differ from the file's by the regridding and by the spread of
+the models' land fractions, as for the real data (see ts5_grid.profile_rtol)
+'''
+def write_feedback(rng, scale):
+    import iris
+    from iris.coords import DimCoord
+    from iris.cube import Cube, CubeList
+
+    nlat = int(round(180 * np.sqrt(scale)))
+    dlat = 180. / nlat
+    lat = DimCoord(np.linspace(-90 + dlat / 2, 90 - dlat / 2, nlat), var_name='lat', long_name='lat', units='degrees')
+    lon = DimCoord(np.linspace(dlat / 2, 360 - dlat / 2, 2 * nlat), var_name='lon', long_name='lon', units='degrees')
+
+    # the models' grid
+    n = feedback_native
+    nf, df = n * nlat, dlat / n
+    la, lo = np.meshgrid(np.radians(np.linspace(-90 + df / 2, 90 - df / 2, nf)),
+                         np.radians(np.linspace(df / 2, 360 - df / 2, 2 * nf)), indexing='ij')
+
+    # relative areas of its cells and their widths (m), their area over their meridional extent
+    edges = np.radians(np.linspace(-90, 90, nf + 1))
+    area = np.repeat((np.sin(edges[1:]) - np.sin(edges[:-1]))[:, None], 2 * nf, axis=1)
+    width = 6371e3 * area[:, 0] * np.radians(360. / (2 * nf)) / np.radians(df)
+
+    # area-weighted means of the n x n model cells of each map cell
+    def regrid(x):
+        blocks = lambda y: y.reshape(y.shape[:-2] + (nlat, n, 2 * nlat, n)).sum(axis=(-3, -1))
+        return blocks(x * area) / blocks(area)
+
+    # smooth continents with partly land cells along their coasts, shifted a little in each model
+    shift = rng.uniform(-.02, .02, (feedback_models, 2, 1, 1))
+    frac = np.clip(2 * np.sin(2 * (lo + shift[:, 0])) * np.cos(la) + np.sin(3 * la) - .5 + shift[:, 1], 0, 1)
+    iris.save(Cube(100 * regrid(frac.mean(axis=0)), var_name='sftlf', units='%',
+                   dim_coords_and_dims=[(lat.copy(), 0), (lon.copy(), 1)]), land_frac_file)
+
+    cubes = CubeList()
+    for v, amp in [('beta', 0.01), ('gamma', 0.6)]:
+        gain = 1 + 0.2 * rng.standard_normal((feedback_models, 1, 1))
+        phase = rng.uniform(-.3, .3, (feedback_models, 1, 1))
+        field = amp * gain * np.sin(la) * np.cos(lo + phase) + 0.1 * amp * rng.standard_normal(frac.shape)
+
+        cubes.append(Cube(regrid(field.mean(axis=0)), var_name='%s_ensmean' % v,
+                          dim_coords_and_dims=[(lat.copy(), 0), (lon.copy(), 1)]))
+        cubes.append(Cube(rng.random((nlat, 2 * nlat)), var_name='%s_fraction_sign_agreement' % v,
+                          dim_coords_and_dims=[(lat.copy(), 0), (lon.copy(), 1)]))
+        for r, f in [('land', frac), ('ocean', 1 - frac)]:
+            # each model's integral per metre of latitude, over the model rows of a map row
+            total = 1e-6 * (field * f * width[:, None]).sum(axis=-1).reshape(feedback_models, nlat, n).mean(axis=-1)
+            cubes.append(Cube(total.mean(axis=0), var_name='%s_%s_zonalmean_ensmean' % (v, r),
+                              dim_coords_and_dims=[(lat.copy(), 0)]))
+            cubes.append(Cube(total.std(axis=0), var_name='%s_%s_zonalmean_ensstd' % (v, r),
+                              dim_coords_and_dims=[(lat.copy(), 0)]))
+    iris.save(cubes, 'carbon_feedback_parameters.nc')
+
+
+'''
+writes a full set of synthetic inputs into dirname. scale multiplies the number of
+models, MAGICC members (600 at scale 1) and map grid points. returns the path of
+the land-use file, which the script reads from TS5_LU_FILE when set
+'''
+def write_inputs(dirname, scale=1., seed=0):
+    rng = np.random.default_rng(seed)
+    os.makedirs(dirname, exist_ok=True)
+
+    cwd = os.getcwd()
+    os.chdir(dirname)
+    try:
+        write_co2(rng)
+        write_magicc(rng, max(1, int(round(600 * scale))))
+        write_liddicoat(rng, scale)
+        write_2300(rng)
+        write_land_use(rng)
+        write_feedback(rng, scale)
+    finally:
+        os.chdir(cwd)
+
+    return os.path.join(os.path.abspath(dirname), lu_file)
+
+
+if __name__ == '__main__':
+    print(write_inputs(sys.argv[1], float(sys.argv[2]) if len(sys.argv) > 2 else 1.))
@@ -0,0 +1,258 @@
+# coding: utf-8
+
+# tests of the helper modules of Box TS.5, Figure 1
+#
+# each vectorized piece is checked against the plain numpy it replaces, and what
+# is written to disk against the arrays written into it
+#
+# usage: python -m pytest ts5_test.py
+
+import os
+
+import numpy as np
+import pytest
+
+import ts5_cache
+import ts5_export
+import ts5_io
+import ts5_pipeline
+import ts5_stats
+import ts5_store
+import ts5_timeline
+
+
+'''
+returns a dict of scenario -> (model, year) arrays with different model counts and
+year lengths, as the Liddicoat tables have
+'''
+def ensembles(seed=0, shapes=((4, 50), (9, 60), (7, 60))):
+    rng = np.random.default_rng(seed)
+    return dict([('ssp%d' % i, rng.standard_normal(s).cumsum(axis=1)) for i, s in enumerate(shapes)])
+
+
+def test_ens_stats_matches_np_percentile():
+    data = ensembles()
+    pcs = [5, 17, 50, 83, 95]
+    mmm, pc = ts5_stats.ens_stats(data, pcs, pool='serial')
+
+    for k, a in data.items():
+        np.testing.assert_allclose(mmm[k], a.mean(axis=0), rtol=1e-12)
+        for j, p in enumerate(pcs):
+            np.testing.assert_array_equal(pc[j][k], np.percentile(a, p, axis=0))
+
+
+def test_load_cube_is_the_first_cube(tmp_path):
+    iris = pytest.importorskip('iris')
+    from iris.cube import Cube
+
+    fname = str(tmp_path / 'two_cubes.nc')
+    iris.save([Cube(np.arange(3.), var_name='first'), Cube(np.arange(4.), var_name='second')], fname)
+
+    cube = ts5_store.load_cube(fname)
+    assert cube.var_name == iris.load(fname)[0].var_name
+    np.testing.assert_array_equal(cube.data, iris.load(fname)[0].data)
+
+
+@pytest.mark.parametrize('merge', [False, True])
+def test_sketch_within_rank_error_bound(merge):
+    rng = np.random.default_rng(6)
+    members = rng.lognormal(size=(5000, 20))
+    delta, pcs = 200, [1, 5, 50, 95, 99]
+
+    if merge:
+        halves = [ts5_stats.sketch_new(20, delta) for i in range(2)]
+        for i in range(0, len(members), 500):
+            ts5_stats.sketch_add(halves[i // 500 % 2], members[i:i + 500])
+        sk = ts5_stats.sketch_merge(*halves)
+    else:
+        sk = ts5_stats.sketch_new(20, delta)
+        for i in range(0, len(members), 500):
+            ts5_stats.sketch_add(sk, members[i:i + 500])
+    mmm, pc = ts5_stats.sketch_stats(sk, pcs)
+
+    np.testing.assert_allclose(mmm, members.mean(axis=0), rtol=1e-12)
+    for p, est in zip(pcs, pc):
+        q = p / 100.
+        bound = 2 * np.pi * np.sqrt(q * (1 - q)) / delta + 2. / len(members)
+        lo = np.percentile(members, 100 * max(0., q - bound), axis=0)
+        hi = np.percentile(members, 100 * min(1., q + bound), axis=0)
+        assert np.all((est >= lo) & (est <= hi))
+
+
+def test_sketch_exact_for_small_ensembles():
+    members = np.random.default_rng(7).standard_normal((60, 10))
+    sk = ts5_stats.sketch_add(ts5_stats.sketch_new(10, 200), members)
+    mmm, pc = ts5_stats.sketch_stats(sk, [5, 95])
+
+    np.testing.assert_allclose(pc[0], np.percentile(members, 5, axis=0), rtol=1e-12)
+    np.testing.assert_allclose(pc[1], np.percentile(members, 95, axis=0), rtol=1e-12)
+
+
+def test_fingerprint_covers_imported_helpers():
+    here = os.path.dirname(os.path.abspath(__file__))
+    closure = [os.path.basename(p) for p in ts5_pipeline.module_closure(os.path.join(here, 'ts5_io.py'))]
+
+    assert closure[0] == 'ts5_io.py'
+    assert set(['ts5_cache.py', 'ts5_stats.py', 'ts5_store.py', 'ts5_timeline.py']) <= set(closure)
+
+
+def test_bootstrap_matches_loop():
+    data = ensembles(2)
+    pcs, ci, n_boot, seed = [5, 95], [2.5, 97.5], 200, 3
+    mmm_ci, pc_ci = ts5_stats.ens_bootstrap(data, pcs, ci, n_boot=n_boot, seed=seed, pool='serial')
+
+    nmod = [a.shape[0] for a in data.values()]
+    idx = ts5_stats.boot_indices(nmod, n_boot, seed)
+    for i, (k, a) in enumerate(data.items()):
+        stats = []
+        for b in range(n_boot):
+            sample = a[idx[i, b, :nmod[i]]]
+            stats.append([sample.mean(axis=0)] + [np.percentile(sample, p, axis=0) for p in pcs])
+        limits = np.percentile(np.array(stats), ci, axis=0)
+
+        np.testing.assert_allclose(mmm_ci[k], limits[:, 0], rtol=1e-10)
+        for j in range(len(pcs)):
+            np.testing.assert_allclose(pc_ci[j][k], limits[:, j + 1], rtol=1e-10)
+
+
+def test_boot_indices_in_range():
+    idx = ts5_stats.boot_indices([3, 5], 50, seed=1)
+    assert idx.shape == (2, 50, 5)
+    assert idx[0, :, :3].max() < 3 and np.all(idx[0, :, 3:] == 5)
+    assert idx[1].max() < 5
+    np.testing.assert_array_equal(idx, ts5_stats.boot_indices([3, 5], 50, seed=1))
+
+
+def test_store_table_matches_loadtxt(tmp_path):
+    pytest.importorskip('iris')
+
+    fname = str(tmp_path / 'CanESM5_nbp.dat')
+    table = np.column_stack([np.arange(1850, 1900), np.random.default_rng(8).standard_normal((50, 3))])
+    np.savetxt(fname, table, fmt='%.6f', header='year a b c', comments='')
+
+    store = str(tmp_path / 'ts5_inputs.npz')
+    e = ts5_store.ingest(store, [fname])['files']['CanESM5_nbp.dat']
+    arr = ts5_store.array(ts5_store.open_store(store), e['data'])
+
+    assert e['kwargs'] == dict([('skiprows', 1)])
+    np.testing.assert_array_equal(arr, np.loadtxt(fname, skiprows=1))
+
+
+'''
+returns the export series and values of flux statistics of ensembles with a few
+missing models at the end, as (series, values)
+'''
+def flux_export(seed):
+    data = ensembles(seed)
+    for a in data.values():
+        a[:2, -5:] = np.nan
+    y = dict([(k, np.arange(1850, 1850 + a.shape[1])) for k, a in data.items()])
+    values = dict([('flx', data), ('y', y),
+                   ('flx_mmm', dict([(k, np.nanmean(a, axis=0)) for k, a in data.items()])),
+                   ('flx_mmm_ci', dict([(k, np.nanpercentile(a, [2.5, 97.5], axis=0)) for k, a in data.items()]))])
+    series = [('f', 'mmm', 'flx_mmm', 'y', 'flx'), ('f', 'mmm_ci', 'flx_mmm_ci', 'y', 'flx')]
+    return series, values
+
+
+def test_export_npz_roundtrip(tmp_path):
+    series, values = flux_export(9)
+
+    fname = str(tmp_path / 'export.npz')
+    n = ts5_export.write(fname, series, values, 'base')
+    assert n == 3 * sum(len(v) for v in values['y'].values())
+
+    for k, a in values['flx'].items():
+        rows = ts5_export.read(fname, scenario=k, statistic='mmm')
+        assert np.all(rows['run'] == 'base')
+        np.testing.assert_array_equal(rows['year'], values['y'][k])
+        np.testing.assert_array_equal(rows['value'], values['flx_mmm'][k])
+        np.testing.assert_array_equal(rows['n_models'], np.sum(np.isfinite(a), axis=0))
+        for j, s in enumerate(['_lo', '_hi']):
+            rows = ts5_export.read(fname, ['value'], scenario=k, statistic='mmm_ci' + s)
+            np.testing.assert_array_equal(rows['value'], values['flx_mmm_ci'][k][j])
+
+
+def test_export_appends_runs(tmp_path):
+    fname = str(tmp_path / 'export.npz')
+    runs = dict([('a', flux_export(9)), ('b', flux_export(10))])
+    for run, (series, values) in runs.items():
+        ts5_export.write(fname, series, values, run, append=True)
+
+    for run, (series, values) in runs.items():
+        for k in values['flx']:
+            rows = ts5_export.read(fname, ['value'], run=run, scenario=k, statistic='mmm')
+            np.testing.assert_array_equal(rows['value'], values['flx_mmm'][k])
+
+    with pytest.raises(ValueError, match='already holds run a'):
+        ts5_export.write(fname, *runs['a'], 'a', append=True)
+
+
+'''
+returns the mean over the points of y a centred window of width w covers at each
+position, the window of np.convolve(y, np.ones(w) / w, mode='same')
+'''
+def covered_mean(y, w):
+    n = len(y)
+    return np.array([y[max(0, i - w // 2):min(n, i + (w - 1) // 2 + 1)].mean() for i in range(n)])
+
+
+@pytest.mark.parametrize('w', [1, 2, 5, 10, 31])
+def test_running_mean_matches_convolve(w):
+    y = np.random.default_rng(w).standard_normal(100)
+    res = ts5_timeline.running_mean(y, w)
+
+    # away from the ends the window is full, as in np.convolve
+    inner = slice(w // 2, len(y) - (w - 1) // 2)
+    np.testing.assert_allclose(res[inner], np.convolve(y, np.ones(w) / w, mode='same')[inner], rtol=1e-10)
+
+    # at the ends the mean is over the points the window covers, not zero padded
+    np.testing.assert_allclose(res, covered_mean(y, w), rtol=1e-10)
+
+
+def test_running_mean_of_padded_stack():
+    rng = np.random.default_rng(5)
+    stack = rng.standard_normal((3, 40))
+    stack[1, 30:] = np.nan
+    w = np.array([5, 10, 20])
+
+    res = ts5_timeline.running_mean(stack, w)
+    for m in range(3):
+        n = np.sum(np.isfinite(stack[m]))
+        np.testing.assert_allclose(res[m, :n], covered_mean(stack[m, :n], w[m]), rtol=1e-10)
+        assert np.all(np.isnan(res[m, n:]))
+
+
+def test_load_columns_skips_what_loadtxt_skips(tmp_path, monkeypatch):
+    monkeypatch.setattr(ts5_cache, 'cache_on', False)
+
+    fname = str(tmp_path / 'ffEmsHistoricalSsp119_GtCyr.txt')
+    with open(fname, 'w') as f:
+        f.write('year a b\n1850 1.0 2.0\n\n# a comment\n1851 1.5 2.5  # inline\n1852 2.0 3.0\n\n')
+
+    assert ts5_io.table_shape(fname, 1) == (3, 3)
+    t = ts5_io.load_columns([fname], skiprows=1, pool='thread')[0]
+    np.testing.assert_array_equal(t, np.loadtxt(fname, skiprows=1).T)
+
+
+def test_ens_stats_same_in_every_pool():
+    data = ensembles(1, ((30, 200), (25, 180), (30, 200), (12, 200)))
+    serial = ts5_stats.ens_stats(data, [5, 95], pool='serial')
+
+    for pool in ['thread', 'process']:
+        mmm, pc = ts5_stats.ens_stats(data, [5, 95], pool=pool, workers=2)
+        for k in data:
+            np.testing.assert_array_equal(mmm[k], serial[0][k])
+            for j in range(2):
+                np.testing.assert_array_equal(pc[j][k], serial[1][j][k])
+
+
+def test_bootstrap_same_in_every_pool():
+    data = ensembles(4)
+    serial = ts5_stats.ens_bootstrap(data, n_boot=100, pool='serial')
+
+    for pool in ['thread', 'process']:
+        mmm_ci, pc_ci = ts5_stats.ens_bootstrap(data, n_boot=100, pool=pool, workers=2)
+        for k in data:
+            np.testing.assert_array_equal(mmm_ci[k], serial[0][k])
+            for j in range(2):
+                np.testing.assert_array_equal(pc_ci[j][k], serial[1][j][k])
@@ -0,0 +1,175 @@
+# coding: utf-8
+
+# shared year index for the time series of Box TS.5, Figure 1
+#
+# series that start or end in different years (historical to 2014, SSPs from
+# 2015, emissions from 1851, land use from the historical record plus scenario
+# interpolation, extensions to 2300) are written once into arrays laid out on a
+# common year index and handed around as views with an offset into it, instead
+# of being stitched together with np.append / np.insert / np.concatenate copies.
+
+import numpy as np
+
+
+# days per year of the fixed-length cftime calendars
+calendar_days = dict([('360_day', 360.), ('365_day', 365.), ('noleap', 365.),
+             ('366_day', 366.), ('all_leap', 366.)])
+
+# seconds per unit of the "<unit> since <date>" time units Iris uses
+unit_seconds = dict([('second', 1.), ('seconds', 1.), ('minute', 60.), ('minutes', 60.),
+             ('hour', 3600.), ('hours', 3600.), ('day', 86400.), ('days', 86400.)])
+
+
+'''
+returns a numpy array of years from the time coordinate of an Iris cube. decoding
+is vectorized for "<unit> since <date>" units in the standard and fixed-length
+calendars and falls back to cftime objects otherwise
+'''
+def cube_years(cube):
+    t = cube.coord('time')
+    units = t.units
+    points = np.asarray(t.points, dtype=float)
+
+    step, since, origin = (str(units.origin).split(None, 2) + ['', ''])[:3]
+    calendar = str(units.calendar)
+
+    if since == 'since' and step in unit_seconds:
+        seconds = points * unit_seconds[step]
+        if calendar in ['standard', 'gregorian', 'proleptic_gregorian']:
+            t0 = units.num2date(0)
+            if calendar == 'proleptic_gregorian' or t0.year > 1582:
+                start = np.datetime64(t0.strftime('%Y-%m-%dT%H:%M:%S'), 's')
+                dates = start + np.round(seconds).astype('timedelta64[s]')
+                return dates.astype('datetime64[Y]').astype(int) + 1970
+        elif calendar in calendar_days:
+            t0 = units.num2date(0)
+            year_seconds = calendar_days[calendar] * 86400.
+            day0 = (t0.dayofyr - 1) * 86400. + t0.hour * 3600. + t0.minute * 60. + t0.second
+            return t0.year + np.floor((seconds + day0) / year_seconds).astype(int)
+
+    return np.array([d.year for d in units.num2date(points)])
+
+
+'''
+returns a shared year index running from start to end inclusive
+'''
+def index(start, end):
+    return np.arange(int(start), int(end) + 1)
+
+
+'''
+returns the offset of years (first year, or an array of consecutive years) in a
+year index, checking that they fit into it
+'''
+def offset(idx, years):
+    years = np.atleast_1d(years)
+    i0 = int(years[0] - idx[0])
+    if i0 < 0 or i0 + len(years) > len(idx) or \
+            (len(years) > 1 and not np.array_equal(idx[i0:i0 + len(years)], years)):
+        raise ValueError('years %d-%d do not fit the index %d-%d'
+                         % (years[0], years[-1], idx[0], idx[-1]))
+    return i0
+
+
+'''
+returns values (..., year) laid out on the year index idx: written once into a
+new array (or out) at their offset, with fill elsewhere. values that already
+span the whole index are returned as they are
+'''
+def place(idx, years, values, fill=np.nan, out=None):
+    values = np.asarray(values)
+    i0 = offset(idx, years)
+
+    if out is None:
+        if i0 == 0 and values.shape[-1] == len(idx):
+            return values
+        out = np.full(values.shape[:-1] + (len(idx),), fill, dtype=float)
+
+    out[..., i0:i0 + values.shape[-1]] = values
+    return out
+
+
+'''
+returns the view of an array laid out on idx for the years start to end inclusive
+'''
+def view(idx, arr, start, end):
+    i0 = offset(idx, start)
+    return arr[..., i0:i0 + int(end) - int(start) + 1]
+
+
+'''
+linear interpolation of every row of fp (..., len(xp)) to x, sharing one
+search for the interpolation weights. matches np.interp row by row
+'''
+def interp_batch(x, xp, fp):
+    x = np.asarray(x, dtype=float)
+    xp = np.asarray(xp, dtype=float)
+    fp = np.asarray(fp, dtype=float)
+
+    j = np.clip(np.searchsorted(xp, x, side='right') - 1, 0, len(xp) - 2)
+    slope = (fp[..., j + 1] - fp[..., j]) / (xp[j + 1] - xp[j])
+    res = slope * (x - xp[j]) + fp[..., j]
+
+    # exact at the knots and constant beyond the ends, as np.interp
+    res = np.where(x == xp[j + 1], fp[..., j + 1], res)
+    res = np.where(x <= xp[0], fp[..., :1], res)
+    res = np.where(x >= xp[-1], fp[..., -1:], res)
+
+    return res
+
+
+'''
+centred running mean of width w along axis of a (a 1-d series or a (model, year)
+or (scenario, model, year) stack) from running sums, O(n) whatever the width.
+the window covers w // 2 points before and (w - 1) // 2 after, as
+np.convolve(y, np.ones(w) / w, mode='same'), but near the ends and next to NaN
+(padding of ens_stats stacks) the mean is taken over the points the window does
+cover instead of counting the missing ones as zeros. NaN points stay NaN. w can
+also be an array of widths, one per series, broadcast over the leading axes
+'''
+def running_mean(a, w, axis=-1):
+    a = np.moveaxis(np.asarray(a, dtype=float), axis, -1)
+    n = a.shape[-1]
+    w = np.asarray(w, dtype=int)[..., None]
+
+    ok = np.isfinite(a)
+    zero = np.zeros(a.shape[:-1] + (1,))
+    total = np.concatenate([zero, np.cumsum(np.where(ok, a, 0.), axis=-1)], axis=-1)
+    count = np.concatenate([zero, np.cumsum(ok, axis=-1)], axis=-1)
+
+    i = np.arange(n)
+    lo = np.broadcast_to(np.clip(i - w // 2, 0, n), a.shape)
+    hi = np.broadcast_to(np.clip(i + (w - 1) // 2 + 1, 0, n), a.shape)
+
+    s = np.take_along_axis(total, hi, axis=-1) - np.take_along_axis(total, lo, axis=-1)
+    k = np.take_along_axis(count, hi, axis=-1) - np.take_along_axis(count, lo, axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        res = np.where(ok & (k > 0), s / k, np.nan)
+
+    return np.moveaxis(res, -1, axis)
+
+
+'''
+returns the prefix sums of a (..., year) array along the years with a leading
+zero, so that the sum over the years at positions i0..i1 is p[..., i1 + 1] - p[..., i0]
+'''
+def prefix_sums(a):
+    a = np.asarray(a, dtype=float)
+    p = np.zeros(a.shape[:-1] + (a.shape[-1] + 1,))
+    np.cumsum(a, axis=-1, out=p[..., 1:])
+    return p
+
+
+'''
+returns the sums over the windows of years start..end (inclusive; scalars, or
+arrays of windows) of the series behind prefix sums p (see prefix_sums) laid out
+on the year index idx, as (..., window). every window costs two lookups per
+series whatever its length
+'''
+def window_sums(p, idx, start, end):
+    i0 = np.asarray(start, dtype=int) - int(idx[0])
+    i1 = np.asarray(end, dtype=int) - int(idx[0]) + 1
+    if np.any(i0 < 0) or np.any(i1 > p.shape[-1] - 1) or np.any(i1 <= i0):
+        raise ValueError('windows %s-%s do not fit the index %d-%d'
+                         % (np.min(start), np.max(end), idx[0], idx[-1]))
+    return p[..., i1] - p[..., i0]
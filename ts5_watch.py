@@ -0,0 +1,216 @@
+# coding: utf-8
+
+# watch mode for Box TS.5, Figure 1
+#
+# the figure is rendered once and then again whenever one of the input files of
+# the pipeline stages (or the input store serving them) or a settings file
+# changes. the files are polled for their size and mtime (see
+# ts5_store.file_tag), so no file-system notification package is needed.
+#
+# a re-render is an ordinary render of the script: the stage fingerprints of
+# ts5_pipeline.py recompute only the stages downstream of what changed, and the
+# layer keys of the panel groups redraw only the panels whose code, data or
+# settings changed. the others are reused from memory, and only the region of
+# the changed panels is composited again (see ts5_render.py). a restyled
+# time-series panel is back on screen in about a second, while a change to the
+# map settings or the feedback file takes as long as the maps take to draw.
+#
+# the latest image is served on a local preview page, which the server tells to
+# reload the image after every render (server-sent events). when a render fails,
+# e.g. on a half-written table or a bad settings file, the page shows the error
+# over the last good image and the next change is tried again.
+#
+# the settings file is a json dict of script settings, as one variant of
+# TS5_VARIANTS, e.g. {"xr": [1950, 2100], "col": {"ssp126": "#0000FF"}}.
+
+import http.server
+import json
+import os
+import threading
+import time
+import traceback
+
+import ts5_store
+
+
+# state of the preview page: version (number of renders), image_version (the
+# last one that produced an image), image (PNG bytes), status (message) and
+# whether the last render failed
+_state = dict([('version', 0), ('image_version', 0), ('image', None), ('status', 'rendering'), ('error', False)])
+
+# notified whenever _state changes
+_changed = threading.Condition()
+
+page = '''<!DOCTYPE html>
+<html>
+<head><meta charset="utf-8"><title>Box TS.5, Figure 1</title></head>
+<body style="margin: 0; font-family: sans-serif">
+<div id="status" style="position: fixed; top: 0; width: 100%; padding: 4px; background: #eee; white-space: pre"></div>
+<img id="figure" style="max-width: 100%; margin-top: 2em">
+<script>
+var shown = 0;
+var events = new EventSource('/events');
+events.onmessage = function (e) {
+    var m = JSON.parse(e.data);
+    var status = document.getElementById('status');
+    status.textContent = m.status;
+    status.style.background = m.error ? '#fcc' : '#eee';
+    if (m.image_version != shown) {
+        document.getElementById('figure').src = '/image?v=' + m.image_version;
+        shown = m.image_version;
+    }
+};
+</script>
+</body>
+</html>
+'''
+
+
+'''
+serves the preview page, the latest image and the render events
+'''
+class Preview(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path == '/':
+            self.send_body(page.encode(), 'text/html; charset=utf-8')
+        elif path == '/image' and _state['image'] is not None:
+            self.send_body(_state['image'], 'image/png')
+        elif path == '/events':
+            self.send_events()
+        else:
+            self.send_error(404)
+
+    def send_body(self, body, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_events(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+
+        seen = None
+        try:
+            while True:
+                with _changed:
+                    _changed.wait_for(lambda: _state['version'] != seen, timeout=15)
+                    event = dict([(k, _state[k]) for k in ['version', 'image_version', 'status', 'error']])
+                if event['version'] == seen:
+                    # keeps the connection open through proxies and idle timeouts
+                    self.wfile.write(b': waiting\n\n')
+                else:
+                    self.wfile.write(('data: %s\n\n' % json.dumps(event)).encode())
+                    seen = event['version']
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+'''
+starts the preview server on localhost in a background thread and returns it
+'''
+def serve(port):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), Preview)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+'''
+publishes the outcome of a render to the preview page: the PNG file to show (or
+None to keep the last image) and a status message
+'''
+def publish(fname, status, error=False):
+    image = None
+    if fname is not None:
+        with open(fname, 'rb') as f:
+            image = f.read()
+
+    with _changed:
+        _state['version'] += 1
+        if image is not None:
+            _state['image'] = image
+            _state['image_version'] = _state['version']
+        _state['status'] = status
+        _state['error'] = error
+        _changed.notify_all()
+
+
+'''
+returns the current version of each file in fnames (see ts5_store.file_tag), None
+for files that do not exist (e.g. while an editor replaces them)
+'''
+def file_tags(fnames):
+    tags = dict()
+    for f in fnames:
+        try:
+            tags[f] = ts5_store.file_tag(f)
+        except OSError:
+            tags[f] = None
+    return tags
+
+
+'''
+reads the settings file: a json dict, empty when the file does not exist
+'''
+def read_settings(fname):
+    if not os.path.exists(fname):
+        return dict()
+    with open(fname) as f:
+        settings = json.load(f)
+    if not isinstance(settings, dict):
+        raise ValueError('%s must hold a json dict of settings' % fname)
+    return settings
+
+
+'''
+renders the figure with update(settings), a function applying the settings and
+rendering the figure that returns the files written, and again whenever
+settings_file or one of the files returned by inputs() changes, checking every
+interval seconds. the latest PNG is shown on http://localhost:<port>/. runs
+until interrupted
+'''
+def watch(update, settings_file, inputs, port=8050, interval=.2):
+    server = serve(port)
+    print('watching %s and the inputs, preview on http://localhost:%d/ (ctrl-c to stop)' % (settings_file, port))
+
+    tags = None
+    try:
+        while True:
+            now = file_tags([settings_file] + inputs())
+            if now == tags:
+                time.sleep(interval)
+                continue
+
+            changed = [f for f in now if tags is not None and now[f] != tags.get(f)]
+            tags = now
+            if changed:
+                print('changed: %s' % ', '.join(os.path.basename(f) for f in changed))
+
+            t0 = time.perf_counter()
+            try:
+                fnames = update(read_settings(settings_file))
+            except Exception as e:
+                traceback.print_exc()
+                publish(None, 'render failed at %s, showing the last image:\n%s: %s' %
+                        (time.strftime('%H:%M:%S'), type(e).__name__, e), error=True)
+                continue
+
+            t = time.perf_counter() - t0
+            png = [f for f in fnames if f.lower().endswith('.png')]
+            publish(png[0] if png else None, 'rendered %s at %s in %.2f s' %
+                    (', '.join(fnames), time.strftime('%H:%M:%S'), t))
+            print('updated in %.2f s' % t)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        server.server_close()